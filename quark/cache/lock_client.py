@@ -0,0 +1,53 @@
+# Copyright 2015 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#
+
+from oslo_log import log as logging
+
+from quark.cache import redis_base
+
+
+LOG = logging.getLogger(__name__)
+
+# NOTE: only deletes the lease if it still holds our value, so a holder
+#       whose lease expired can't release somebody else's.
+RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class LockClient(redis_base.ClientBase):
+    """Lease locks kept in the Redis master.
+
+    A lease is a key set with NX and an expiry.
+    """
+
+    def lock_key(self, name):
+        return "quark.lock.{0}".format(name)
+
+    @redis_base.handle_connection_error
+    def acquire(self, name, value, ttl_ms):
+        """Returns True if the lease was taken."""
+        return bool(self._client.master.set(self.lock_key(name), value,
+                                            nx=True, px=ttl_ms))
+
+    @redis_base.handle_connection_error
+    def release(self, name, value):
+        """Returns False if the lease had already expired."""
+        released = self._client.master.eval(RELEASE_SCRIPT, 1,
+                                            self.lock_key(name), value)
+        return bool(released)
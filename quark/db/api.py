@@ -13,11 +13,15 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import base64
+import collections
 import datetime
 import inspect
+import random
 
 import json
 import netaddr
+from neutron.common import exceptions
 from neutron.db.sqlalchemyutils import paginate_query
 from oslo_config import cfg
 from oslo_log import log as logging
@@ -25,10 +29,11 @@ from oslo_utils import timeutils
 from oslo_utils import uuidutils
 from sqlalchemy import event
 from sqlalchemy import func as sql_func
-from sqlalchemy import and_, asc, desc, orm, or_, not_
+from sqlalchemy import and_, asc, desc, orm, or_, not_, select
 from sqlalchemy.orm import class_mapper
 
 from quark.db import models
+from quark import interval_set
 from quark import network_strategy
 from quark import protocols
 from quark import tags
@@ -38,10 +43,29 @@ STRATEGY = network_strategy.STRATEGY
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
 
+quark_opts = [
+    cfg.IntOpt("list_stream_chunk_size",
+               default=0,
+               help=_("Unpaginated port, subnet and security group listings"
+                      " fetch this many rows at a time and build the"
+                      " response as they go, so a full listing never holds"
+                      " more than one chunk of models. 0 loads the whole"
+                      " listing at once.")),
+    cfg.IntOpt("ipam_free_ranges_reservation_timeout",
+               default=60,
+               help=_("Seconds an address taken out of the free address"
+                      " index waits for its row before it's considered"
+                      " abandoned and freed again."))
+]
+
+CONF.register_opts(quark_opts, "QUARK")
+
 
 ONE = "one"
 ALL = "all"
 
+_claim_tokens = random.SystemRandom()
+
 
 # NOTE(jkoelker) init event listener that will ensure id is filled in
 #                on object creation (prior to commit).
@@ -59,17 +83,228 @@ for _name, klass in inspect.getmembers(models, inspect.isclass):
         event.listen(klass, "init", _perhaps_generate_id)
 
 
+def _is_reserved(address):
+    return bool(address._deallocated)
+
+
+def _subnet_counts_update(connection, subnet_id, allocated=0, reserved=0,
+                          addresses=()):
+    """Adds allocated and reserved to a subnet's counts.
+
+    With addresses, allocated and reserved are per address and go to the
+    cursor stripes holding them instead, so that allocating from a striped
+    subnet doesn't update, and serialize on, the subnet row. Only addresses
+    outside of every stripe count against the subnet row itself.
+    """
+    if not subnet_id or not (allocated or reserved):
+        return
+    if addresses:
+        cursors = models.SubnetCursor.__table__
+        stripes = connection.execute(select(
+            [cursors.c.stripe, cursors.c.first_ip, cursors.c.last_ip]).where(
+                cursors.c.subnet_id == subnet_id)).fetchall()
+        counts = collections.Counter()
+        unstriped = 0
+        for address in addresses:
+            for stripe, first_ip, last_ip in stripes:
+                if first_ip <= address <= last_ip:
+                    counts[stripe] += 1
+                    break
+            else:
+                unstriped += 1
+        for stripe, count in counts.items():
+            connection.execute(cursors.update().where(and_(
+                cursors.c.subnet_id == subnet_id,
+                cursors.c.stripe == stripe)).values(
+                    allocated_count=cursors.c.allocated_count +
+                    allocated * count,
+                    reserved_count=cursors.c.reserved_count +
+                    reserved * count))
+        allocated *= unstriped
+        reserved *= unstriped
+        if not unstriped:
+            return
+    subnets = models.Subnet.__table__
+    connection.execute(subnets.update().where(
+        subnets.c.id == subnet_id).values(
+            allocated_count=subnets.c.allocated_count + allocated,
+            reserved_count=subnets.c.reserved_count + reserved))
+
+
+def _striped_address(address):
+    # NOTE: only v4 subnets are striped.
+    if address.version != 4:
+        return ()
+    return (long(address.address),)
+
+
+def _ip_address_after_insert(mapper, connection, target):
+    addresses = _striped_address(target)
+    if _is_reserved(target):
+        _subnet_counts_update(connection, target.subnet_id, reserved=1,
+                              addresses=addresses)
+    else:
+        _subnet_counts_update(connection, target.subnet_id, allocated=1,
+                              addresses=addresses)
+
+
+def _ip_address_after_update(mapper, connection, target):
+    history = orm.attributes.get_history(target, "_deallocated")
+    if not history.added or not history.deleted:
+        return
+    was_reserved = bool(history.deleted[0])
+    if was_reserved == bool(history.added[0]):
+        return
+    delta = 1 if was_reserved else -1
+    _subnet_counts_update(connection, target.subnet_id, allocated=delta,
+                          reserved=-delta,
+                          addresses=_striped_address(target))
+
+
+def _ip_address_after_delete(mapper, connection, target):
+    addresses = _striped_address(target)
+    if _is_reserved(target):
+        _subnet_counts_update(connection, target.subnet_id, reserved=-1,
+                              addresses=addresses)
+    else:
+        _subnet_counts_update(connection, target.subnet_id, allocated=-1,
+                              addresses=addresses)
+
+
+# NOTE: keep quark_subnets.allocated_count and reserved_count in step with
+#       every ORM insert, delete and (de)allocation of an IPAddress. The
+#       set-based statements that bypass the ORM adjust the counts
+#       themselves, see ip_address_create_bulk, ip_address_deallocate_bulk
+#       and _ip_address_claim.
+event.listen(models.IPAddress, "after_insert", _ip_address_after_insert)
+event.listen(models.IPAddress, "after_update", _ip_address_after_update)
+event.listen(models.IPAddress, "after_delete", _ip_address_after_delete)
+
+
+def _mac_range_count_update(connection, mac_address_range_id, delta):
+    if not mac_address_range_id or not delta:
+        return
+    ranges = models.MacAddressRange.__table__
+    connection.execute(ranges.update().where(
+        ranges.c.id == mac_address_range_id).values(
+            allocated_count=ranges.c.allocated_count + delta))
+
+
+def _mac_address_after_insert(mapper, connection, target):
+    _mac_range_count_update(connection, target.mac_address_range_id, 1)
+
+
+def _mac_address_after_delete(mapper, connection, target):
+    _mac_range_count_update(connection, target.mac_address_range_id, -1)
+
+
+# NOTE: likewise for quark_mac_address_ranges.allocated_count. Deallocating
+#       a MAC keeps its row, so only inserts and deletes change the count.
+event.listen(models.MacAddress, "after_insert", _mac_address_after_insert)
+event.listen(models.MacAddress, "after_delete", _mac_address_after_delete)
+
+
+def _ip_reuse_dequeue(connection, ip_address_id):
+    queue = models.IPAddressReuseQueue.__table__
+    connection.execute(queue.delete().where(
+        queue.c.ip_address_id == ip_address_id))
+
+
+def _ip_reuse_enqueue(connection, address):
+    _ip_reuse_dequeue(connection, address.id)
+    queue = models.IPAddressReuseQueue.__table__
+    connection.execute(queue.insert().values(
+        ip_address_id=address.id, network_id=address.network_id,
+        subnet_id=address.subnet_id, version=address.version,
+        deallocated_at=address.deallocated_at,
+        created_at=timeutils.utcnow()))
+
+
+def _mac_reuse_dequeue(connection, address):
+    queue = models.MacAddressReuseQueue.__table__
+    connection.execute(queue.delete().where(queue.c.address == address))
+
+
+def _mac_reuse_enqueue(connection, mac):
+    _mac_reuse_dequeue(connection, mac.address)
+    queue = models.MacAddressReuseQueue.__table__
+    connection.execute(queue.insert().values(
+        address=mac.address, deallocated_at=mac.deallocated_at,
+        created_at=timeutils.utcnow()))
+
+
+def _reuse_changed(target, *attrs):
+    for attr in attrs:
+        if orm.attributes.get_history(target, attr).has_changes():
+            return True
+    return False
+
+
+def _ip_address_reuse_after_insert(mapper, connection, target):
+    if _is_reserved(target):
+        _ip_reuse_enqueue(connection, target)
+
+
+def _ip_address_reuse_after_update(mapper, connection, target):
+    if not _reuse_changed(target, "_deallocated", "deallocated_at"):
+        return
+    if _is_reserved(target):
+        _ip_reuse_enqueue(connection, target)
+    else:
+        _ip_reuse_dequeue(connection, target.id)
+
+
+def _ip_address_reuse_after_delete(mapper, connection, target):
+    _ip_reuse_dequeue(connection, target.id)
+
+
+def _mac_address_reuse_after_insert(mapper, connection, target):
+    if target.deallocated:
+        _mac_reuse_enqueue(connection, target)
+
+
+def _mac_address_reuse_after_update(mapper, connection, target):
+    if not _reuse_changed(target, "deallocated", "deallocated_at"):
+        return
+    if target.deallocated:
+        _mac_reuse_enqueue(connection, target)
+    else:
+        _mac_reuse_dequeue(connection, target.address)
+
+
+def _mac_address_reuse_after_delete(mapper, connection, target):
+    _mac_reuse_dequeue(connection, target.address)
+
+
+# NOTE: the reuse queues hold every deallocated IP and MAC, whether or not
+#       ipam_use_reuse_queue is set, so the option can be turned on at any
+#       time. Reallocations by set-based UPDATE are dequeued by the
+#       *_reallocate_find functions.
+event.listen(models.IPAddress, "after_insert", _ip_address_reuse_after_insert)
+event.listen(models.IPAddress, "after_update", _ip_address_reuse_after_update)
+event.listen(models.IPAddress, "after_delete", _ip_address_reuse_after_delete)
+event.listen(models.MacAddress, "after_insert",
+             _mac_address_reuse_after_insert)
+event.listen(models.MacAddress, "after_update",
+             _mac_address_reuse_after_update)
+event.listen(models.MacAddress, "after_delete",
+             _mac_address_reuse_after_delete)
+
+
+_LISTIFY_KEYS = frozenset([
+    "name", "network_id", "id", "device_id", "tenant_id", "subnet_id",
+    "mac_address", "shared", "version", "segment_id", "device_owner",
+    "ip_address", "used_by_tenant_id", "group_id"])
+
+
 def _listify(filters):
-    for key in ["name", "network_id", "id", "device_id", "tenant_id",
-                "subnet_id", "mac_address", "shared", "version", "segment_id",
-                "device_owner", "ip_address", "used_by_tenant_id", "group_id"]:
-        if key in filters:
-            if not filters[key]:
-                continue
-            listified = filters[key]
-            if not isinstance(listified, list):
-                listified = [listified]
-            filters[key] = listified
+    for key in _LISTIFY_KEYS.intersection(filters):
+        if not filters[key]:
+            continue
+        listified = filters[key]
+        if not isinstance(listified, list):
+            listified = [listified]
+        filters[key] = listified
 
 
 def _model_attrs(model):
@@ -82,81 +317,112 @@ def _model_attrs(model):
     return model_attrs
 
 
-def _model_query(context, model, filters, fields=None):
-    filters = filters or {}
-    model_filters = []
-    eq_filters = ["address", "cidr", "deallocated", "ip_version", "service",
-                  "mac_address_range_id", "transaction_id", "lock_id"]
-    in_filters = ["device_id", "device_owner", "group_id", "id", "mac_address",
-                  "name", "network_id", "segment_id", "subnet_id",
-                  "used_by_tenant_id", "version"]
-
-    # Sanitize incoming filters to only attributes that exist in the model.
-    # NOTE: Filters for unusable attributes are silently dropped here.
-    # NOTE: When the filter key != attribute key, a conditional must be added
-    #       here.
-    model_attrs = _model_attrs(model)
-    filters = {x: y for x, y in filters.items()
-               if x in model_attrs or
-               (x == "tenant_id" and model == models.IPAddress) or
-               (x == "ip_address" and model == models.IPAddress) or
-               (x == "reuse_after" and model in (models.IPAddress,
-                                                 models.MacAddress))}
-
-    # Inject the tenant id if none is set. We don't need unqualified queries.
-    # This works even when a non-shared, other-tenant owned network is passed
-    # in because the authZ checks that happen in Neutron above us yank it back
-    # out of the result set.
-    if not filters.get("tenant_id") and not context.is_admin:
-        filters["tenant_id"] = [context.tenant_id]
-
-    if model == models.SecurityGroupRule:
-        sg_rule_attribs = ["direction", "port_range_max", "port_range_min"]
-        eq_filters.extend(sg_rule_attribs)
-
-    for key, value in filters.items():
-        if key in in_filters:
-            model_type = getattr(model, key)
-            model_filters.append(model_type.in_(value))
+_EQ_FILTERS = ["address", "cidr", "deallocated", "ip_version", "service",
+               "mac_address_range_id", "transaction_id", "lock_id"]
+_IN_FILTERS = ["device_id", "device_owner", "group_id", "id", "mac_address",
+               "name", "network_id", "segment_id", "subnet_id",
+               "used_by_tenant_id", "version"]
+_SG_RULE_EQ_FILTERS = ["direction", "port_range_max", "port_range_min"]
+
+
+class _FilterPlan(object):
+    """How _model_query turns each filter key into a clause for a model.
+
+    Mapper introspection and working out which branch a key takes happen
+    once per model, leaving each query with a dict lookup and a call per
+    filter.
+    """
+
+    def __init__(self, model):
+        # NOTE: When the filter key != attribute key, a conditional must be
+        #       added here.
+        allowed = set(_model_attrs(model))
+        if model == models.IPAddress:
+            allowed.update(["tenant_id", "ip_address"])
+        if model in (models.IPAddress, models.MacAddress):
+            allowed.add("reuse_after")
+        self.allowed = frozenset(allowed)
+
+        eq_filters = list(_EQ_FILTERS)
+        if model == models.SecurityGroupRule:
+            eq_filters.extend(_SG_RULE_EQ_FILTERS)
+
+        self.builders = {}
+        # NOTE: tenant_id is injected after sanitizing, so it always needs
+        #       a builder.
+        for key in self.allowed | set(["tenant_id"]):
+            builder = self._builder(model, key, eq_filters)
+            if builder:
+                self.builders[key] = builder
+
+    def _builder(self, model, key, eq_filters):
+        if key in _IN_FILTERS:
+            column = getattr(model, key)
+            return lambda value: column.in_(value)
         elif key in eq_filters:
-            model_type = getattr(model, key)
-            model_filters.append(model_type == value)
+            column = getattr(model, key)
+            return lambda value: column == value
         elif key == "_deallocated":
-            if value:
-                model_filters.append(model._deallocated == 1)
-            else:
-                model_filters.append(model._deallocated != 1)
+            return lambda value: (model._deallocated == 1 if value
+                                  else model._deallocated != 1)
         elif key == "ethertype":
-            etypes = []
-            for etype in value:
-                etypes.append(protocols.translate_ethertype(etype))
-            model_filters.append(model.ethertype.in_(etypes))
+            return lambda value: model.ethertype.in_(
+                [protocols.translate_ethertype(etype) for etype in value])
         elif key == "ip_address":
-            model_filters.append(model.address.in_(
-                [ip.ipv6().value for ip in value]))
-        elif key == 'protocol':
-            pnums = []
-            for version in (protocols.PROTOCOLS_V4, protocols.PROTOCOLS_V6):
-                pnums.extend([y for x, y in version.items() if x in value])
-            model_filters.append(model.protocol.in_(pnums))
+            return lambda value: model.address.in_(
+                [ip.ipv6().value for ip in value])
+        elif key == "protocol":
+            def protocol(value):
+                pnums = []
+                for version in (protocols.PROTOCOLS_V4,
+                                protocols.PROTOCOLS_V6):
+                    pnums.extend([y for x, y in version.items()
+                                  if x in value])
+                return model.protocol.in_(pnums)
+            return protocol
         elif key == "reuse_after":
-            reuse = (timeutils.utcnow() -
-                     datetime.timedelta(seconds=value))
             # NOTE(asadoughi): should this allow for deallocated_at = null?
-            model_filters.append(model.deallocated_at <= reuse)
+            return lambda value: model.deallocated_at <= (
+                timeutils.utcnow() - datetime.timedelta(seconds=value))
         elif key == "port_id":
             if model == models.PortIpAssociation:
-                model_filters.append(model.port_id == value)
+                return lambda value: model.port_id == value
         elif key == "tenant_id":
             if model == models.IPAddress:
-                model_filters.append(model.used_by_tenant_id.in_(value))
+                return lambda value: model.used_by_tenant_id.in_(value)
             elif (model == models.PortIpAssociation or
                   model == models.LockHolder):
-                pass
-            else:
-                model_filters.append(model.tenant_id.in_(value))
+                return
+            return lambda value: model.tenant_id.in_(value)
+
+
+_FILTER_PLANS = {}
+
+
+def _filter_plan(model):
+    plan = _FILTER_PLANS.get(model)
+    if plan is None:
+        plan = _FILTER_PLANS[model] = _FilterPlan(model)
+    return plan
+
+
+def _model_query(context, model, filters, fields=None):
+    filters = filters or {}
+    plan = _filter_plan(model)
+
+    # Sanitize incoming filters to only attributes that exist in the model.
+    # NOTE: Filters for unusable attributes are silently dropped here.
+    filters = {x: y for x, y in filters.items() if x in plan.allowed}
+
+    # Inject the tenant id if none is set. We don't need unqualified queries.
+    # This works even when a non-shared, other-tenant owned network is passed
+    # in because the authZ checks that happen in Neutron above us yank it back
+    # out of the result set.
+    if not filters.get("tenant_id") and not context.is_admin:
+        filters["tenant_id"] = [context.tenant_id]
 
-    return model_filters
+    return [plan.builders[key](value) for key, value in filters.items()
+            if key in plan.builders]
 
 
 def scoped(f):
@@ -186,6 +452,104 @@ def scoped(f):
     return wrapped
 
 
+# NOTE: pass as the page_token filter of port_find, network_find or
+#       subnet_find to get the first page of a keyset paginated listing.
+FIRST_PAGE = ""
+
+
+def page_token_create(resource_id):
+    """Opaque token for the keyset paginated page after the given id."""
+    return base64.urlsafe_b64encode(json.dumps({"id": resource_id}))
+
+
+def page_token_check(sorts=None, marker=None, page_reverse=False):
+    """Rejects listing options a page_token can't be combined with.
+
+    Keyset pages are ordered by ascending id, so the only sort that can be
+    honoured is that one, and the token takes the place of the marker.
+    """
+    if marker or page_reverse or any(
+            key != "id" or direction not in (True, "asc")
+            for key, direction in sorts or []):
+        raise exceptions.InvalidInput(
+            error_message="page_token can only be combined with an "
+                          "ascending sort on id")
+
+
+class Page(list):
+    """A keyset paginated page of a listing.
+
+    next_page_token is the page_token of the page after this one, None once
+    the listing has run out.
+    """
+
+    def __init__(self, items, next_page_token=None):
+        super(Page, self).__init__(items)
+        self.next_page_token = next_page_token
+
+
+def page_create(items, rows, limit):
+    """The Page of items made from the rows of a keyset paginated find."""
+    next_page_token = None
+    if limit and len(rows) >= limit:
+        next_page_token = page_token_create(rows[-1]["id"])
+    return Page(items, next_page_token)
+
+
+def _page_token_marker(page_token):
+    try:
+        return json.loads(base64.urlsafe_b64decode(str(page_token)))["id"]
+    except (TypeError, ValueError, KeyError):
+        raise exceptions.InvalidInput(
+            error_message="Invalid page token %s" % page_token)
+
+
+def _keyset_paginate(query, model, limit, page_token):
+    """Seek pagination on the primary key.
+
+    Each page starts right after the id in the token, an index seek however
+    deep the page is, where paginate_query filters on the sort keys of a
+    marker object that has to be loaded first.
+    """
+    if page_token:
+        query = query.filter(model.id > _page_token_marker(page_token))
+    query = query.order_by(asc(model.id))
+    if limit:
+        query = query.limit(limit)
+    return query
+
+
+def use_stream(limit=None, sorts=None, marker=None, page_token=None):
+    """Whether a listing should be streamed rather than loaded at once."""
+    return (CONF.QUARK.list_stream_chunk_size > 0 and not limit and
+            not sorts and not marker and page_token is None)
+
+
+def stream(find, context, **filters):
+    """Yields everything a finder matches, list_stream_chunk_size rows at
+    a time.
+
+    find is port_find, network_find, subnet_find or security_group_find.
+    Each chunk is a keyset paginated query of its own, and is expunged from
+    the session once its rows have been consumed, so memory is bounded by
+    the chunk rather than the listing.
+    """
+    chunk_size = CONF.QUARK.list_stream_chunk_size
+    filters["page_token"] = FIRST_PAGE
+    while True:
+        chunk = find(context, limit=chunk_size, scope=ALL, **filters)
+        if not chunk:
+            return
+        for row in chunk:
+            yield row
+        for row in chunk:
+            if row in context.session:
+                context.session.expunge(row)
+        if len(chunk) < chunk_size:
+            return
+        filters["page_token"] = page_token_create(chunk[-1]["id"])
+
+
 @scoped
 def port_find(context, limit=None, sorts=None, marker_obj=None, fields=None,
               **filters):
@@ -212,8 +576,11 @@ def port_find(context, limit=None, sorts=None, marker_obj=None, fields=None,
             orm.joinedload("ip_addresses.subnet.dns_nameservers"))
         query = query.options(
             orm.joinedload("ip_addresses.subnet.routes"))
-    return paginate_query(query.filter(*model_filters), models.Port, limit,
-                          sorts, marker_obj)
+    query = query.filter(*model_filters)
+    if "page_token" in filters:
+        return _keyset_paginate(query, models.Port, limit,
+                                filters["page_token"])
+    return paginate_query(query, models.Port, limit, sorts, marker_obj)
 
 
 @scoped
@@ -317,6 +684,45 @@ def ip_address_create(context, **address_dict):
     return ip_address
 
 
+def ip_address_create_bulk(context, addresses):
+    """Inserts many new addresses with a single multi-row INSERT.
+
+    Takes a list of dicts shaped like the keyword arguments to
+    ip_address_create and returns the new IPAddress models in the same
+    order.
+    """
+    if not addresses:
+        return []
+
+    now = timeutils.utcnow()
+    rows = []
+    for address_dict in addresses:
+        row = dict(address_dict)
+        address = row.pop("address")
+        row.update(id=uuidutils.generate_uuid(),
+                   address=int(address.ipv6()),
+                   address_readable=str(address),
+                   used_by_tenant_id=context.tenant_id,
+                   _deallocated=False,
+                   allocated_at=now,
+                   created_at=now)
+        rows.append(row)
+    context.session.execute(models.IPAddress.__table__.insert().values(rows))
+    connection = context.session.connection()
+    by_subnet = collections.defaultdict(list)
+    for row in rows:
+        by_subnet[row["subnet_id"]].append(row["address"])
+    for subnet_id, subnet_addresses in by_subnet.items():
+        _subnet_counts_update(connection, subnet_id, allocated=1,
+                              addresses=subnet_addresses)
+
+    ids = [new_row["id"] for new_row in rows]
+    query = context.session.query(models.IPAddress)
+    query = query.filter(models.IPAddress.id.in_(ids))
+    created = dict((address["id"], address) for address in query)
+    return [created[address_id] for address_id in ids]
+
+
 def ip_address_delete(context, addr):
     context.session.delete(addr)
 
@@ -327,6 +733,78 @@ def ip_address_deallocate(context, address, **kwargs):
     return ip_address_update(context, address, **kwargs)
 
 
+def ip_address_deallocate_bulk(context, addresses):
+    """Deallocates v4 and deletes v6 addresses no longer used by any port.
+
+    Does in a fixed number of statements what deallocating or deleting
+    each address through the ORM does one row at a time, so it keeps the
+    subnet counts and the reuse queue in step itself. Addresses still
+    associated with a port are left alone. Returns the addresses that were
+    deallocated or deleted.
+    """
+    if not addresses:
+        return []
+
+    ids = [address["id"] for address in addresses]
+    assocs = models.PortIpAssociation
+    query = context.session.query(assocs.ip_address_id).distinct()
+    shared = set(row[0] for row in
+                 query.filter(assocs.ip_address_id.in_(ids)))
+    unused = [address for address in addresses if address["id"] not in shared]
+    if not unused:
+        return []
+    v4 = [address for address in unused if address["version"] != 6]
+    v6 = [address for address in unused if address["version"] == 6]
+
+    connection = context.session.connection()
+    now = timeutils.utcnow()
+    counts = collections.defaultdict(collections.Counter)
+    for address in v4:
+        if not address["_deallocated"]:
+            counts[address["subnet_id"]].update(allocated=-1, reserved=1)
+    for address in v6:
+        kind = "reserved" if address["_deallocated"] else "allocated"
+        counts[address["subnet_id"]][kind] -= 1
+
+    queue = models.IPAddressReuseQueue.__table__
+    connection.execute(queue.delete().where(
+        queue.c.ip_address_id.in_([address["id"] for address in unused])))
+
+    if v4:
+        values = dict(_deallocated=True, deallocated_at=now,
+                      allocated_at=None, address_type=None)
+        query = context.session.query(models.IPAddress)
+        query = query.filter(models.IPAddress.id.in_(
+            [address["id"] for address in v4]))
+        query.update(values, synchronize_session=False)
+        # NOTE: bring the in-session models up to date without marking
+        #       them dirty, or the next flush would update them again.
+        for address in v4:
+            for key, value in values.items():
+                orm.attributes.set_committed_value(address, key, value)
+        connection.execute(queue.insert().values([
+            dict(ip_address_id=address["id"],
+                 network_id=address["network_id"],
+                 subnet_id=address["subnet_id"], version=address["version"],
+                 deallocated_at=now, created_at=now) for address in v4]))
+
+    if v6:
+        v6_ids = [address["id"] for address in v6]
+        flips = models.flip_to_fixed_ip_assoc_tbl
+        connection.execute(flips.delete().where(or_(
+            flips.c.floating_ip_address_id.in_(v6_ids),
+            flips.c.fixed_ip_address_id.in_(v6_ids))))
+        query = context.session.query(models.IPAddress)
+        query = query.filter(models.IPAddress.id.in_(v6_ids))
+        query.delete(synchronize_session="fetch")
+
+    for subnet_id, delta in counts.items():
+        _subnet_counts_update(connection, subnet_id,
+                              allocated=delta["allocated"],
+                              reserved=delta["reserved"])
+    return unused
+
+
 @scoped
 def ip_address_find(context, lock_mode=False, **filters):
     query = context.session.query(models.IPAddress)
@@ -365,19 +843,123 @@ def ip_address_count_all(context, filters):
     return query.filter(*model_filters).scalar()
 
 
+def _ip_address_reallocatable(check_policy=True):
+    """SQL for an IPAddress that's safe to hand out again.
+
+    The address has to lie within the CIDR of its subnet, the subnet can't
+    be marked do_not_use and, unless check_policy is False, the address
+    can't be excluded by the subnet's IP policy. Correlates against
+    quark_ip_addresses.
+    """
+    subnet = models.Subnet
+    address = models.IPAddress.address
+    conditions = [subnet.id == models.IPAddress.subnet_id,
+                  not_(subnet.do_not_use),
+                  subnet.first_ip <= address,
+                  subnet.last_ip >= address]
+    if check_policy:
+        ippc = models.IPPolicyCIDR
+        conditions.append(~select([ippc.id]).where(and_(
+            ippc.ip_policy_id == subnet.ip_policy_id,
+            ippc.first_ip <= address,
+            ippc.last_ip >= address)).exists())
+    return select([subnet.id]).where(and_(*conditions)).exists()
+
+
+def _ip_address_claim(context, query, update_kwargs, deallocated=True,
+                      **update_args):
+    """Runs a reallocating UPDATE of at most one row.
+
+    Deallocated rows are claimed first, moving their subnet's count from
+    reserved to allocated in the same transaction, which is started here
+    unless the caller already has one. Unless deallocated is True, an
+    allocated row is claimed once no deallocated one matches, which leaves
+    the counts alone. update_kwargs must set the claim token in
+    transaction_id.
+    """
+    token = [value for key, value in update_kwargs.items()
+             if getattr(key, "key", key) == "transaction_id"][0]
+    reserved = query.filter(models.IPAddress._deallocated == 1)
+    with context.session.begin(subtransactions=True):
+        if reserved.update(update_kwargs, synchronize_session=False,
+                           **update_args):
+            ips = models.IPAddress.__table__
+            subnets = models.Subnet.__table__
+            context.session.execute(subnets.update().where(
+                subnets.c.id.in_(select([ips.c.subnet_id]).where(
+                    ips.c.transaction_id == token))).values(
+                        allocated_count=subnets.c.allocated_count + 1,
+                        reserved_count=subnets.c.reserved_count - 1))
+            return 1
+    if deallocated:
+        return 0
+    return query.update(update_kwargs, synchronize_session=False,
+                        **update_args)
+
+
 @scoped
 def ip_address_reallocate(context, update_kwargs, **filters):
+    """Claims one matching address by way of a single UPDATE.
+
+    Addresses outside of their subnet's CIDR, in do_not_use subnets or
+    excluded by policy are never matched. Explicitly requested addresses
+    skip the policy check, the same as when they're created.
+    """
     LOG.debug("ip_address_reallocate %s", filters)
     query = context.session.query(models.IPAddress)
     model_filters = _model_query(context, models.IPAddress, filters)
     query = query.filter(*model_filters)
-    row_count = query.update(update_kwargs,
-                             update_args={"mysql_limit": 1},
-                             synchronize_session=False)
+    query = query.filter(_ip_address_reallocatable(
+        check_policy="ip_address" not in filters))
+    row_count = _ip_address_claim(context, query, update_kwargs,
+                                  deallocated="deallocated" in filters,
+                                  update_args={"mysql_limit": 1})
     return row_count == 1
 
 
+@scoped
+def ip_address_reallocate_from_queue(context, update_kwargs, **filters):
+    """Reallocates the longest deallocated address in the reuse queue.
+
+    Takes the same filters as ip_address_reallocate, but finds the address
+    with a seek on the queue rather than a scan of the deallocated rows.
+    Entries whose address doesn't match the filters are skipped and stay
+    queued, so they're found again once it does. Must be called in a
+    transaction.
+    """
+    LOG.debug("ip_address_reallocate_from_queue %s", filters)
+    queue = models.IPAddressReuseQueue
+    query = context.session.query(queue.ip_address_id)
+    query = query.join(models.IPAddress,
+                       models.IPAddress.id == queue.ip_address_id)
+    query = query.with_lockmode("update")
+    query = query.filter(queue.network_id.in_(filters["network_id"]))
+    if filters.get("version"):
+        query = query.filter(queue.version.in_(filters["version"]))
+    if filters.get("subnet_id"):
+        query = query.filter(queue.subnet_id.in_(filters["subnet_id"]))
+    if filters.get("reuse_after") is not None:
+        reuse = (timeutils.utcnow() -
+                 datetime.timedelta(seconds=filters["reuse_after"]))
+        query = query.filter(queue.deallocated_at <= reuse)
+
+    model_filters = _model_query(context, models.IPAddress, filters)
+    model_filters.append(_ip_address_reallocatable())
+    query = query.filter(*model_filters)
+    head = query.order_by(asc(queue.deallocated_at)).first()
+    if not head:
+        return False
+    address = context.session.query(models.IPAddress)
+    address = address.filter(models.IPAddress.id == head.ip_address_id)
+    address = address.filter(*model_filters)
+    if not _ip_address_claim(context, address, update_kwargs):
+        return False
+    _ip_reuse_dequeue(context.session.connection(), head.ip_address_id)
+    return True
+
+
 def ip_address_reallocate_find(context, transaction_id):
+    """Finds the address claimed by ip_address_reallocate."""
     address = ip_address_find(context, transaction_id=transaction_id,
                               scope=ONE)
     if not address:
@@ -385,42 +967,11 @@ def ip_address_reallocate_find(context, transaction_id):
                  transaction_id)
         return
 
-    LOG.info("Potentially reallocatable IP found: "
-             "{0}".format(address["address_readable"]))
-    subnet = address.get('subnet')
-    if not subnet:
-        LOG.debug("No subnet associated with address")
-        return
-    if subnet["do_not_use"]:
-        LOG.debug("Subnet marked as do_not_use")
-        return
-
-    addr = netaddr.IPAddress(int(address["address"]))
-    if address["subnet"]["ip_version"] == 4:
-        addr = addr.ipv4()
-    else:
-        addr = addr.ipv6()
-
-    # TODO(amir): performance test replacing this with SQL in
-    #             ip_address_reallocate's UPDATE statement
-    policy = models.IPPolicy.get_ip_policy_cidrs(subnet)
-    if policy is not None and addr in policy:
-        LOG.info("Deleting Address {0} due to policy "
-                 "violation".format(
-                     address["address_readable"]))
-        context.session.delete(address)
-        return
-
-    # TODO(amir): performance test replacing this with SQL in
-    #             ip_address_reallocate's UPDATE statement
-    cidr = netaddr.IPNetwork(address["subnet"]["cidr"])
-    if addr not in cidr:
-        LOG.info("Address {0} isn't in the subnet "
-                 "it claims to be in".format(
-                     address["address_readable"]))
-        context.session.delete(address)
-        return
+    _ip_reuse_dequeue(context.session.connection(), address["id"])
 
+    # NOTE: the subnet, CIDR and policy checks that used to follow are part
+    #       of the reallocating UPDATE, see _ip_address_reallocatable.
+    LOG.info("Reallocated IP found: {0}".format(address["address_readable"]))
     return address
 
 
@@ -448,6 +999,37 @@ def mac_address_reallocate(context, update_kwargs, **filters):
     return row_count == 1
 
 
+@scoped
+def mac_address_reallocate_from_queue(context, update_kwargs, **filters):
+    """Reallocates the longest deallocated MAC in the reuse queue.
+
+    The MAC counterpart of ip_address_reallocate_from_queue.
+    """
+    LOG.debug("mac_address_reallocate_from_queue %s", filters)
+    queue = models.MacAddressReuseQueue
+    query = context.session.query(queue.address)
+    query = query.join(models.MacAddress,
+                       models.MacAddress.address == queue.address)
+    query = query.with_lockmode("update")
+    if filters.get("reuse_after") is not None:
+        reuse = (timeutils.utcnow() -
+                 datetime.timedelta(seconds=filters["reuse_after"]))
+        query = query.filter(queue.deallocated_at <= reuse)
+
+    model_filters = _model_query(context, models.MacAddress, filters)
+    query = query.filter(*model_filters)
+    head = query.order_by(asc(queue.deallocated_at)).first()
+    if not head:
+        return False
+    mac = context.session.query(models.MacAddress)
+    mac = mac.filter(models.MacAddress.address == head.address)
+    mac = mac.filter(*model_filters)
+    if not mac.update(update_kwargs, synchronize_session=False):
+        return False
+    _mac_reuse_dequeue(context.session.connection(), head.address)
+    return True
+
+
 def mac_address_reallocate_find(context, transaction_id):
     mac = mac_address_find(context, transaction_id=transaction_id,
                            scope=ONE)
@@ -455,6 +1037,7 @@ def mac_address_reallocate_find(context, transaction_id):
         LOG.warn("Couldn't find MAC address with transaction_id %s",
                  transaction_id)
         return
+    _mac_reuse_dequeue(context.session.connection(), mac["address"])
 
     # NOTE(mdietz): This is a HACK. Please see RM11043 for details
     if mac["mac_address_range"] and mac["mac_address_range"]["do_not_use"]:
@@ -469,11 +1052,9 @@ def mac_address_reallocate_find(context, transaction_id):
 
 def mac_address_range_find_allocation_counts(context, address=None,
                                              use_forbidden_mac_range=False):
-    count = sql_func.count(models.MacAddress.address)
+    count = models.MacAddressRange.allocated_count
     query = context.session.query(models.MacAddressRange,
                                   count.label("count")).with_lockmode("update")
-    query = query.outerjoin(models.MacAddress)
-    query = query.group_by(models.MacAddressRange.id)
     query = query.order_by(desc(count))
     if address:
         query = query.filter(models.MacAddressRange.last_address >= address)
@@ -509,7 +1090,7 @@ def mac_address_range_update(context, mac_range, **kwargs):
     return mac_range
 
 
-def mac_range_update_next_auto_assign_mac(context, mac_range):
+def mac_range_update_next_auto_assign_mac(context, mac_range, increment=1):
     query = context.session.query(models.MacAddressRange)
     query = query.filter(models.MacAddressRange.id == mac_range["id"])
     query = query.filter(models.MacAddressRange.next_auto_assign_mac != -1)
@@ -518,7 +1099,7 @@ def mac_range_update_next_auto_assign_mac(context, mac_range):
     # http://docs.sqlalchemy.org/en/rel_0_8/orm/query.html
     query = query.update(
         {"next_auto_assign_mac":
-         models.MacAddressRange.next_auto_assign_mac + 1},
+         models.MacAddressRange.next_auto_assign_mac + increment},
         synchronize_session=False)
 
     # Returns a count of the rows matched in the update
@@ -540,6 +1121,110 @@ def mac_range_update_set_full(context, mac_range):
     return query
 
 
+def mac_address_range_lease_block(context, size, ttl,
+                                  use_forbidden_mac_range=False):
+    """Takes up to size never assigned MACs off the front of a range.
+
+    The block is recorded as a MacAddressLease expiring in ttl seconds,
+    after expired leases have been reclaimed. Returns (range, lease), or
+    None if no range has any left.
+    """
+    _mac_address_leases_reclaim(context)
+    query = context.session.query(models.MacAddressRange)
+    query = query.with_lockmode("update").populate_existing()
+    query = query.filter(models.MacAddressRange.next_auto_assign_mac != -1)
+    if not use_forbidden_mac_range:
+        query = query.filter(models.MacAddressRange.do_not_use == '0')  # noqa
+    query = query.order_by(desc(models.MacAddressRange.allocated_count))
+
+    while True:
+        rng = query.first()
+        if not rng:
+            return
+        first = rng["next_auto_assign_mac"]
+        if first > rng["last_address"]:
+            mac_range_update_set_full(context, rng)
+            continue
+
+        last = min(first + size - 1, rng["last_address"])
+        if last == rng["last_address"]:
+            mac_range_update_set_full(context, rng)
+        else:
+            mac_range_update_next_auto_assign_mac(context, rng,
+                                                  increment=last - first + 1)
+        lease = models.MacAddressLease(
+            id=uuidutils.generate_uuid(), mac_address_range_id=rng["id"],
+            first_address=first, last_address=last,
+            expires_at=timeutils.utcnow() + datetime.timedelta(seconds=ttl))
+        context.session.add(lease)
+        return rng, lease
+
+
+def _mac_address_leases_reclaim(context):
+    """Hands back the unassigned MACs of leases whose worker went away."""
+    query = context.session.query(models.MacAddressLease)
+    query = query.with_lockmode("update")
+    query = query.filter(models.MacAddressLease.expires_at <=
+                         timeutils.utcnow())
+    for lease in query.all():
+        LOG.info("Reclaiming expired MAC address lease %s-%s" % (
+            lease["first_address"], lease["last_address"]))
+        unused = interval_set.IntervalSet.from_range(lease["first_address"],
+                                                     lease["last_address"])
+        macs = context.session.query(models.MacAddress.address)
+        macs = macs.filter(models.MacAddress.address.in_(
+            xrange(lease["first_address"], lease["last_address"] + 1)))
+        for (address,) in macs:
+            unused.remove(long(address))
+        # NOTE: from the top down, so the block at the end of the lease
+        #       can still rewind the range's cursor.
+        for first, last in reversed(unused.intervals()):
+            mac_address_range_return_block(
+                context, lease["mac_address_range_id"], first, last)
+        context.session.delete(lease)
+
+
+def mac_address_lease_delete(context, lease_id):
+    """Ends a lease. Returns False if it was reclaimed in the meantime."""
+    query = context.session.query(models.MacAddressLease)
+    return bool(query.filter_by(id=lease_id).delete())
+
+
+def mac_address_range_return_block(context, mac_address_range_id, first,
+                                   last):
+    """Hands leased but unassigned MACs back to their range.
+
+    Rewinds the range's cursor if nothing was taken from it since the
+    lease, otherwise records the addresses as deallocated MACs so they're
+    reallocated like any other.
+    """
+    query = context.session.query(models.MacAddressRange)
+    query = query.filter_by(id=mac_address_range_id)
+    query = query.filter(or_(
+        models.MacAddressRange.next_auto_assign_mac == last + 1,
+        and_(models.MacAddressRange.next_auto_assign_mac == -1,
+             models.MacAddressRange.last_address == last)))
+    if query.update({"next_auto_assign_mac": first},
+                    synchronize_session=False):
+        return
+
+    # NOTE: these were never handed out, so there's nothing to wait
+    #       out before reusing them.
+    deallocated_at = datetime.datetime(1970, 1, 1)
+    now = timeutils.utcnow()
+    rows = [dict(address=address, mac_address_range_id=mac_address_range_id,
+                 tenant_id=context.tenant_id, deallocated=True,
+                 deallocated_at=deallocated_at, created_at=now)
+            for address in xrange(first, last + 1)]
+    context.session.execute(models.MacAddress.__table__.insert().values(rows))
+    _mac_range_count_update(context.session.connection(),
+                            mac_address_range_id, len(rows))
+    context.session.execute(
+        models.MacAddressReuseQueue.__table__.insert().values(
+            [dict(address=row["address"], deallocated_at=deallocated_at,
+                  created_at=now) for row in rows]))
+
+
 def mac_address_update(context, mac, **kwargs):
     mac.update(kwargs)
     context.session.add(mac)
@@ -615,6 +1300,9 @@ def _network_find(context, limit, sorts, marker, page_reverse, fields,
     if "join_subnets" in filters:
         query = query.options(orm.joinedload(models.Network.subnets))
 
+    if "page_token" in filters:
+        return _keyset_paginate(query, models.Network, limit,
+                                filters["page_token"])
     return paginate_query(query, models.Network, limit, sorts, marker)
 
 
@@ -641,16 +1329,29 @@ def network_delete(context, network):
     context.session.delete(network)
 
 
+def _subnet_stripe_counts():
+    """SQL for the counts kept on a subnet's cursor stripes. Correlates
+    against quark_subnets.
+    """
+    cursor = models.SubnetCursor
+    return select([sql_func.coalesce(sql_func.sum(
+        cursor.allocated_count + cursor.reserved_count), 0)]).where(
+            cursor.subnet_id == models.Subnet.id).as_scalar()
+
+
 def subnet_find_ordered_by_most_full(context, net_id, lock_subnets=True,
-                                     **filters):
-    count = sql_func.count(models.IPAddress.address).label("count")
+                                     populate_existing=False, **filters):
+    # NOTE: the counts are maintained alongside quark_ip_addresses, which
+    #       saves joining against and grouping every address in the network.
+    count = (models.Subnet.allocated_count + models.Subnet.reserved_count +
+             _subnet_stripe_counts()).label("count")
     size = (models.Subnet.last_ip - models.Subnet.first_ip)
     query = context.session.query(models.Subnet, count)
     if lock_subnets:
         query = query.with_lockmode("update")
+    if populate_existing:
+        query = query.populate_existing()
     query = query.filter_by(do_not_use=False)
-    query = query.outerjoin(models.Subnet.generated_ips)
-    query = query.group_by(models.Subnet.id)
     query = query.order_by(
         asc(models.Subnet.ip_version),
         asc(size - count))
@@ -667,22 +1368,109 @@ def subnet_find_ordered_by_most_full(context, net_id, lock_subnets=True,
     return query
 
 
-def subnet_update_next_auto_assign_ip(context, subnet):
+def _skip_policy_cidr(cursor, ip_policy_id=models.Subnet.ip_policy_id):
+    """SQL for the first address at or after cursor not excluded by the
+    policy CIDR containing it, if any.
+
+    Uses the first_ip/last_ip columns of quark_ip_policy_cidrs so that an
+    excluded range costs one statement instead of one retry per address.
+    By default it correlates against quark_subnets, so it's only valid in
+    statements on that table unless ip_policy_id is given.
+    """
+    ippc = models.IPPolicyCIDR
+    hole_end = select([sql_func.max(ippc.last_ip) + 1]).where(and_(
+        ippc.ip_policy_id == ip_policy_id,
+        ippc.first_ip <= cursor,
+        ippc.last_ip >= cursor)).as_scalar()
+    return sql_func.coalesce(hole_end, cursor)
+
+
+def subnet_update_next_auto_assign_ip(context, subnet, increment=1,
+                                      expected=None):
+    """Advances next_auto_assign_ip past the address about to be assigned.
+
+    With the default increment, a cursor inside one of the subnet's policy
+    CIDRs jumps past the end of that CIDR in the same statement. Larger
+    increments are applied as is, callers reserving a range have already
+    skipped over policy addresses themselves.
+
+    If expected is given the update is a compare-and-swap, and only matches
+    while the cursor still holds that value.
+    """
     query = context.session.query(models.Subnet)
     query = query.filter(models.Subnet.id == subnet["id"])
     query = query.filter(models.Subnet.next_auto_assign_ip != -1)
+    if expected is not None:
+        query = query.filter(models.Subnet.next_auto_assign_ip == expected)
+
+    cursor = models.Subnet.next_auto_assign_ip
+    if increment == 1:
+        cursor = _skip_policy_cidr(cursor)
 
     # For details on synchronize_session, see:
     # http://docs.sqlalchemy.org/en/rel_0_8/orm/query.html
     query = query.update(
-        {"next_auto_assign_ip":
-         models.Subnet.next_auto_assign_ip + 1},
+        {"next_auto_assign_ip": cursor + increment},
         synchronize_session=False)
 
     # Returns a count of the rows matched in the update
     return query
 
 
+def subnet_cursors_find(context, subnet):
+    query = context.session.query(models.SubnetCursor)
+    query = query.filter_by(subnet_id=subnet["id"])
+    return query.order_by(asc(models.SubnetCursor.stripe)).all()
+
+
+def subnet_cursors_create(context, subnet, stripes):
+    """Splits the subnet's unassigned addresses into contiguous stripes."""
+    first_ip = subnet["next_auto_assign_ip"]
+    last_ip = subnet["last_ip"]
+    stride = max(1, (last_ip - first_ip + stripes) // stripes)
+    cursors = []
+    while first_ip <= last_ip:
+        cursor = models.SubnetCursor(
+            subnet_id=subnet["id"], stripe=len(cursors), first_ip=first_ip,
+            last_ip=min(first_ip + stride - 1, last_ip),
+            next_auto_assign_ip=first_ip)
+        context.session.add(cursor)
+        cursors.append(cursor)
+        first_ip = cursor["last_ip"] + 1
+    return cursors
+
+
+def subnet_cursor_update_next_auto_assign_ip(context, cursor, ip_policy_id):
+    """Advances a cursor stripe past the address about to be assigned.
+
+    Matches nothing once the stripe is exhausted. Like
+    subnet_update_next_auto_assign_ip, a cursor inside one of the policy's
+    CIDRs jumps past the end of that CIDR.
+    """
+    query = context.session.query(models.SubnetCursor)
+    query = query.filter_by(subnet_id=cursor["subnet_id"],
+                            stripe=cursor["stripe"])
+    query = query.filter(models.SubnetCursor.next_auto_assign_ip <=
+                         models.SubnetCursor.last_ip)
+    next_ip = _skip_policy_cidr(models.SubnetCursor.next_auto_assign_ip,
+                                ip_policy_id=ip_policy_id)
+    return query.update({"next_auto_assign_ip": next_ip + 1},
+                        synchronize_session=False)
+
+
+def subnet_cursor_update_range(context, cursor, first_ip, next_ip):
+    """Moves a cursor stripe from first_ip on to next_ip.
+
+    Matches nothing if the stripe has been moved since it was read.
+    """
+    query = context.session.query(models.SubnetCursor)
+    query = query.filter_by(subnet_id=cursor["subnet_id"],
+                            stripe=cursor["stripe"],
+                            next_auto_assign_ip=first_ip)
+    return query.update({"next_auto_assign_ip": next_ip},
+                        synchronize_session=False)
+
+
 def subnet_update_set_full(context, subnet):
     query = context.session.query(models.Subnet)
     query = query.filter_by(id=subnet["id"])
@@ -711,6 +1499,123 @@ def subnet_update_set_alloc_pool_cache(context, subnet, cache_data=None):
     return subnet
 
 
+def _subnet_free_ranges_stamp(context, subnet):
+    ip_policy = subnet["ip_policy"] or {}
+    rows = (subnet["allocated_count"] or 0) + (subnet["reserved_count"] or 0)
+    # NOTE: a subnet striped before ipam_use_free_ranges was set keeps some
+    #       of its counts on the stripes.
+    cursor = models.SubnetCursor
+    query = context.session.query(sql_func.sum(cursor.allocated_count +
+                                               cursor.reserved_count))
+    rows += query.filter(cursor.subnet_id == subnet["id"]).scalar() or 0
+    return dict(rows=rows,
+                ip_policy=[ip_policy.get("id"), ip_policy.get("revision")])
+
+
+def _subnet_free_ranges_pending(context, subnet, pending):
+    """Sorts the reservations stored with the index by whether they landed.
+
+    Returns the number of reserved addresses that have a row by now, the
+    reservations still waiting for theirs and the addresses of those that
+    gave up waiting after ipam_free_ranges_reservation_timeout.
+    """
+    if not pending:
+        return 0, [], []
+    query = context.session.query(models.IPAddress.address)
+    query = query.filter(models.IPAddress.subnet_id == subnet["id"])
+    query = query.filter(models.IPAddress.address.in_(
+        [long(address) for address, reserved_at in pending]))
+    landed = set(address for (address,) in query)
+    expiry = (timeutils.utcnow_ts() -
+              CONF.QUARK.ipam_free_ranges_reservation_timeout)
+    waiting = [[address, reserved_at] for address, reserved_at in pending
+               if address not in landed and reserved_at > expiry]
+    expired = [address for address, reserved_at in pending
+               if address not in landed and reserved_at <= expiry]
+    return len(landed), waiting, expired
+
+
+def subnet_free_ranges_build(context, subnet):
+    """Builds the free address index for a subnet from scratch.
+
+    Everything in the subnet that isn't excluded by the subnet's IP policy
+    and doesn't already have a row in quark_ip_addresses is considered free.
+    """
+    free_ranges = interval_set.IntervalSet.from_range(subnet["first_ip"],
+                                                      subnet["last_ip"])
+    compiled_policy = models.IPPolicy.get_compiled_policy(subnet)
+    for first, last in compiled_policy.intervals():
+        free_ranges.remove_range(first, last)
+
+    query = context.session.query(models.IPAddress.address)
+    query = query.filter(models.IPAddress.subnet_id == subnet["id"])
+    for (address,) in query:
+        free_ranges.remove(address)
+    return free_ranges
+
+
+def subnet_free_ranges_find(context, subnet):
+    """Returns the subnet's free address index, rebuilding it if stale.
+
+    The index is stored along with the subnet's committed row count
+    (allocated_count plus reserved_count), its IP policy revision and the
+    addresses reserved from it whose rows may not be committed yet. Rows
+    for those reservations are expected and don't make the index stale.
+    Deleted rows, rows inserted without going through the index (such as
+    while ipam_use_free_ranges was off) and policy changes do, and force a
+    rebuild. Deallocated v4 addresses keep their row and are handed back
+    out by reallocation, so they stay out of the index.
+
+    Reservations still waiting for their row are kept on the subnet for
+    subnet_update_set_free_ranges, and stay out of a rebuilt index too.
+    """
+    data = subnet["_free_ranges"]
+    data = json.loads(data) if data else None
+    # NOTE: indexes from before reservations were stored are rebuilt.
+    if not isinstance(data, dict) or "pending" not in data:
+        data = dict(free=None, pending=[])
+    free = data.pop("free")
+    landed, waiting, expired = _subnet_free_ranges_pending(
+        context, subnet, data.pop("pending"))
+    subnet["_free_ranges_pending"] = waiting
+    if free is not None:
+        data["rows"] += landed
+        if data == _subnet_free_ranges_stamp(context, subnet):
+            free_ranges = interval_set.IntervalSet(
+                [(long(first), long(last)) for first, last in free])
+            for address in expired:
+                free_ranges.add(address)
+            return free_ranges
+    LOG.info("Building free address index for subnet %s" % subnet["id"])
+    free_ranges = subnet_free_ranges_build(context, subnet)
+    for address, reserved_at in waiting:
+        free_ranges.remove(address)
+    return free_ranges
+
+
+def subnet_update_set_free_ranges(context, subnet, free_ranges=None,
+                                  reserved=()):
+    """Persists the free address index. Passing None invalidates it.
+
+    reserved are the addresses taken out of free_ranges that the caller is
+    about to insert rows for, in a transaction of its own.
+    """
+    data = None
+    if free_ranges is not None:
+        now = timeutils.utcnow_ts()
+        pending = list(subnet.get("_free_ranges_pending") or [])
+        pending.extend([address, now] for address in reserved)
+        data = json.dumps(dict(free=free_ranges.intervals(), pending=pending,
+                               **_subnet_free_ranges_stamp(context, subnet)))
+    query = context.session.query(models.Subnet)
+    query = query.filter(models.Subnet.id == subnet["id"])
+    row_count = query.update({"_free_ranges": data},
+                             synchronize_session=False)
+    if isinstance(subnet, models.Subnet):
+        orm.attributes.set_committed_value(subnet, "_free_ranges", data)
+    return row_count
+
+
 @scoped
 def subnet_find(context, limit=None, page_reverse=False, sorts=None,
                 marker_obj=None, fields=None, **filters):
@@ -770,6 +1675,9 @@ def _subnet_find(context, limit, sorts, marker, page_reverse, fields,
     if "join_routes" in filters:
         query = query.options(orm.joinedload(models.Subnet.routes))
 
+    if "page_token" in filters:
+        return _keyset_paginate(query, models.Subnet, limit,
+                                filters["page_token"])
     return paginate_query(query, models.Subnet, limit, sorts, marker)
 
 
@@ -840,11 +1748,15 @@ def dns_delete(context, dns):
 
 
 @scoped
-def security_group_find(context, **filters):
+def security_group_find(context, limit=None, **filters):
     query = context.session.query(models.SecurityGroup).options(
         orm.joinedload(models.SecurityGroup.rules))
     model_filters = _model_query(context, models.SecurityGroup, filters)
-    return query.filter(*model_filters)
+    query = query.filter(*model_filters)
+    if "page_token" in filters:
+        return _keyset_paginate(query, models.SecurityGroup, limit,
+                                filters["page_token"])
+    return query
 
 
 @scoped
@@ -919,9 +1831,11 @@ def ip_policy_create(context, **ip_policy_dict):
                                 last_ip=cidr_net.last))
         ip_set.add(excluded_cidr)
     ip_policy_dict["size"] = ip_set.size
+    ip_policy_dict["revision"] = uuidutils.generate_uuid()
     new_policy.update(ip_policy_dict)
     new_policy["tenant_id"] = context.tenant_id
     context.session.add(new_policy)
+    models.IPPolicy.invalidate_compiled_policy(new_policy["id"])
     return new_policy
 
 
@@ -945,14 +1859,17 @@ def ip_policy_update(context, ip_policy, **ip_policy_dict):
                                     last_ip=cidr_net.last))
             ip_set.add(excluded_cidr)
         ip_policy_dict["size"] = ip_set.size
+        ip_policy_dict["revision"] = uuidutils.generate_uuid()
 
     ip_policy.update(ip_policy_dict)
     context.session.add(ip_policy)
+    models.IPPolicy.invalidate_compiled_policy(ip_policy["id"])
     return ip_policy
 
 
 def ip_policy_delete(context, ip_policy):
     context.session.delete(ip_policy)
+    models.IPPolicy.invalidate_compiled_policy(ip_policy["id"])
 
 
 def transaction_create(context):
@@ -961,6 +1878,17 @@ def transaction_create(context):
     return transaction
 
 
+def claim_token_create():
+    """Returns a token to mark the row claimed by a reallocate UPDATE with.
+
+    The token is what ip_address_reallocate_find and
+    mac_address_reallocate_find look the row up by afterwards. It's 63
+    random bits rather than the id of a committed quark_transactions row,
+    so each attempt saves an INSERT and commit.
+    """
+    return _claim_tokens.getrandbits(63)
+
+
 @scoped
 def floating_ip_find(context, lock_mode=False, limit=None, sorts=None,
                      marker=None, page_reverse=False, fields=None, **filters):
@@ -997,6 +1925,29 @@ def floating_ip_disassociate_fixed_ip(context, floating_ip):
     return floating_ip
 
 
+def floating_ip_disassociate_fixed_ips(context, floating_ips):
+    """Disassociates the fixed IPs of many floating IPs with one DELETE.
+
+    Returns the floating IPs that had a fixed IP.
+    """
+    if not floating_ips:
+        return []
+    flips = models.flip_to_fixed_ip_assoc_tbl
+    ids = [flip["id"] for flip in floating_ips]
+    query = context.session.query(flips.c.floating_ip_address_id).distinct()
+    associated = set(row[0] for row in
+                     query.filter(flips.c.floating_ip_address_id.in_(ids)))
+    if not associated:
+        return []
+    context.session.execute(flips.delete().where(
+        flips.c.floating_ip_address_id.in_(associated)))
+    disassociated = [flip for flip in floating_ips
+                     if flip["id"] in associated]
+    for flip in disassociated:
+        orm.attributes.set_committed_value(flip, "fixed_ip", None)
+    return disassociated
+
+
 @scoped
 def lock_holder_find(context, **filters):
     query = context.session.query(models.LockHolder)
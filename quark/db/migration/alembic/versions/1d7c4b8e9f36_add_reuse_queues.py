@@ -0,0 +1,90 @@
+"""Add IP and MAC address reuse queue tables
+
+Revision ID: 1d7c4b8e9f36
+Revises: 5e1f9d3a7b20
+Create Date: 2015-11-17 11:45:09.582371
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1d7c4b8e9f36'
+down_revision = '5e1f9d3a7b20'
+
+from alembic import op
+from sqlalchemy.sql import column, select, table
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('quark_ip_address_reuse_queue',
+                    sa.Column('created_at', sa.DateTime(), nullable=True),
+                    sa.Column('ip_address_id', sa.String(length=36),
+                              nullable=False),
+                    sa.Column('network_id', sa.String(length=36),
+                              nullable=True),
+                    sa.Column('subnet_id', sa.String(length=36),
+                              nullable=True),
+                    sa.Column('version', sa.Integer(), nullable=True),
+                    sa.Column('deallocated_at', sa.DateTime(),
+                              nullable=True),
+                    sa.ForeignKeyConstraint(['ip_address_id'],
+                                            ['quark_ip_addresses.id'],
+                                            ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('ip_address_id'),
+                    mysql_engine='InnoDB')
+    op.create_index('idx_ip_reuse_network_version_dealloc',
+                    'quark_ip_address_reuse_queue',
+                    ['network_id', 'version', 'deallocated_at'])
+    op.create_table('quark_mac_address_reuse_queue',
+                    sa.Column('created_at', sa.DateTime(), nullable=True),
+                    sa.Column('address', sa.BigInteger(),
+                              autoincrement=False, nullable=False),
+                    sa.Column('deallocated_at', sa.DateTime(),
+                              nullable=True),
+                    sa.ForeignKeyConstraint(['address'],
+                                            ['quark_mac_addresses.address'],
+                                            ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('address'),
+                    mysql_engine='InnoDB')
+    op.create_index(op.f('ix_quark_mac_address_reuse_queue_deallocated_at'),
+                    'quark_mac_address_reuse_queue', ['deallocated_at'])
+
+    ip_addresses = table('quark_ip_addresses',
+                         column('id', sa.String(length=36)),
+                         column('network_id', sa.String(length=36)),
+                         column('subnet_id', sa.String(length=36)),
+                         column('version', sa.Integer()),
+                         column('_deallocated', sa.Boolean()),
+                         column('deallocated_at', sa.DateTime()))
+    ip_queue = table('quark_ip_address_reuse_queue',
+                     column('ip_address_id', sa.String(length=36)),
+                     column('network_id', sa.String(length=36)),
+                     column('subnet_id', sa.String(length=36)),
+                     column('version', sa.Integer()),
+                     column('deallocated_at', sa.DateTime()))
+    mac_addresses = table('quark_mac_addresses',
+                          column('address', sa.BigInteger()),
+                          column('deallocated', sa.Boolean()),
+                          column('deallocated_at', sa.DateTime()))
+    mac_queue = table('quark_mac_address_reuse_queue',
+                      column('address', sa.BigInteger()),
+                      column('deallocated_at', sa.DateTime()))
+
+    connection = op.get_bind()
+    connection.execute(ip_queue.insert().from_select(
+        ['ip_address_id', 'network_id', 'subnet_id', 'version',
+         'deallocated_at'],
+        select([ip_addresses.c.id, ip_addresses.c.network_id,
+                ip_addresses.c.subnet_id, ip_addresses.c.version,
+                ip_addresses.c.deallocated_at]).where(
+            ip_addresses.c._deallocated == 1)))
+    connection.execute(mac_queue.insert().from_select(
+        ['address', 'deallocated_at'],
+        select([mac_addresses.c.address,
+                mac_addresses.c.deallocated_at]).where(
+            mac_addresses.c.deallocated == 1)))
+
+
+def downgrade():
+    op.drop_table('quark_mac_address_reuse_queue')
+    op.drop_table('quark_ip_address_reuse_queue')
@@ -0,0 +1,23 @@
+"""Add free address index to subnets
+
+Revision ID: 2a8e3ba5f58e
+Revises: 374c1bdb4480
+Create Date: 2015-11-02 10:31:12.418207
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2a8e3ba5f58e'
+down_revision = '374c1bdb4480'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('quark_subnets', sa.Column('_free_ranges', sa.Text(),
+                                             nullable=True))
+
+
+def downgrade():
+    op.drop_column('quark_subnets', '_free_ranges')
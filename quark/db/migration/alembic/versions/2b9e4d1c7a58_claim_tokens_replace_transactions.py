@@ -0,0 +1,54 @@
+"""Replace quark_transactions references with claim tokens
+
+Revision ID: 2b9e4d1c7a58
+Revises: 1d7c4b8e9f36
+Create Date: 2015-11-24 10:12:37.418264
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2b9e4d1c7a58'
+down_revision = '1d7c4b8e9f36'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+_CLAIMS = (('quark_ip_addresses', 'fk_quark_ips_transaction_id'),
+           ('quark_mac_addresses', 'fk_quark_macs_transaction_id'))
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    for table_name, fk_name in _CLAIMS:
+        fk_names = [fk['name']
+                    for fk in inspector.get_foreign_keys(table_name)]
+        with op.batch_alter_table(table_name) as batch_op:
+            # NOTE: SQLite can't add constraints by ALTER, so the foreign key
+            #       may never have been created there.
+            if fk_name in fk_names:
+                batch_op.drop_constraint(fk_name, type_='foreignkey')
+            if bind.dialect.name == 'mysql':
+                # NOTE: MySQL backed the foreign key with an index of the
+                #       same name, which the index below replaces.
+                batch_op.drop_index(fk_name)
+            batch_op.alter_column('transaction_id', type_=sa.BigInteger(),
+                                  existing_type=sa.Integer(),
+                                  existing_nullable=True)
+            batch_op.create_index('ix_%s_transaction_id' % table_name,
+                                  ['transaction_id'])
+
+
+def downgrade():
+    for table_name, fk_name in _CLAIMS:
+        # NOTE: claim tokens don't exist in quark_transactions.
+        op.execute(sa.text('UPDATE %s SET transaction_id = NULL' %
+                           table_name))
+        with op.batch_alter_table(table_name) as batch_op:
+            batch_op.drop_index('ix_%s_transaction_id' % table_name)
+            batch_op.alter_column('transaction_id', type_=sa.Integer(),
+                                  existing_type=sa.BigInteger(),
+                                  existing_nullable=True)
+            batch_op.create_foreign_key(fk_name, 'quark_transactions',
+                                        ['transaction_id'], ['id'])
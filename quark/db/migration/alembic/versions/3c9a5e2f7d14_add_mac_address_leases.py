@@ -0,0 +1,40 @@
+"""Add MAC address leases
+
+Revision ID: 3c9a5e2f7d14
+Revises: 6a2d8f4c1e93
+Create Date: 2015-12-02 14:06:51.730219
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3c9a5e2f7d14'
+down_revision = '6a2d8f4c1e93'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('quark_mac_address_leases',
+                    sa.Column('created_at', sa.DateTime(), nullable=True),
+                    sa.Column('id', sa.String(length=36), nullable=False),
+                    sa.Column('mac_address_range_id', sa.String(length=36),
+                              nullable=False),
+                    sa.Column('first_address', sa.BigInteger(),
+                              nullable=False),
+                    sa.Column('last_address', sa.BigInteger(),
+                              nullable=False),
+                    sa.Column('expires_at', sa.DateTime(), nullable=False),
+                    sa.ForeignKeyConstraint(['mac_address_range_id'],
+                                            ['quark_mac_address_ranges.id'],
+                                            ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('id'),
+                    mysql_engine='InnoDB')
+    op.create_index(op.f('ix_quark_mac_address_leases_expires_at'),
+                    'quark_mac_address_leases', ['expires_at'])
+
+
+def downgrade():
+    op.drop_index(op.f('ix_quark_mac_address_leases_expires_at'),
+                  'quark_mac_address_leases')
+    op.drop_table('quark_mac_address_leases')
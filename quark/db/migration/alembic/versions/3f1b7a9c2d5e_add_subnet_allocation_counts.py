@@ -0,0 +1,49 @@
+"""Add allocated_count and reserved_count to subnets
+
+Revision ID: 3f1b7a9c2d5e
+Revises: 2a8e3ba5f58e
+Create Date: 2015-11-04 14:52:06.730215
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f1b7a9c2d5e'
+down_revision = '2a8e3ba5f58e'
+
+from alembic import op
+from sqlalchemy.sql import and_, column, func, or_, select, table
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('quark_subnets',
+                  sa.Column('allocated_count', sa.Integer(), nullable=False,
+                            server_default='0'))
+    op.add_column('quark_subnets',
+                  sa.Column('reserved_count', sa.Integer(), nullable=False,
+                            server_default='0'))
+
+    subnets = table('quark_subnets',
+                    column('id', sa.String(length=36)),
+                    column('allocated_count', sa.Integer()),
+                    column('reserved_count', sa.Integer()))
+    ip_addresses = table('quark_ip_addresses',
+                         column('subnet_id', sa.String(length=36)),
+                         column('_deallocated', sa.Boolean()))
+
+    allocated = select([func.count()]).where(and_(
+        ip_addresses.c.subnet_id == subnets.c.id,
+        or_(ip_addresses.c._deallocated.is_(None),
+            ip_addresses.c._deallocated != 1))).as_scalar()
+    reserved = select([func.count()]).where(and_(
+        ip_addresses.c.subnet_id == subnets.c.id,
+        ip_addresses.c._deallocated == 1)).as_scalar()
+
+    connection = op.get_bind()
+    connection.execute(subnets.update().values(
+        allocated_count=allocated, reserved_count=reserved))
+
+
+def downgrade():
+    op.drop_column('quark_subnets', 'reserved_count')
+    op.drop_column('quark_subnets', 'allocated_count')
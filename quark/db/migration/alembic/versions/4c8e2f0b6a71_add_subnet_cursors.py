@@ -0,0 +1,38 @@
+"""Add striped subnet allocation cursors table
+
+Revision ID: 4c8e2f0b6a71
+Revises: 3f1b7a9c2d5e
+Create Date: 2015-11-09 10:21:47.118530
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4c8e2f0b6a71'
+down_revision = '3f1b7a9c2d5e'
+
+from alembic import op
+import sqlalchemy as sa
+
+from quark.db.custom_types import INET
+
+
+def upgrade():
+    op.create_table('quark_subnet_cursors',
+                    sa.Column('created_at', sa.DateTime(), nullable=True),
+                    sa.Column('subnet_id', sa.String(length=36),
+                              nullable=False),
+                    sa.Column('stripe', sa.Integer(), autoincrement=False,
+                              nullable=False),
+                    sa.Column('first_ip', INET(), nullable=False),
+                    sa.Column('last_ip', INET(), nullable=False),
+                    sa.Column('next_auto_assign_ip', INET(),
+                              nullable=False),
+                    sa.ForeignKeyConstraint(['subnet_id'],
+                                            ['quark_subnets.id'],
+                                            ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('subnet_id', 'stripe'),
+                    mysql_engine='InnoDB')
+
+
+def downgrade():
+    op.drop_table('quark_subnet_cursors')
@@ -0,0 +1,38 @@
+"""Add allocated_count to MAC address ranges
+
+Revision ID: 5e1f9d3a7b20
+Revises: 4c8e2f0b6a71
+Create Date: 2015-11-12 16:03:28.402917
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e1f9d3a7b20'
+down_revision = '4c8e2f0b6a71'
+
+from alembic import op
+from sqlalchemy.sql import column, func, select, table
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('quark_mac_address_ranges',
+                  sa.Column('allocated_count', sa.Integer(), nullable=False,
+                            server_default='0'))
+
+    mac_ranges = table('quark_mac_address_ranges',
+                       column('id', sa.String(length=36)),
+                       column('allocated_count', sa.Integer()))
+    mac_addresses = table('quark_mac_addresses',
+                          column('mac_address_range_id',
+                                 sa.String(length=36)))
+
+    allocated = select([func.count()]).where(
+        mac_addresses.c.mac_address_range_id == mac_ranges.c.id).as_scalar()
+
+    connection = op.get_bind()
+    connection.execute(mac_ranges.update().values(allocated_count=allocated))
+
+
+def downgrade():
+    op.drop_column('quark_mac_address_ranges', 'allocated_count')
@@ -0,0 +1,23 @@
+"""Add revision to IP policies
+
+Revision ID: 6a2d8f4c1e93
+Revises: 2b9e4d1c7a58
+Create Date: 2015-11-30 09:41:18.203547
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6a2d8f4c1e93'
+down_revision = '2b9e4d1c7a58'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('quark_ip_policy', sa.Column('revision', sa.String(36),
+                                               nullable=True))
+
+
+def downgrade():
+    op.drop_column('quark_ip_policy', 'revision')
@@ -0,0 +1,48 @@
+"""Add allocation counts to subnet cursor stripes
+
+Revision ID: 7e2b4c9a1f58
+Revises: 3c9a5e2f7d14
+Create Date: 2015-12-03 16:22:09.641508
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7e2b4c9a1f58'
+down_revision = '3c9a5e2f7d14'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('quark_subnet_cursors',
+                  sa.Column('allocated_count', sa.Integer(), nullable=False,
+                            server_default='0'))
+    op.add_column('quark_subnet_cursors',
+                  sa.Column('reserved_count', sa.Integer(), nullable=False,
+                            server_default='0'))
+
+
+def downgrade():
+    # NOTE: fold the stripes' counts back into their subnets first.
+    cursors = sa.table('quark_subnet_cursors',
+                       sa.column('subnet_id', sa.String(36)),
+                       sa.column('allocated_count', sa.Integer()),
+                       sa.column('reserved_count', sa.Integer()))
+    subnets = sa.table('quark_subnets',
+                       sa.column('id', sa.String(36)),
+                       sa.column('allocated_count', sa.Integer()),
+                       sa.column('reserved_count', sa.Integer()))
+
+    def _stripe_sum(column):
+        return sa.select([sa.func.coalesce(sa.func.sum(column), 0)]).where(
+            cursors.c.subnet_id == subnets.c.id).as_scalar()
+
+    op.execute(subnets.update().values(
+        allocated_count=(subnets.c.allocated_count +
+                         _stripe_sum(cursors.c.allocated_count)),
+        reserved_count=(subnets.c.reserved_count +
+                        _stripe_sum(cursors.c.reserved_count))))
+    with op.batch_alter_table('quark_subnet_cursors') as batch_op:
+        batch_op.drop_column('reserved_count')
+        batch_op.drop_column('allocated_count')
@@ -30,6 +30,7 @@ from sqlalchemy import orm
 
 from quark.db import custom_types
 from quark.db import ip_types
+from quark import interval_set
 # NOTE(mdietz): This is the only way to actually create the quotas table,
 #              regardless if we need it. This is how it's done upstream.
 # NOTE(jhammond): If it isn't obvious quota_driver is unused and that's ok.
@@ -160,7 +161,10 @@ class IPAddress(BASEV2, models.HasId):
     allocated_at = sa.Column(sa.DateTime())
     subnet = orm.relationship("Subnet")
     # Need a constant to facilitate the indexed search for new IPs
-    _deallocated = sa.Column(sa.Boolean())
+    # NOTE: active_history so the subnet allocation counts in quark.db.api
+    #       can always tell which way the flag flipped.
+    _deallocated = orm.column_property(sa.Column(sa.Boolean()),
+                                       active_history=True)
     # Legacy data
     used_by_tenant_id = sa.Column(sa.String(255))
 
@@ -168,9 +172,10 @@ class IPAddress(BASEV2, models.HasId):
                                      ip_types.SHARED,
                              name="quark_ip_address_types"))
     associations = orm.relationship(PortIpAssociation, backref="ip_address")
-    transaction_id = sa.Column(sa.Integer(),
-                               sa.ForeignKey("quark_transactions.id"),
-                               nullable=True)
+    # NOTE: claim token set by the reallocating UPDATE, see
+    #       db_api.claim_token_create. No longer references
+    #       quark_transactions.
+    transaction_id = sa.Column(sa.BigInteger(), nullable=True, index=True)
     lock_id = sa.Column(sa.Integer(),
                         sa.ForeignKey("quark_locks.id"),
                         nullable=True)
@@ -226,6 +231,27 @@ class IPAddress(BASEV2, models.HasId):
     fixed_ip = None
 
 
+class IPAddressReuseQueue(BASEV2):
+    """Deallocated IP addresses waiting to be reused, oldest first.
+
+    Mirrors the deallocated rows of quark_ip_addresses so that reallocation
+    is a seek on (network_id, version, deallocated_at) no matter how many
+    addresses have been deallocated.
+    """
+    __tablename__ = "quark_ip_address_reuse_queue"
+    __table_args__ = (sa.Index("idx_ip_reuse_network_version_dealloc",
+                               "network_id", "version", "deallocated_at"),
+                      TABLE_KWARGS)
+    ip_address_id = sa.Column(sa.String(36),
+                              sa.ForeignKey("quark_ip_addresses.id",
+                                            ondelete="CASCADE"),
+                              primary_key=True)
+    network_id = sa.Column(sa.String(36))
+    subnet_id = sa.Column(sa.String(36))
+    version = sa.Column(sa.Integer())
+    deallocated_at = sa.Column(sa.DateTime())
+
+
 class FloatingToFixedIPAssociation(object):
     pass
 
@@ -274,26 +300,39 @@ class DNSNameserver(BASEV2, models.HasTenant, models.HasId, IsHazTags):
                                                        ondelete="CASCADE"))
 
 
-def _pools_from_cidr(cidr):
-    cidrs = cidr.iter_cidrs()
-    if len(cidrs) == 0:
-        return []
-    if len(cidrs) == 1:
-        return [dict(start=str(cidrs[0][0]),
-                     end=str(cidrs[0][-1]))]
-
-    pool_start = cidrs[0][0]
-    prev_cidr_end = cidrs[0][-1]
-    pools = []
-    for cidr in cidrs[1:]:
-        cidr_start = cidr[0]
-        if prev_cidr_end + 1 != cidr_start:
-            pools.append(dict(start=str(pool_start),
-                              end=str(prev_cidr_end)))
-            pool_start = cidr_start
-        prev_cidr_end = cidr[-1]
-    pools.append(dict(start=str(pool_start), end=str(prev_cidr_end)))
-    return pools
+def _pools_from_intervals(intervals, version):
+    def _readable(value):
+        address = netaddr.IPAddress(value)
+        if version == 4:
+            address = address.ipv4()
+        return str(address)
+
+    return [dict(start=_readable(first), end=_readable(last))
+            for first, last in intervals.intervals()]
+
+
+class SubnetCursor(BASEV2):
+    """One stripe of a v4 subnet's address space, with its own cursor.
+
+    Striping spreads concurrent allocations in a subnet over several rows
+    instead of all of them updating Subnet.next_auto_assign_ip.
+    """
+    __tablename__ = "quark_subnet_cursors"
+    subnet_id = sa.Column(sa.String(36),
+                          sa.ForeignKey("quark_subnets.id",
+                                        ondelete="CASCADE"),
+                          primary_key=True)
+    stripe = sa.Column(sa.Integer(), primary_key=True, autoincrement=False)
+    first_ip = sa.Column(custom_types.INET(), nullable=False)
+    last_ip = sa.Column(custom_types.INET(), nullable=False)
+    next_auto_assign_ip = sa.Column(custom_types.INET(), nullable=False)
+    # Changes to the subnet's allocated_count and reserved_count made by
+    # addresses in the stripe, kept here so that allocating from a striped
+    # subnet never updates the subnet row. The subnet's counts are the sum.
+    allocated_count = sa.Column(sa.Integer(), default=0, nullable=False,
+                                server_default='0')
+    reserved_count = sa.Column(sa.Integer(), default=0, nullable=False,
+                               server_default='0')
 
 
 class Subnet(BASEV2, models.HasId, IsHazTags):
@@ -316,6 +355,9 @@ class Subnet(BASEV2, models.HasId, IsHazTags):
     network_id = sa.Column(sa.String(36), sa.ForeignKey('quark_networks.id'))
     _cidr = sa.Column(sa.String(64), nullable=False)
     _allocation_pool_cache = sa.Column(sa.Text(), nullable=True)
+    # NOTE: run-length free address index, see quark.interval_set. Deferred
+    #       so that listing subnets never pays for loading it.
+    _free_ranges = orm.deferred(sa.Column(sa.Text(), nullable=True))
     tenant_id = sa.Column(sa.String(255), index=True)
     segment_id = sa.Column(sa.String(255), index=True)
 
@@ -330,10 +372,14 @@ class Subnet(BASEV2, models.HasId, IsHazTags):
             pools = json.loads(_cache)
             return pools
         else:
-            ip_policy_cidrs = IPPolicy.get_ip_policy_cidrs(self)
-            cidr = netaddr.IPSet([netaddr.IPNetwork(self["cidr"])])
-            allocatable = cidr - ip_policy_cidrs
-            pools = _pools_from_cidr(allocatable)
+            compiled_policy = IPPolicy.get_compiled_policy(self)
+            cidr = netaddr.IPNetwork(self["cidr"])
+            v6_cidr = cidr.ipv6()
+            allocatable = interval_set.IntervalSet.from_range(v6_cidr.first,
+                                                              v6_cidr.last)
+            for first, last in compiled_policy.intervals():
+                allocatable.remove_range(first, last)
+            pools = _pools_from_intervals(allocatable, cidr.version)
             return pools
 
     @cidr.setter
@@ -374,6 +420,19 @@ class Subnet(BASEV2, models.HasId, IsHazTags):
                              sa.ForeignKey("quark_ip_policy.id"))
     # Legacy data
     do_not_use = sa.Column(sa.Boolean(), default=False)
+    cursors = orm.relationship(SubnetCursor, cascade="delete",
+                               order_by=SubnetCursor.stripe)
+    # Denormalized counts of allocated and deallocated (held for reuse) rows
+    # in quark_ip_addresses, kept up to date by quark.db.api. Those of a
+    # striped subnet are spread over its cursors too.
+    allocated_count = sa.Column(sa.Integer(), default=0, nullable=False,
+                                server_default='0')
+    reserved_count = sa.Column(sa.Integer(), default=0, nullable=False,
+                               server_default='0')
+
+    # Address reserved for this subnet by IPAM during subnet selection.
+    # Not persisted, consumed by the allocation step that follows.
+    reserved_ip = None
 
 
 port_group_association_table = sa.Table(
@@ -471,9 +530,17 @@ class MacAddress(BASEV2, models.HasTenant):
     deallocated = sa.Column(sa.Boolean(), index=True)
     deallocated_at = sa.Column(sa.DateTime(), index=True)
     orm.relationship(Port, backref="mac_address")
-    transaction_id = sa.Column(sa.Integer(),
-                               sa.ForeignKey("quark_transactions.id"),
-                               nullable=True)
+    transaction_id = sa.Column(sa.BigInteger(), nullable=True, index=True)
+
+
+class MacAddressReuseQueue(BASEV2):
+    """Deallocated MAC addresses waiting to be reused, oldest first."""
+    __tablename__ = "quark_mac_address_reuse_queue"
+    address = sa.Column(sa.BigInteger(),
+                        sa.ForeignKey("quark_mac_addresses.address",
+                                      ondelete="CASCADE"),
+                        primary_key=True, autoincrement=False)
+    deallocated_at = sa.Column(sa.DateTime(), index=True)
 
 
 class MacAddressRange(BASEV2, models.HasId):
@@ -489,6 +556,32 @@ class MacAddressRange(BASEV2, models.HasId):
                                       backref="mac_address_range")
     do_not_use = sa.Column(sa.Boolean(), default=False, nullable=False,
                            server_default='0')
+    # Denormalized count of quark_mac_addresses rows in the range, including
+    # deallocated ones held for reuse, kept up to date by quark.db.api.
+    allocated_count = sa.Column(sa.Integer(), default=0, nullable=False,
+                                server_default='0')
+
+
+class MacAddressLease(BASEV2, models.HasId):
+    """A block of a MAC range's addresses handed to one worker.
+
+    The range's cursor has already moved past the block. Leases that
+    outlive expires_at are reclaimed, which hands back whatever addresses
+    in the block never got a row.
+    """
+    __tablename__ = "quark_mac_address_leases"
+    mac_address_range_id = sa.Column(
+        sa.String(36),
+        sa.ForeignKey("quark_mac_address_ranges.id", ondelete="CASCADE"),
+        nullable=False)
+    first_address = sa.Column(sa.BigInteger(), nullable=False)
+    last_address = sa.Column(sa.BigInteger(), nullable=False)
+    expires_at = sa.Column(sa.DateTime(), nullable=False, index=True)
+
+
+# Compiled IP policy exclusions and the (ip_policy_id, revision) they were
+# compiled for, keyed by ip_policy_id, see IPPolicy.get_compiled_policy
+_COMPILED_POLICIES = {}
 
 
 class IPPolicy(BASEV2, models.HasId, models.HasTenant):
@@ -508,6 +601,9 @@ class IPPolicy(BASEV2, models.HasId, models.HasTenant):
     name = sa.Column(sa.String(255), nullable=True)
     description = sa.Column(sa.String(255), nullable=True)
     size = sa.Column(custom_types.INET())
+    # Changed by quark.db.api whenever the exclude CIDRs change, so cached
+    # compilations can be told apart without loading the CIDRs.
+    revision = sa.Column(sa.String(36), nullable=True)
 
     @staticmethod
     def get_ip_policy_cidrs(subnet):
@@ -517,6 +613,34 @@ class IPPolicy(BASEV2, models.HasId, models.HasTenant):
                            for ip_policy_cidr in ip_policies]
         return netaddr.IPSet(ip_policy_cidrs)
 
+    @staticmethod
+    def get_compiled_policy(subnet):
+        """Returns the subnet's policy exclusions as a FrozenIntervalSet.
+
+        Values are IPv6 mapped integers, the same as the first_ip and
+        last_ip columns. Results are cached per ip_policy_id and revision,
+        so a cache hit never loads the policy's CIDRs, and a policy changed
+        by another worker is recompiled instead of being served stale.
+        """
+        ip_policy = subnet["ip_policy"] or {}
+        ip_policy_id = ip_policy.get("id")
+        key = (ip_policy_id, ip_policy.get("revision"))
+        cached = _COMPILED_POLICIES.get(ip_policy_id)
+        if cached and cached[0] == key:
+            return cached[1]
+
+        nets = [netaddr.IPNetwork(ip_policy_cidr.cidr).ipv6()
+                for ip_policy_cidr in ip_policy.get("exclude", [])]
+        compiled = interval_set.FrozenIntervalSet(
+            [(net.first, net.last) for net in nets])
+        if ip_policy_id:
+            _COMPILED_POLICIES[ip_policy_id] = (key, compiled)
+        return compiled
+
+    @staticmethod
+    def invalidate_compiled_policy(ip_policy_id):
+        _COMPILED_POLICIES.pop(ip_policy_id, None)
+
 
 class IPPolicyCIDR(BASEV2, models.HasId):
     __tablename__ = "quark_ip_policy_cidrs"
@@ -540,6 +664,11 @@ class Network(BASEV2, models.HasId):
 
 
 class Transaction(BASEV2):
+    """Legacy claim rows, superseded by db_api.claim_token_create.
+
+    Nothing references the table any more; quark.tools.prune_transactions
+    empties it.
+    """
     __tablename__ = "quark_transactions"
     id = sa.Column(sa.Integer, primary_key=True)
 
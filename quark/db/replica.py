@@ -0,0 +1,147 @@
+# Copyright 2015 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Routing of read-only plugin calls to the database read replica
+"""
+
+import contextlib
+import threading
+import time
+
+from neutron.db import api as neutron_db_api
+from oslo_config import cfg
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+
+quark_opts = [
+    cfg.BoolOpt("read_replica_routing",
+                default=False,
+                help=_("Serve read-only plugin calls, such as listing ports,"
+                       " from [database] slave_connection. Calls fall back"
+                       " to the primary when the replica lags too far"
+                       " behind or the request has already written.")),
+    cfg.IntOpt("read_replica_max_lag",
+               default=5,
+               help=_("Seconds a replica may lag behind the primary and"
+                      " still serve reads.")),
+    cfg.IntOpt("read_replica_lag_check_interval",
+               default=10,
+               help=_("Seconds a measurement of replica lag is reused for"
+                      " before measuring again."))
+]
+
+CONF.register_opts(quark_opts, "QUARK")
+
+# NOTE: set on the request context by every call that may write, so later
+#       reads in the same request see what it wrote.
+WROTE_KEY = "_quark_wrote"
+# NOTE: set on the request context while its session is the replica's.
+ROUTED_KEY = "_quark_replica"
+
+
+class ReplicaLag(object):
+    """Periodically measured lag of the read replica, in seconds.
+
+    None means the lag couldn't be measured, or replication is stopped.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lag = None
+        self._checked_at = 0
+
+    def _measure(self):
+        session = neutron_db_api.get_session(use_slave=True)
+        try:
+            row = session.execute("SHOW SLAVE STATUS").first()
+        finally:
+            session.close()
+        if row is None:
+            LOG.warn("Read replica reports no replication status")
+            return
+        return row["Seconds_Behind_Master"]
+
+    def get(self):
+        with self._lock:
+            now = time.time()
+            if now - self._checked_at >= (
+                    CONF.QUARK.read_replica_lag_check_interval):
+                self._checked_at = now
+                try:
+                    self._lag = self._measure()
+                except Exception:
+                    LOG.exception("Couldn't measure read replica lag")
+                    self._lag = None
+            return self._lag
+
+    def reset(self):
+        with self._lock:
+            self._lag = None
+            self._checked_at = 0
+
+
+LAG = ReplicaLag()
+
+
+def mark_written(context):
+    setattr(context, WROTE_KEY, True)
+
+
+def is_routed(context):
+    """Whether the context is reading from the replica, where it mustn't
+    write.
+    """
+    return getattr(context, ROUTED_KEY, False)
+
+
+def use_replica(context):
+    if not CONF.QUARK.read_replica_routing:
+        return False
+    if not CONF.database.slave_connection:
+        return False
+    if getattr(context, WROTE_KEY, False):
+        return False
+    # NOTE: the caller is already in a transaction on the primary.
+    if (context._session is not None and
+            context._session.transaction is not None):
+        return False
+    lag = LAG.get()
+    if lag is None or lag > CONF.QUARK.read_replica_max_lag:
+        LOG.debug("Read replica lag is %s, reading from the primary" % lag)
+        return False
+    return True
+
+
+@contextlib.contextmanager
+def routed(context):
+    """Serves the context's queries from the replica inside the block, if
+    use_replica allows it, and from the primary otherwise.
+    """
+    if not use_replica(context):
+        yield
+        return
+
+    primary = context._session
+    context._session = neutron_db_api.get_session(use_slave=True)
+    setattr(context, ROUTED_KEY, True)
+    try:
+        yield
+    finally:
+        context._session.close()
+        context._session = primary
+        setattr(context, ROUTED_KEY, False)
@@ -0,0 +1,153 @@
+# Copyright 2015 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Counts and times the SQL statements issued on behalf of a plugin call
+"""
+
+import contextlib
+import json
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+from sqlalchemy import engine
+from sqlalchemy import event
+
+from quark import metrics
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+
+quark_opts = [
+    cfg.BoolOpt("sql_statement_stats",
+                default=False,
+                help=_("Count and time the SQL statements of every plugin"
+                       " call, logging them and publishing them to"
+                       " ipam_metrics_sink."))
+]
+
+CONF.register_opts(quark_opts, "QUARK")
+
+# NOTE: threading.local is per greenthread once eventlet has patched it.
+_local = threading.local()
+_listening = []
+_listen_lock = threading.Lock()
+
+
+class StatementStats(object):
+    """Statements, rows and DB time seen while a collector was active.
+
+    rows is what the DBAPI reports in cursor.rowcount, which some drivers
+    leave at -1 for SELECTs until they're fetched. Those count as 0. The
+    statements themselves are only kept in sql with capture_sql.
+    """
+
+    def __init__(self, name, capture_sql=False):
+        self.name = name
+        self.statements = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.capture_sql = capture_sql
+        self.sql = []
+
+    def record(self, statement, rowcount, seconds):
+        self.statements += 1
+        self.rows += max(rowcount, 0)
+        self.seconds += seconds
+        if self.capture_sql:
+            self.sql.append(statement)
+
+    def to_dict(self):
+        return dict(name=self.name, statements=self.statements,
+                    rows=self.rows, db_seconds=round(self.seconds, 6))
+
+
+def _collectors():
+    if not hasattr(_local, "collectors"):
+        _local.collectors = []
+    return _local.collectors
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if _collectors():
+        conn.info.setdefault("quark_query_start", []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    collectors = _collectors()
+    if not collectors:
+        return
+    starts = conn.info.get("quark_query_start")
+    elapsed = time.time() - starts.pop() if starts else 0.0
+    for stats in collectors:
+        stats.record(statement, cursor.rowcount, elapsed)
+
+
+def _listen():
+    if _listening:
+        return
+    with _listen_lock:
+        if _listening:
+            return
+        event.listen(engine.Engine, "before_cursor_execute",
+                     _before_cursor_execute)
+        event.listen(engine.Engine, "after_cursor_execute",
+                     _after_cursor_execute)
+        _listening.append(True)
+
+
+def publish(stats):
+    LOG.info("SQL statement stats %s" % json.dumps(stats.to_dict(),
+                                                   sort_keys=True))
+    sink = metrics.REGISTRY.get_sink()
+    prefix = CONF.QUARK.ipam_metrics_prefix
+    labels = dict(method=stats.name)
+    sink.increment("%s_sql_statements_total" % prefix, labels,
+                   value=stats.statements)
+    sink.increment("%s_sql_rows_total" % prefix, labels, value=stats.rows)
+    sink.observe("%s_sql_seconds" % prefix, stats.seconds, labels)
+
+
+@contextlib.contextmanager
+def collect(name, capture_sql=False):
+    """Attributes the SQL statements issued in the block to name.
+
+    Yields the StatementStats, which keep counting until the block exits.
+    Collectors nest, a statement counts towards each active one. Only
+    counts and times are kept unless capture_sql is set.
+    """
+    _listen()
+    stats = StatementStats(name, capture_sql=capture_sql)
+    collectors = _collectors()
+    collectors.append(stats)
+    try:
+        yield stats
+    finally:
+        collectors.remove(stats)
+
+
+@contextlib.contextmanager
+def collected(name):
+    """collect, then publish, if sql_statement_stats is set."""
+    if not CONF.QUARK.sql_statement_stats:
+        yield
+        return
+    with collect(name) as stats:
+        yield
+    publish(stats)
@@ -73,12 +73,12 @@ class UnicornDriver(object):
             LOG.error("register_floating_ip: %s" % msg)
             raise ex.RegisterFloatingIpFailure(id=floating_ip.id)
 
-    def remove_floating_ip(self, floating_ip):
+    def remove_floating_ip(self, floating_ip, session=requests):
         url = "%s/%s" % (CONF.QUARK.floating_ip_base_url,
                          floating_ip.address_readable)
 
         LOG.info("Calling unicorn to remove floating ip: %s" % url)
-        r = requests.delete(url)
+        r = session.delete(url)
 
         if r.status_code == 404:
             LOG.warn("The floating IP %s does not exist in the unicorn system."
@@ -89,6 +89,16 @@ class UnicornDriver(object):
             LOG.error("remove_floating_ip: %s" % msg)
             raise ex.RemoveFloatingIpFailure(id=floating_ip.id)
 
+    def remove_floating_ips(self, floating_ips):
+        # NOTE: unicorn has no bulk delete, but one keep-alive session saves
+        #       a connection per floating IP.
+        session = requests.Session()
+        try:
+            for floating_ip in floating_ips:
+                self.remove_floating_ip(floating_ip, session=session)
+        finally:
+            session.close()
+
     @staticmethod
     def _build_request_body(floating_ip, port, fixed_ip):
         fixed_ips = [{"ip_address": ip.address_readable,
@@ -0,0 +1,156 @@
+# Copyright 2015 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Run-length encoded sets of integers, used to track IP address ranges
+"""
+
+import bisect
+import json
+
+
+class IntervalSet(object):
+    """A sorted set of disjoint, inclusive [first, last] integer intervals.
+
+    Addresses are stored as integers in the same (IPv6 mapped) space as the
+    first_ip and last_ip columns. Adjacent intervals are always merged, so a
+    mostly contiguous address space costs a handful of entries regardless of
+    how many addresses it holds.
+    """
+
+    def __init__(self, intervals=None):
+        self._firsts = []
+        self._lasts = []
+        for first, last in sorted(intervals or []):
+            self.add_range(first, last)
+
+    @classmethod
+    def from_range(cls, first, last):
+        return cls([(first, last)])
+
+    @classmethod
+    def from_json(cls, data):
+        return cls([(long(first), long(last))
+                    for first, last in json.loads(data)])
+
+    def to_json(self):
+        return json.dumps(self.intervals())
+
+    def intervals(self):
+        return [[first, last]
+                for first, last in zip(self._firsts, self._lasts)]
+
+    def __len__(self):
+        return len(self._firsts)
+
+    def __nonzero__(self):
+        return bool(self._firsts)
+
+    def __contains__(self, value):
+        idx = bisect.bisect_right(self._firsts, value) - 1
+        return idx >= 0 and value <= self._lasts[idx]
+
+    def __eq__(self, other):
+        return (isinstance(other, IntervalSet) and
+                self.intervals() == other.intervals())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "IntervalSet(%r)" % self.intervals()
+
+    @property
+    def size(self):
+        return sum(last - first + 1
+                   for first, last in zip(self._firsts, self._lasts))
+
+    def first(self):
+        if not self._firsts:
+            return None
+        return self._firsts[0]
+
+    def next_gap(self, value):
+        """Returns the lowest integer >= value that isn't in the set."""
+        idx = bisect.bisect_right(self._firsts, value) - 1
+        if idx >= 0 and value <= self._lasts[idx]:
+            return self._lasts[idx] + 1
+        return value
+
+    def pop_first(self):
+        """Removes and returns the lowest value in the set, or None."""
+        if not self._firsts:
+            return None
+        value = self._firsts[0]
+        if value == self._lasts[0]:
+            del self._firsts[0]
+            del self._lasts[0]
+        else:
+            self._firsts[0] = value + 1
+        return value
+
+    def add_range(self, first, last):
+        if first > last:
+            return
+        # Find every interval that overlaps or touches [first, last] and
+        # collapse them into a single entry.
+        lo = bisect.bisect_left(self._lasts, first - 1)
+        hi = bisect.bisect_right(self._firsts, last + 1)
+        if lo < hi:
+            first = min(first, self._firsts[lo])
+            last = max(last, self._lasts[hi - 1])
+        self._firsts[lo:hi] = [first]
+        self._lasts[lo:hi] = [last]
+
+    def add(self, value):
+        self.add_range(value, value)
+
+    def remove_range(self, first, last):
+        if first > last:
+            return
+        lo = bisect.bisect_left(self._lasts, first)
+        hi = bisect.bisect_right(self._firsts, last)
+        if lo >= hi:
+            return
+        firsts = []
+        lasts = []
+        if self._firsts[lo] < first:
+            firsts.append(self._firsts[lo])
+            lasts.append(first - 1)
+        if self._lasts[hi - 1] > last:
+            firsts.append(last + 1)
+            lasts.append(self._lasts[hi - 1])
+        self._firsts[lo:hi] = firsts
+        self._lasts[lo:hi] = lasts
+
+    def remove(self, value):
+        self.remove_range(value, value)
+
+
+class FrozenIntervalSet(IntervalSet):
+    """An immutable IntervalSet that can safely be cached and shared."""
+
+    def __init__(self, intervals=None):
+        mutable = IntervalSet(intervals)
+        self._firsts = tuple(mutable._firsts)
+        self._lasts = tuple(mutable._lasts)
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("FrozenIntervalSet is immutable")
+
+    pop_first = add_range = add = remove_range = remove = _immutable
+
+    def __repr__(self):
+        return "FrozenIntervalSet(%r)" % self.intervals()
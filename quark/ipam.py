@@ -17,27 +17,32 @@
 Quark Pluggable IPAM
 """
 
+import collections
 import functools
 import itertools
 import random
 import time
-import uuid
 
 import netaddr
 from neutron.common import exceptions
-from neutron.common import rpc as n_rpc
-from oslo_concurrency import lockutils
 from oslo_config import cfg
 from oslo_db import exception as db_exception
 from oslo_log import log as logging
 from oslo_utils import timeutils
+from sqlalchemy import inspect as sa_inspect
 
 from quark.db import api as db_api
 from quark.db import ip_types
 from quark.db import models
 from quark.drivers import floating_ip_registry as registry
 from quark import exceptions as q_exc
+from quark import ipam_locks
+from quark import ipv6
+from quark import mac_leases
+from quark import metrics
 from quark import network_strategy
+from quark import notifications
+from quark import subnet_selection
 from quark import utils
 
 LOG = logging.getLogger(__name__)
@@ -62,20 +67,58 @@ quark_opts = [
     cfg.BoolOpt("ipam_use_synchronization",
                 default=False,
                 help=_("Configures whether or not to use the experimental"
-                       " semaphore logic around IPAM")),
+                       " semaphore logic around IPAM, see"
+                       " ipam_synchronization_backend")),
     cfg.BoolOpt("ipam_select_subnet_v6_locking",
                 default=True,
                 help=_("Controls whether or not SELECT ... FOR UPDATE is used"
-                       " when retrieving v6 subnets explicitly."))
+                       " when retrieving v6 subnets explicitly.")),
+    cfg.BoolOpt("ipam_use_free_ranges",
+                default=False,
+                help=_("Allocate new v4 addresses from the per-subnet free"
+                       " address index instead of walking"
+                       " next_auto_assign_ip one address at a time.")),
+    cfg.BoolOpt("ipam_optimistic_subnet_cursors",
+                default=False,
+                help=_("Read candidate subnets without SELECT ... FOR UPDATE"
+                       " and claim new v4 addresses with a compare-and-swap"
+                       " on next_auto_assign_ip. Networks can also opt in"
+                       " individually with one of the *_OPTIMISTIC IPAM"
+                       " strategies. Ignored when ipam_use_free_ranges is"
+                       " set, since the free address index needs the lock.")),
+    cfg.IntOpt("ipam_subnet_cursor_stripes",
+               default=0,
+               help=_("Split the unassigned addresses of each v4 subnet"
+                      " into this many stripes, each with its own cursor,"
+                      " so that workers allocating from the same subnet"
+                      " update different rows. Subnets are striped the"
+                      " first time they're allocated from, changing this"
+                      " afterwards doesn't restripe them. 0 disables"
+                      " striping. Ignored when ipam_use_free_ranges is"
+                      " set.")),
+    cfg.BoolOpt("ipam_lazy_subnet_locking",
+                default=False,
+                help=_("Lock and check candidate subnets one at a time, in"
+                       " the order picked by the subnet selection policy,"
+                       " instead of locking every candidate subnet in the"
+                       " segment up front. Ignored when optimistic or"
+                       " striped subnet cursors are in use, since those"
+                       " don't lock subnets at all.")),
+    cfg.BoolOpt("ipam_use_reuse_queue",
+                default=False,
+                help=_("Find deallocated IPs and MACs to reuse through the"
+                       " reuse queue tables, ordered by deallocation time,"
+                       " instead of scanning every deallocated row.")),
+    cfg.BoolOpt("ipam_bulk_deallocation",
+                default=False,
+                help=_("Deallocate and delete the addresses of a port with"
+                       " set-based statements, and remove its floating IPs"
+                       " from the driver in one batch, instead of one"
+                       " address at a time."))
 ]
 
 CONF.register_opts(quark_opts, "QUARK")
 
-# NOTE(mdietz): equivalent to the following line, but converting
-#               v6 addresses in netaddr is very slow.
-# netaddr.IPAddress("::0200:0:0:0").value
-MAGIC_INT = 144115188075855872
-
 
 def no_synchronization(*args, **kwargs):
     def wrap(f):
@@ -91,35 +134,24 @@ def named(sema):
 
 
 if CONF.QUARK.ipam_use_synchronization:
-    synchronized = lockutils.synchronized
+    synchronized = ipam_locks.synchronized
 else:
     synchronized = no_synchronization
 
 
+def _mac_int(mac):
+    if isinstance(mac, (int, long)):
+        return mac
+    return int(netaddr.EUI(mac))
+
+
 def rfc2462_ip(mac, cidr):
     # NOTE(mdietz): see RFC2462
-    int_val = netaddr.IPNetwork(cidr).value
-    mac = netaddr.EUI(mac)
-    LOG.info("Using RFC2462 method to generate a v6 with MAC %s" % mac)
-    int_val += mac.eui64().value
-    int_val ^= MAGIC_INT
-    return int_val
+    return ipv6.rfc2462_ip(_mac_int(mac), ipv6.cidr_network(cidr))
 
 
 def rfc3041_ip(port_id, cidr):
-    if not port_id:
-        random_stuff = uuid.uuid4()
-    else:
-        random_stuff = uuid.UUID(port_id)
-    random.seed(int(random_stuff))
-    int_val = netaddr.IPNetwork(cidr).value
-    while True:
-        rand_bits = random.getrandbits(64)
-        LOG.info("Using RFC3041 method to generate a v6 with bits %s" %
-                 rand_bits)
-        val = int_val + rand_bits
-        val ^= MAGIC_INT
-        yield val
+    return ipv6.rfc3041_ips(port_id, ipv6.cidr_network(cidr))
 
 
 def ip_address_failure(network_id):
@@ -136,11 +168,19 @@ def generate_v6(mac, port_id, cidr):
     #               have a MAC to base our generator on in that case for
     #               example.
     if mac is not None:
-        addr = rfc2462_ip(mac, cidr)
-        yield addr
+        mac = _mac_int(mac)
+        LOG.info("Using RFC2462 method to generate a v6 with MAC %012x" %
+                 mac)
+    return ipv6.generate(mac, port_id, ipv6.cidr_network(cidr))
+
 
-    for addr in rfc3041_ip(port_id, cidr):
-        yield addr
+def _loaded_device_ids(address):
+    # NOTE: a new or just reallocated address has no ports associated yet,
+    #       so don't lazy load the relationship only to find that out.
+    state = sa_inspect(address, raiseerr=False)
+    if state is not None and "ports" in state.unloaded:
+        return []
+    return [p["device_id"] for p in address["ports"]]
 
 
 def ipam_logged(fx):
@@ -158,6 +198,8 @@ class QuarkIPAMLog(object):
     def __init__(self):
         self.entries = {}
         self.success = True
+        self.strategy = None
+        self.network_id = None
 
     def make_entry(self, fx_name):
         if fx_name not in self.entries:
@@ -185,6 +227,10 @@ class QuarkIPAMLog(object):
                 else:
                     fails += 1
         self._output(self.success, total, fails, successes)
+        try:
+            metrics.REGISTRY.get_sink().record_ipam_log(self)
+        except Exception:
+            LOG.exception("Failed to publish IPAM metrics")
 
     def failed(self):
         self.success = False
@@ -196,9 +242,11 @@ class QuarkIPAMLogEntry(object):
         self.log = log
         self.start_time = time.time()
         self.success = True
+        self.reason = None
 
-    def failed(self):
+    def failed(self, reason="error"):
         self.success = False
+        self.reason = reason
 
     def end(self):
         self.end_time = time.time()
@@ -210,6 +258,8 @@ class QuarkIPAMLogEntry(object):
 
 
 class QuarkIpam(object):
+    optimistic_cursors = False
+
     @synchronized(named("allocate_mac_address"))
     def allocate_mac_address(self, context, net_id, port_id, reuse_after,
                              mac_address=None,
@@ -228,12 +278,11 @@ class QuarkIpam(object):
                      " attempt {0} of {1}".format(
                          retry + 1, CONF.QUARK.mac_address_retry_max))
             try:
-                with context.session.begin():
-                    transaction = db_api.transaction_create(context)
+                claim_token = db_api.claim_token_create()
                 update_kwargs = {
                     "deallocated": False,
                     "deallocated_at": None,
-                    "transaction_id": transaction.id
+                    "transaction_id": claim_token
                 }
                 filter_kwargs = {
                     "deallocated": True,
@@ -243,13 +292,18 @@ class QuarkIpam(object):
                 if reuse_after is not None:
                     filter_kwargs["reuse_after"] = reuse_after
                 elevated = context.elevated()
-                result = db_api.mac_address_reallocate(
-                    elevated, update_kwargs, **filter_kwargs)
+                if mac_address is None and CONF.QUARK.ipam_use_reuse_queue:
+                    with elevated.session.begin():
+                        result = db_api.mac_address_reallocate_from_queue(
+                            elevated, update_kwargs, **filter_kwargs)
+                else:
+                    result = db_api.mac_address_reallocate(
+                        elevated, update_kwargs, **filter_kwargs)
                 if not result:
                     break
 
                 reallocated_mac = db_api.mac_address_reallocate_find(
-                    elevated, transaction.id)
+                    elevated, claim_token)
                 if reallocated_mac:
                     dealloc = netaddr.EUI(reallocated_mac["address"])
                     LOG.info("Found a suitable deallocated MAC {0}".format(
@@ -264,6 +318,10 @@ class QuarkIpam(object):
         LOG.info("Couldn't find a suitable deallocated MAC, attempting "
                  "to create a new one")
 
+        if not mac_address and CONF.QUARK.mac_address_lease_block_size > 0:
+            return self._allocate_leased_mac_address(
+                context, net_id, port_id, use_forbidden_mac_range)
+
         # This could fail if a large chunk of MACs were chosen explicitly,
         # but under concurrent load enough MAC creates should iterate without
         # any given thread exhausting its retry count.
@@ -333,7 +391,37 @@ class QuarkIpam(object):
 
         raise exceptions.MacAddressGenerationFailure(net_id=net_id)
 
-    @synchronized(named("reallocate_ip"))
+    def _allocate_leased_mac_address(self, context, net_id, port_id,
+                                     use_forbidden_mac_range=False):
+        for retry in xrange(CONF.QUARK.mac_address_retry_max):
+            leased = mac_leases.MAC_LEASES.pop(
+                context, use_forbidden_mac_range=use_forbidden_mac_range)
+            if not leased:
+                LOG.info("No MAC ranges could be found given the criteria")
+                break
+
+            next_address, mac_address_range_id = leased
+            mac_readable = str(netaddr.EUI(next_address))
+            LOG.info("Attempting to create new leased MAC {0} (step 2 of 2), "
+                     "attempt {1} of {2}".format(
+                         mac_readable, retry + 1,
+                         CONF.QUARK.mac_address_retry_max))
+            try:
+                with context.session.begin():
+                    address = db_api.mac_address_create(
+                        context, address=next_address,
+                        mac_address_range_id=mac_address_range_id)
+                    LOG.info("MAC assignment for port ID {0} completed with "
+                             "address {1}".format(port_id, mac_readable))
+                    return address
+            except Exception:
+                LOG.info("Failed to create new MAC {0}".format(mac_readable))
+                LOG.exception("Error in creating mac. MAC possibly duplicate")
+                continue
+
+        raise exceptions.MacAddressGenerationFailure(net_id=net_id)
+
+    @synchronized(named("reallocate_ip"), scope_arg="net_id")
     def attempt_to_reallocate_ip(self, context, net_id, port_id, reuse_after,
                                  version=None, ip_address=None,
                                  segment_id=None, subnets=None, **kwargs):
@@ -399,31 +487,37 @@ class QuarkIpam(object):
             LOG.info("Attempt {0} of {1}".format(
                 retry + 1, CONF.QUARK.ip_address_retry_max))
             try:
-                with context.session.begin():
-                    transaction = db_api.transaction_create(context)
+                claim_token = db_api.claim_token_create()
                 m = models.IPAddress
                 update_kwargs = {
-                    m.transaction_id: transaction.id,
+                    m.transaction_id: claim_token,
                     m.address_type: kwargs.get("address_type", ip_types.FIXED),
                     m.deallocated: False,
                     m.deallocated_at: None,
                     m.used_by_tenant_id: context.tenant_id,
                     m.allocated_at: timeutils.utcnow(),
                 }
-                result = db_api.ip_address_reallocate(
-                    elevated, update_kwargs, **ip_kwargs)
+                if ("deallocated" in ip_kwargs and
+                        CONF.QUARK.ipam_use_reuse_queue):
+                    with elevated.session.begin():
+                        result = db_api.ip_address_reallocate_from_queue(
+                            elevated, update_kwargs, **ip_kwargs)
+                else:
+                    with elevated.session.begin():
+                        result = db_api.ip_address_reallocate(
+                            elevated, update_kwargs, **ip_kwargs)
                 if not result:
                     LOG.info("Couldn't update any reallocatable addresses "
                              "given the criteria")
                     if attempt:
-                        attempt.failed()
+                        attempt.failed("none_reallocatable")
                     break
 
                 updated_address = db_api.ip_address_reallocate_find(
-                    elevated, transaction.id)
+                    elevated, claim_token)
                 if not updated_address:
                     if attempt:
-                        attempt.failed()
+                        attempt.failed("reallocated_not_found")
                     continue
 
                 LOG.info("Address {0} is reallocated".format(
@@ -450,10 +544,16 @@ class QuarkIpam(object):
                                                  port_id=port_id,
                                                  ip_address=ip_address)))
 
-        ip_policy_cidrs = models.IPPolicy.get_ip_policy_cidrs(subnet)
+        compiled_policy = models.IPPolicy.get_compiled_policy(subnet)
         next_ip = ip_address
         if not next_ip:
-            if subnet["next_auto_assign_ip"] != -1:
+            reserved_ip = subnet.get("reserved_ip")
+            if reserved_ip is not None:
+                # NOTE: reserved from the free address index while the
+                #       subnet was locked in select_subnet.
+                subnet["reserved_ip"] = None
+                next_ip = netaddr.IPAddress(reserved_ip)
+            elif subnet["next_auto_assign_ip"] != -1:
                 next_ip = netaddr.IPAddress(subnet["next_auto_assign_ip"] - 1)
             else:
                 next_ip = netaddr.IPAddress(subnet["last_ip"])
@@ -461,7 +561,7 @@ class QuarkIpam(object):
                 next_ip = next_ip.ipv4()
 
         LOG.info("Next IP is {0}".format(str(next_ip)))
-        if ip_policy_cidrs and next_ip in ip_policy_cidrs and not ip_address:
+        if not ip_address and int(next_ip.ipv6()) in compiled_policy:
             LOG.info("Next IP {0} violates policy".format(str(next_ip)))
             raise q_exc.IPAddressPolicyRetryableFailure(ip_addr=next_ip,
                                                         net_id=net_id)
@@ -480,6 +580,7 @@ class QuarkIpam(object):
             if ip_address:
                 raise exceptions.IpAddressInUse(ip_address=next_ip,
                                                 net_id=net_id)
+            subnet_selection.CONTENTION.record(subnet["id"])
             raise q_exc.IPAddressRetryableFailure(ip_addr=next_ip,
                                                   net_id=net_id)
 
@@ -517,7 +618,7 @@ class QuarkIpam(object):
             if mac:
                 mac = kwargs["mac_address"].get("address")
 
-            ip_policy_cidrs = models.IPPolicy.get_ip_policy_cidrs(subnet)
+            compiled_policy = models.IPPolicy.get_compiled_policy(subnet)
             for tries, ip_address in enumerate(
                     generate_v6(mac, port_id, subnet["cidr"])):
 
@@ -528,16 +629,15 @@ class QuarkIpam(object):
                     LOG.info("Exceeded v6 allocation attempts, bailing")
                     raise ip_address_failure(net_id)
 
-                ip_address = netaddr.IPAddress(ip_address).ipv6()
-                LOG.info("Generated a new v6 address {0}".format(
-                    str(ip_address)))
-
-                if (ip_policy_cidrs is not None and
-                        ip_address in ip_policy_cidrs):
+                if ip_address in compiled_policy:
                     LOG.info("Address {0} excluded by policy".format(
-                        str(ip_address)))
+                        ipv6.to_readable(ip_address)))
                     continue
 
+                ip_address = netaddr.IPAddress(ip_address, version=6)
+                LOG.info("Generated a new v6 address {0}".format(
+                    str(ip_address)))
+
                 try:
                     with context.session.begin():
                         return db_api.ip_address_create(
@@ -594,11 +694,10 @@ class QuarkIpam(object):
             payload = dict(used_by_tenant_id=addr["used_by_tenant_id"],
                            ip_block_id=addr["subnet_id"],
                            ip_address=addr["address_readable"],
-                           device_ids=[p["device_id"] for p in addr["ports"]],
+                           device_ids=_loaded_device_ids(addr),
                            created_at=addr["created_at"])
-            n_rpc.get_notifier("network").info(context,
-                                               "ip_block.address.create",
-                                               payload)
+            notifications.notify(context, "ip_block.address.create",
+                                 payload)
 
     @ipam_logged
     def allocate_ip_address(self, context, new_addresses, net_id, port_id,
@@ -609,6 +708,9 @@ class QuarkIpam(object):
         ip_addresses = ip_addresses or []
 
         ipam_log = kwargs.get('ipam_log', None)
+        if ipam_log:
+            ipam_log.strategy = self.get_name()
+            ipam_log.network_id = net_id
         LOG.info("Starting a new IP address(es) allocation. Strategy "
                  "is {0} - [{1}]".format(
                      self.get_name(),
@@ -632,14 +734,21 @@ class QuarkIpam(object):
                     attempt = ipam_log.make_entry("_try_allocate_ip_address")
                 LOG.info("Allocating new IP attempt {0} of {1}".format(
                     retry + 1, CONF.QUARK.ip_address_retry_max))
-                if not sub:
-                    subnets = self._choose_available_subnet(
-                        elevated, net_id, version, segment_id=segment_id,
-                        ip_address=ip_addr, reallocated_ips=new_addresses)
-                else:
-                    subnets = [self.select_subnet(context, net_id,
-                                                  ip_addr, segment_id,
-                                                  subnet_ids=[sub])]
+                try:
+                    if not sub:
+                        subnets = self._choose_available_subnet(
+                            elevated, net_id, version, segment_id=segment_id,
+                            ip_address=ip_addr, reallocated_ips=new_addresses)
+                    else:
+                        subnets = [self.select_subnet(context, net_id,
+                                                      ip_addr, segment_id,
+                                                      subnet_ids=[sub])]
+                except (exceptions.IpAddressGenerationFailure,
+                        q_exc.ProviderNetworkOutOfIps):
+                    if attempt:
+                        attempt.failed("subnet_full")
+                        attempt.end()
+                    raise
                 LOG.info("Subnet selection returned {0} viable subnet(s) - "
                          "IDs: {1}".format(len(subnets),
                                            ", ".join([str(s["id"])
@@ -650,11 +759,15 @@ class QuarkIpam(object):
                                                     net_id, subnets,
                                                     port_id, reuse_after,
                                                     ip_addr, **kwargs)
-                except q_exc.IPAddressRetryableFailure:
+                except q_exc.IPAddressRetryableFailure as e:
                     LOG.exception("Error in allocating IP")
                     if attempt:
                         LOG.debug("ATTEMPT FAILED")
-                        attempt.failed()
+                        reason = "duplicate"
+                        if isinstance(e,
+                                      q_exc.IPAddressPolicyRetryableFailure):
+                            reason = "policy"
+                        attempt.failed(reason)
                     remaining = CONF.QUARK.ip_address_retry_max - retry - 1
                     if remaining > 0:
                         LOG.info("{0} retries remain, retrying...".format(
@@ -702,7 +815,105 @@ class QuarkIpam(object):
 
         raise ip_address_failure(net_id)
 
-    def deallocate_ip_address(self, context, address):
+    def allocate_ip_addresses_bulk(self, context, port_requests, reuse_after,
+                                   segment_id=None, **kwargs):
+        """Allocates new addresses for many ports at once.
+
+        port_requests is a list of dicts with network_id, port_id and an
+        optional version. v4 requests are grouped by network and satisfied
+        with one subnet lock, a single cursor update per subnet and a
+        multi-row INSERT. Other requests, and any v4 request the bulk path
+        couldn't satisfy, go through allocate_ip_address one port at a time.
+
+        Deallocated addresses are not reused by the bulk path.
+
+        Returns a dict mapping each port_id to its new addresses.
+        """
+        new_addresses = dict((req["port_id"], []) for req in port_requests)
+        v4_requests = collections.OrderedDict()
+        single_requests = []
+        for req in port_requests:
+            if req.get("version") == 4:
+                v4_requests.setdefault(req["network_id"], []).append(req)
+            else:
+                single_requests.append(req)
+
+        bulk_addresses = []
+        for net_id, reqs in v4_requests.items():
+            port_ids = [req["port_id"] for req in reqs]
+            allocated = self._allocate_bulk_from_network(context, net_id,
+                                                         port_ids,
+                                                         segment_id, **kwargs)
+            for req, address in itertools.izip_longest(reqs, allocated):
+                if address:
+                    new_addresses[req["port_id"]].append(address)
+                    bulk_addresses.append(address)
+                else:
+                    single_requests.append(req)
+
+        if bulk_addresses:
+            self._notify_new_addresses(context, bulk_addresses)
+
+        LOG.info("Bulk allocated {0} of {1} requested address(es), "
+                 "allocating {2} individually".format(
+                     len(bulk_addresses), len(port_requests),
+                     len(single_requests)))
+
+        for req in single_requests:
+            self.allocate_ip_address(context, new_addresses[req["port_id"]],
+                                     req["network_id"], req["port_id"],
+                                     reuse_after, segment_id=segment_id,
+                                     version=req.get("version"), **kwargs)
+        return new_addresses
+
+    def _allocate_bulk_from_network(self, context, net_id, port_ids,
+                                    segment_id=None, **kwargs):
+        """Creates up to len(port_ids) new v4 addresses on a network.
+
+        Returns the new addresses in the same order as port_ids. The list
+        may be short if the network ran out of room, and is empty if the
+        INSERT conflicted with a concurrent explicit allocation.
+        """
+        address_type = kwargs.get("address_type", ip_types.FIXED)
+        try:
+            with context.session.begin():
+                subnets = db_api.subnet_find_ordered_by_most_full(
+                    context, net_id, segment_id=segment_id,
+                    scope=db_api.ALL, ip_version=4)
+
+                rows = []
+                for subnet, ips_in_subnet in subnets:
+                    needed = len(port_ids) - len(rows)
+                    if needed <= 0:
+                        break
+
+                    ipnet = netaddr.IPNetwork(subnet["cidr"])
+                    if self._should_mark_subnet_full(context, subnet, ipnet,
+                                                     None, ips_in_subnet):
+                        LOG.info("Marking subnet {0} as full".format(
+                            subnet["id"]))
+                        db_api.subnet_update_set_full(context, subnet)
+                        continue
+
+                    for address in self._reserve_address_range(context,
+                                                               subnet,
+                                                               needed):
+                        rows.append(dict(address=address,
+                                         subnet_id=subnet["id"],
+                                         network_id=net_id,
+                                         version=subnet["ip_version"],
+                                         address_type=address_type))
+
+                return db_api.ip_address_create_bulk(context, rows)
+        except db_exception.DBDuplicateEntry:
+            LOG.info("Bulk allocation on network {0} conflicted with an "
+                     "existing address, falling back to allocating "
+                     "individually".format(net_id))
+            return []
+
+    def deallocate_ip_address(self, context, address, device_ids=None):
+        if device_ids is None:
+            device_ids = [p["device_id"] for p in address["ports"]]
         if address["version"] == 6:
             db_api.ip_address_delete(context, address)
         else:
@@ -712,12 +923,10 @@ class QuarkIpam(object):
         payload = dict(used_by_tenant_id=address["used_by_tenant_id"],
                        ip_block_id=address["subnet_id"],
                        ip_address=address["address_readable"],
-                       device_ids=[p["device_id"] for p in address["ports"]],
+                       device_ids=device_ids,
                        created_at=address["created_at"],
                        deleted_at=timeutils.utcnow())
-        n_rpc.get_notifier("network").info(context,
-                                           "ip_block.address.delete",
-                                           payload)
+        notifications.notify(context, "ip_block.address.delete", payload)
 
     def deallocate_ips_by_port(self, context, port=None, **kwargs):
         ips_to_remove = []
@@ -747,6 +956,9 @@ class QuarkIpam(object):
         #                 the tenant, instead we will disassociate floating's
         #                 fixed IP address.
         context.session.flush()
+        if CONF.QUARK.ipam_bulk_deallocation:
+            self._deallocate_ips_in_bulk(context, ips_to_remove)
+            return
         for ip in ips_to_remove:
             if ip["address_type"] == ip_types.FLOATING:
                 if ip.fixed_ip:
@@ -755,7 +967,30 @@ class QuarkIpam(object):
                     driver.remove_floating_ip(ip)
             else:
                 if len(ip["ports"]) == 0:
-                    self.deallocate_ip_address(context, ip)
+                    self.deallocate_ip_address(context, ip, device_ids=[])
+
+    def _deallocate_ips_in_bulk(self, context, addresses):
+        flips = [ip for ip in addresses
+                 if ip["address_type"] == ip_types.FLOATING]
+        disassociated = db_api.floating_ip_disassociate_fixed_ips(context,
+                                                                  flips)
+        if disassociated:
+            driver = registry.DRIVER_REGISTRY.get_driver()
+            driver.remove_floating_ips(disassociated)
+
+        removed = db_api.ip_address_deallocate_bulk(
+            context, [ip for ip in addresses
+                      if ip["address_type"] != ip_types.FLOATING])
+        deleted_at = timeutils.utcnow()
+        for address in removed:
+            payload = dict(used_by_tenant_id=address["used_by_tenant_id"],
+                           ip_block_id=address["subnet_id"],
+                           ip_address=address["address_readable"],
+                           device_ids=[],
+                           created_at=address["created_at"],
+                           deleted_at=deleted_at)
+            notifications.notify(context, "ip_block.address.delete",
+                                 payload)
 
     # NCP-1509(roaet):
     # - started using admin_context due to tenant not claiming when realloc
@@ -774,20 +1009,18 @@ class QuarkIpam(object):
                                       deallocated_at=timeutils.utcnow())
 
     def _select_subnet(self, context, net_id, ip_address, segment_id,
-                       subnet_ids, **filters):
+                       subnet_ids, lock_subnets=True, **filters):
         # NCP-1480: Don't need to lock V6 subnets, since we don't use
         # next_auto_assign_ip for them. We already uniquely identified
         # the V6 we're going to get by generating a MAC in a previous step.
         # Also note that this only works under BOTH or BOTH_REQUIRED. ANY
         # does not pass an ip_version
-        lock_subnets = True
         if (not CONF.QUARK.ipam_select_subnet_v6_locking and
                 "ip_version" in filters and
                 int(filters["ip_version"]) == 6):
             lock_subnets = False
 
         select_api = db_api.subnet_find_ordered_by_most_full
-        # TODO(mdietz): Add configurable, alternate subnet selection here
         subnets = select_api(context, net_id, lock_subnets=lock_subnets,
                              segment_id=segment_id, scope=db_api.ALL,
                              subnet_id=subnet_ids, **filters)
@@ -796,6 +1029,9 @@ class QuarkIpam(object):
             LOG.info("No subnets found given the search criteria!")
             return
 
+        policy = subnet_selection.REGISTRY.get_policy(net_id)
+        subnets = policy.order(context, subnets)
+
         # TODO(mdietz): Making this into an iterator because we want to move
         #               to selecting 1 subnet at a time and paginating rather
         #               than the bulk fetch. Without locks, we need to
@@ -807,6 +1043,14 @@ class QuarkIpam(object):
 
     def _should_mark_subnet_full(self, context, subnet, ipnet, ip_address,
                                  ips_in_subnet):
+        if self._use_cursor_stripes() and subnet["ip_version"] == 4:
+            # NOTE: once a subnet is striped its own cursor stays put, the
+            #       subnet is only full when every stripe is.
+            cursors = subnet["cursors"]
+            if cursors and all(c["next_auto_assign_ip"] > c["last_ip"]
+                               for c in cursors):
+                return True
+
         ip = subnet["next_auto_assign_ip"]
         # NOTE(mdietz): When atomically updated, this probably
         #               doesn't need the lower bounds check but
@@ -827,6 +1071,214 @@ class QuarkIpam(object):
             return False
         return True
 
+    def _reserve_from_free_ranges(self, context, subnet, ip_address=None):
+        """Takes an address out of the subnet's free address index.
+
+        Returns the reserved address, or None if the index is exhausted.
+        Explicitly requested addresses are only removed from an index that
+        has already been built, so that they aren't handed out again later.
+        """
+        if ip_address:
+            if subnet["_free_ranges"] is None:
+                return
+            free_ranges = db_api.subnet_free_ranges_find(context, subnet)
+            address = int(netaddr.IPAddress(ip_address).ipv6())
+            if address in free_ranges:
+                free_ranges.remove(address)
+                db_api.subnet_update_set_free_ranges(context, subnet,
+                                                     free_ranges,
+                                                     reserved=[address])
+            return address
+
+        free_ranges = db_api.subnet_free_ranges_find(context, subnet)
+        address = free_ranges.pop_first()
+        db_api.subnet_update_set_free_ranges(
+            context, subnet, free_ranges,
+            reserved=[] if address is None else [address])
+        if address is not None:
+            subnet["reserved_ip"] = address
+        return address
+
+    def _reserve_address_range(self, context, subnet, count):
+        """Reserves up to count new v4 addresses from a locked subnet.
+
+        Addresses excluded by the subnet's IP policy are skipped over in
+        place rather than being handed out and retried.
+        """
+        if CONF.QUARK.ipam_use_free_ranges:
+            free_ranges = db_api.subnet_free_ranges_find(context, subnet)
+            values = []
+            while free_ranges and len(values) < count:
+                values.append(free_ranges.pop_first())
+            db_api.subnet_update_set_free_ranges(context, subnet, free_ranges,
+                                                 reserved=values)
+            return [netaddr.IPAddress(value).ipv4() for value in values]
+
+        if self._use_cursor_stripes():
+            return self._reserve_range_from_cursor_stripes(context, subnet,
+                                                           count)
+
+        compiled_policy = models.IPPolicy.get_compiled_policy(subnet)
+        start = cursor = subnet["next_auto_assign_ip"]
+        addresses = []
+        while len(addresses) < count and cursor <= subnet["last_ip"]:
+            if cursor not in compiled_policy:
+                addresses.append(netaddr.IPAddress(cursor).ipv4())
+            cursor += 1
+
+        if cursor > start:
+            db_api.subnet_update_next_auto_assign_ip(context, subnet,
+                                                     increment=cursor - start)
+        return addresses
+
+    def _reserve_range_from_cursor_stripes(self, context, subnet, count):
+        """Reserves up to count new v4 addresses from the cursor stripes.
+
+        Once a subnet is striped, its own next_auto_assign_ip no longer
+        tracks what's been handed out, so bulk allocation takes whole runs
+        off the stripes instead, starting at a random one. Runs are taken
+        with a compare-and-swap on each stripe, since single allocations
+        advance stripes without holding the subnet lock.
+        """
+        cursors = db_api.subnet_cursors_find(context, subnet)
+        if not cursors:
+            cursors = db_api.subnet_cursors_create(
+                context, subnet, CONF.QUARK.ipam_subnet_cursor_stripes)
+            context.session.flush()
+            context.session.expire(subnet, ["cursors"])
+        compiled_policy = models.IPPolicy.get_compiled_policy(subnet)
+        start = random.randrange(max(len(cursors), 1))
+        addresses = []
+        for offset in xrange(len(cursors)):
+            cursor = cursors[(start + offset) % len(cursors)]
+            context.session.refresh(cursor)
+            first = position = cursor["next_auto_assign_ip"]
+            run = []
+            while (len(addresses) + len(run) < count and
+                   position <= cursor["last_ip"]):
+                if position not in compiled_policy:
+                    run.append(netaddr.IPAddress(position).ipv4())
+                position += 1
+            if position > first and db_api.subnet_cursor_update_range(
+                    context, cursor, first, position):
+                addresses.extend(run)
+            if len(addresses) >= count:
+                break
+        return addresses
+
+    def _advance_next_auto_assign_ip(self, context, subnet):
+        """Moves the subnet's cursor to the next assignable address.
+
+        Each update jumps a whole policy CIDR at once. Adjacent CIDRs aren't
+        merged in SQL, so keep going while the address the cursor now points
+        past is still excluded. Returns False if the subnet was marked full
+        underneath us.
+        """
+        compiled_policy = models.IPPolicy.get_compiled_policy(subnet)
+        while True:
+            if not db_api.subnet_update_next_auto_assign_ip(context, subnet):
+                return False
+            context.session.refresh(subnet)
+            next_ip = subnet["next_auto_assign_ip"] - 1
+            if next_ip > subnet["last_ip"] or next_ip not in compiled_policy:
+                return True
+
+    def _claim_next_auto_assign_ip(self, context, subnet):
+        """Claims the next assignable v4 address of an unlocked subnet.
+
+        The cursor is advanced with a compare-and-swap, each attempt in its
+        own transaction so that the reload after losing a race sees the
+        winner's cursor. Returns False if the subnet filled up.
+        """
+        compiled_policy = models.IPPolicy.get_compiled_policy(subnet)
+        for retry in xrange(CONF.QUARK.ip_address_retry_max):
+            with context.session.begin():
+                if retry:
+                    context.session.refresh(subnet)
+                expected = subnet["next_auto_assign_ip"]
+                if expected == -1:
+                    return False
+
+                next_ip = compiled_policy.next_gap(expected)
+                if next_ip > subnet["last_ip"]:
+                    LOG.info("Skipping policy exclusions ran past the end "
+                             "of subnet {0}, marking as full".format(
+                                 subnet["id"]))
+                    db_api.subnet_update_set_full(context, subnet)
+                    return False
+
+                if db_api.subnet_update_next_auto_assign_ip(
+                        context, subnet, increment=next_ip - expected + 1,
+                        expected=expected):
+                    subnet["reserved_ip"] = next_ip
+                    return True
+            LOG.info("Lost the race for next_auto_assign_ip {0} on subnet "
+                     "{1}, retrying".format(expected, subnet["id"]))
+            subnet_selection.CONTENTION.record(subnet["id"])
+        return False
+
+    def _get_cursor_stripes(self, context, subnet):
+        """Returns the subnet's cursor stripes, striping it on first use."""
+        with context.session.begin():
+            cursors = db_api.subnet_cursors_find(context, subnet)
+        if cursors:
+            return cursors
+
+        try:
+            with context.session.begin():
+                cursors = db_api.subnet_cursors_create(
+                    context, subnet, CONF.QUARK.ipam_subnet_cursor_stripes)
+        except db_exception.DBDuplicateEntry:
+            LOG.info("Subnet {0} was striped by another worker".format(
+                subnet["id"]))
+            with context.session.begin():
+                cursors = db_api.subnet_cursors_find(context, subnet)
+        context.session.expire(subnet, ["cursors"])
+        return cursors
+
+    def _claim_from_cursor_stripes(self, context, subnet):
+        """Claims the next assignable v4 address from a cursor stripe.
+
+        Each call starts at a random stripe, so concurrent allocations,
+        even from greenthreads of one worker, mostly update different rows.
+        Moves on to the next stripe when one runs out, and marks the subnet
+        full once all of them have. Returns False if the subnet filled up.
+        """
+        cursors = self._get_cursor_stripes(context, subnet)
+        compiled_policy = models.IPPolicy.get_compiled_policy(subnet)
+        start = random.randrange(max(len(cursors), 1))
+        for offset in xrange(len(cursors)):
+            cursor = cursors[(start + offset) % len(cursors)]
+            with context.session.begin():
+                # NOTE: keep going while the claimed address is excluded,
+                #       adjacent policy CIDRs aren't merged in SQL.
+                while db_api.subnet_cursor_update_next_auto_assign_ip(
+                        context, cursor, subnet["ip_policy_id"]):
+                    context.session.refresh(cursor)
+                    next_ip = cursor["next_auto_assign_ip"] - 1
+                    if next_ip > cursor["last_ip"]:
+                        break
+                    if next_ip not in compiled_policy:
+                        subnet["reserved_ip"] = next_ip
+                        return True
+
+        LOG.info("Every cursor stripe of subnet {0} is exhausted, marking "
+                 "as full".format(subnet["id"]))
+        with context.session.begin():
+            db_api.subnet_update_set_full(context, subnet)
+        return False
+
+    def _use_cursor_stripes(self):
+        if CONF.QUARK.ipam_use_free_ranges:
+            return False
+        return CONF.QUARK.ipam_subnet_cursor_stripes > 0
+
+    def _use_optimistic_cursors(self):
+        if CONF.QUARK.ipam_use_free_ranges:
+            return False
+        return (self.optimistic_cursors or
+                CONF.QUARK.ipam_optimistic_subnet_cursors)
+
     def _ip_in_subnet(self, subnet, subnet_ids, ipnet, ip_address):
         if ip_address:
             requested_ip = netaddr.IPAddress(ip_address)
@@ -849,52 +1301,179 @@ class QuarkIpam(object):
                                 segment_id=segment_id, subnet_ids=subnet_ids,
                                 ip_version=filters.get("ip_version"))))
 
+        if self._use_optimistic_cursors() or self._use_cursor_stripes():
+            return self._select_subnet_unlocked(context, net_id, ip_address,
+                                                segment_id, subnet_ids,
+                                                **filters)
+
+        if self._use_lazy_subnet_locking():
+            return self._select_subnet_lazily(context, net_id, ip_address,
+                                              segment_id, subnet_ids,
+                                              **filters)
+
         # TODO(mdietz): Invert the iterator and the session, should only be
         #               one subnet per attempt. We should also only be fetching
         #               the subnet and usage when we need to. Otherwise
         #               we're locking every subnet for a segment, and once
         #               we stop locking, we're looking at stale data.
+        #               See ipam_lazy_subnet_locking.
         with context.session.begin():
             for subnet, ips_in_subnet in self._select_subnet(context, net_id,
                                                              ip_address,
                                                              segment_id,
                                                              subnet_ids,
                                                              **filters):
-                ipnet = netaddr.IPNetwork(subnet["cidr"])
-                LOG.info("Trying subnet ID: {0} - CIDR: {1}".format(
-                    subnet["id"], subnet["_cidr"]))
+                viable = self._try_locked_subnet(context, subnet,
+                                                 ips_in_subnet, subnet_ids,
+                                                 ip_address)
+                if viable is None:
+                    # This means the subnet was marked full
+                    # while we were checking out policies.
+                    # Fall out and go back to the outer retry
+                    # loop.
+                    return
+                if viable:
+                    return subnet
+
+    def _try_locked_subnet(self, context, subnet, ips_in_subnet, subnet_ids,
+                           ip_address):
+        """Checks a subnet locked by the current transaction, reserving its
+        next v4 address if it's viable.
+
+        Returns True if the subnet is viable, False to move on to the next
+        candidate, or None if the subnet filled up while skipping over
+        policy exclusions.
+        """
+        ipnet = netaddr.IPNetwork(subnet["cidr"])
+        subnet["reserved_ip"] = None
+        LOG.info("Trying subnet ID: {0} - CIDR: {1}".format(
+            subnet["id"], subnet["_cidr"]))
 
-                if not self._ip_in_subnet(subnet, subnet_ids, ipnet,
-                                          ip_address):
-                    continue
+        if not self._ip_in_subnet(subnet, subnet_ids, ipnet, ip_address):
+            return False
+
+        if self._should_mark_subnet_full(context, subnet, ipnet, ip_address,
+                                         ips_in_subnet):
+            LOG.info("Marking subnet {0} as full".format(subnet["id"]))
+            updated = db_api.subnet_update_set_full(context, subnet)
+
+            # Ensure the session is aware of the changes to the subnet
+            if updated:
+                context.session.refresh(subnet)
+            return False
+
+        use_free_ranges = (CONF.QUARK.ipam_use_free_ranges and
+                           subnet["ip_version"] == 4)
+        if use_free_ranges and ip_address:
+            self._reserve_from_free_ranges(context, subnet,
+                                           ip_address=ip_address)
+        elif use_free_ranges:
+            if self._reserve_from_free_ranges(context, subnet) is None:
+                LOG.info("Free address index for subnet {0} is exhausted, "
+                         "marking as full".format(subnet["id"]))
+                if db_api.subnet_update_set_full(context, subnet):
+                    context.session.refresh(subnet)
+                return False
+        elif not ip_address and subnet["ip_version"] == 4:
+            if not self._advance_next_auto_assign_ip(context, subnet):
+                return None
+
+            if subnet["next_auto_assign_ip"] - 1 > subnet["last_ip"]:
+                LOG.info("Skipping policy exclusions ran past the end of "
+                         "subnet {0}, marking as full".format(subnet["id"]))
+                if db_api.subnet_update_set_full(context, subnet):
+                    context.session.refresh(subnet)
+                return False
+
+        LOG.info("Subnet {0} - {1} {2} looks viable, returning".format(
+            subnet["id"], subnet["_cidr"],
+            subnet["reserved_ip"] or subnet["next_auto_assign_ip"]))
+        return True
+
+    def _use_lazy_subnet_locking(self):
+        return CONF.QUARK.ipam_lazy_subnet_locking
 
-                if self._should_mark_subnet_full(context, subnet, ipnet,
-                                                 ip_address, ips_in_subnet):
-                    LOG.info("Marking subnet {0} as full".format(subnet["id"]))
-                    updated = db_api.subnet_update_set_full(context, subnet)
+    def _select_subnet_lazily(self, context, net_id, ip_address, segment_id,
+                              subnet_ids=None, **filters):
+        """Variant of select_subnet that locks one candidate at a time.
 
-                    # Ensure the session is aware of the changes to the subnet
-                    if updated:
-                        context.session.refresh(subnet)
+        Candidates are read without locks and tried in the order picked by
+        the subnet selection policy. Each one is locked and re-read in its
+        own transaction, which ends before the next candidate is locked.
+        """
+        with context.session.begin():
+            candidates = list(self._select_subnet(context, net_id,
+                                                  ip_address, segment_id,
+                                                  subnet_ids,
+                                                  lock_subnets=False,
+                                                  **filters))
+
+        lock_subnets = (CONF.QUARK.ipam_select_subnet_v6_locking or
+                        int(filters.get("ip_version", 4)) != 6)
+        for candidate, _ in candidates:
+            with context.session.begin():
+                locked = db_api.subnet_find_ordered_by_most_full(
+                    context, net_id, lock_subnets=lock_subnets,
+                    segment_id=segment_id, subnet_id=[candidate["id"]],
+                    populate_existing=True, **filters).first()
+                if not locked:
+                    LOG.info("Subnet {0} filled up or was disabled since it "
+                             "was selected, skipping".format(candidate["id"]))
                     continue
 
-                if not ip_address and subnet["ip_version"] == 4:
-                    auto_inc = db_api.subnet_update_next_auto_assign_ip
-                    updated = auto_inc(context, subnet)
+                subnet, ips_in_subnet = locked
+                # NOTE: unlike select_subnet, a subnet that fills up while
+                #       skipping policy exclusions only costs this
+                #       candidate, not the attempt.
+                if self._try_locked_subnet(context, subnet, ips_in_subnet,
+                                           subnet_ids, ip_address):
+                    return subnet
+
+    def _select_subnet_unlocked(self, context, net_id, ip_address,
+                                segment_id, subnet_ids=None, **filters):
+        """Variant of select_subnet that doesn't lock candidate subnets.
+
+        Candidates are read without SELECT ... FOR UPDATE. The only write
+        contended between workers is claiming the next address, either a
+        compare-and-swap on the chosen subnet's next_auto_assign_ip or an
+        update of one of its cursor stripes.
+        """
+        with context.session.begin():
+            candidates = list(self._select_subnet(context, net_id,
+                                                  ip_address, segment_id,
+                                                  subnet_ids,
+                                                  lock_subnets=False,
+                                                  **filters))
+
+        for subnet, ips_in_subnet in candidates:
+            ipnet = netaddr.IPNetwork(subnet["cidr"])
+            subnet["reserved_ip"] = None
+            LOG.info("Trying subnet ID: {0} - CIDR: {1}".format(
+                subnet["id"], subnet["_cidr"]))
 
-                    if updated:
-                        context.session.refresh(subnet)
-                    else:
-                        # This means the subnet was marked full
-                        # while we were checking out policies.
-                        # Fall out and go back to the outer retry
-                        # loop.
-                        return
+            if not self._ip_in_subnet(subnet, subnet_ids, ipnet, ip_address):
+                continue
 
-                LOG.info("Subnet {0} - {1} {2} looks viable, "
-                         "returning".format(subnet["id"], subnet["_cidr"],
-                                            subnet["next_auto_assign_ip"]))
-                return subnet
+            if self._should_mark_subnet_full(context, subnet, ipnet,
+                                             ip_address, ips_in_subnet):
+                LOG.info("Marking subnet {0} as full".format(subnet["id"]))
+                with context.session.begin():
+                    db_api.subnet_update_set_full(context, subnet)
+                continue
+
+            if not ip_address and subnet["ip_version"] == 4:
+                if self._use_cursor_stripes():
+                    claimed = self._claim_from_cursor_stripes(context, subnet)
+                else:
+                    claimed = self._claim_next_auto_assign_ip(context, subnet)
+                if not claimed:
+                    continue
+
+            LOG.info("Subnet {0} - {1} {2} looks viable, "
+                     "returning".format(subnet["id"], subnet["_cidr"],
+                                        subnet["reserved_ip"] or
+                                        subnet["next_auto_assign_ip"]))
+            return subnet
 
 
 class QuarkIpamANY(QuarkIpam):
@@ -993,12 +1572,40 @@ class QuarkIpamBOTHREQ(QuarkIpamBOTH):
         return subnets
 
 
+class QuarkIpamANYOptimistic(QuarkIpamANY):
+    optimistic_cursors = True
+
+    @classmethod
+    def get_name(self):
+        return "ANY_OPTIMISTIC"
+
+
+class QuarkIpamBOTHOptimistic(QuarkIpamBOTH):
+    optimistic_cursors = True
+
+    @classmethod
+    def get_name(self):
+        return "BOTH_OPTIMISTIC"
+
+
+class QuarkIpamBOTHREQOptimistic(QuarkIpamBOTHREQ):
+    optimistic_cursors = True
+
+    @classmethod
+    def get_name(self):
+        return "BOTH_REQUIRED_OPTIMISTIC"
+
+
 class IpamRegistry(object):
     def __init__(self):
         self.strategies = {
             QuarkIpamANY.get_name(): QuarkIpamANY(),
             QuarkIpamBOTH.get_name(): QuarkIpamBOTH(),
-            QuarkIpamBOTHREQ.get_name(): QuarkIpamBOTHREQ()}
+            QuarkIpamBOTHREQ.get_name(): QuarkIpamBOTHREQ(),
+            QuarkIpamANYOptimistic.get_name(): QuarkIpamANYOptimistic(),
+            QuarkIpamBOTHOptimistic.get_name(): QuarkIpamBOTHOptimistic(),
+            QuarkIpamBOTHREQOptimistic.get_name():
+                QuarkIpamBOTHREQOptimistic()}
 
     def is_valid_strategy(self, strategy_name):
         if strategy_name in self.strategies:
@@ -0,0 +1,231 @@
+# Copyright 2015 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Pluggable lock backends for IPAM synchronization
+"""
+
+import contextlib
+import functools
+import inspect
+import threading
+import time
+import uuid
+
+from oslo_concurrency import lockutils
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from quark import exceptions as q_exc
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+
+quark_opts = [
+    cfg.StrOpt("ipam_synchronization_backend",
+               default="local",
+               help=_("Lock backend used when ipam_use_synchronization is"
+                      " set. local only serializes workers on the same"
+                      " host, redis serializes across hosts with lease"
+                      " locks in the Redis master and memory is an in"
+                      " process stand-in for the redis backend.")),
+    cfg.IntOpt("ipam_lock_ttl_ms",
+               default=5000,
+               help=_("Milliseconds a redis or memory lease lock is held"
+                      " for before it expires on its own.")),
+    cfg.FloatOpt("ipam_lock_acquire_timeout",
+                 default=2.0,
+                 help=_("Seconds to wait for a redis or memory lease lock."
+                        " The locks are advisory, IPAM carries on without"
+                        " the lock once this runs out."))
+]
+
+CONF.register_opts(quark_opts, "QUARK")
+
+# NOTE: seconds between attempts to take a contended lease.
+ACQUIRE_INTERVAL = 0.01
+
+
+class Lease(object):
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+
+class LockBackend(object):
+    @classmethod
+    def get_name(self):
+        raise NotImplementedError()
+
+    @contextlib.contextmanager
+    def lock(self, name):
+        """Holds the named lock for the duration of the block.
+
+        Yields the Lease, or None when the backend has no leases or
+        couldn't take the lock in time.
+        """
+        raise NotImplementedError()
+
+
+class LocalLockBackend(LockBackend):
+    """Host local locks, as ipam_use_synchronization has always used."""
+
+    @classmethod
+    def get_name(self):
+        return "local"
+
+    @contextlib.contextmanager
+    def lock(self, name):
+        with lockutils.lock(name):
+            yield
+
+
+class LeaseLockBackend(LockBackend):
+    """Advisory lease locks.
+
+    Subclasses implement _acquire and _release. Taking a lease is retried
+    until ipam_lock_acquire_timeout runs out, after which the block runs
+    without it. Backend errors are logged and treated the same way, since
+    the database remains the arbiter of what's allocated. A holder whose
+    lease expired isn't stopped from writing, the locks only cut down on
+    contention.
+    """
+
+    def _acquire(self, name, value, ttl_ms):
+        raise NotImplementedError()
+
+    def _release(self, name, value):
+        raise NotImplementedError()
+
+    def _take(self, name):
+        value = uuid.uuid4().hex
+        deadline = time.time() + CONF.QUARK.ipam_lock_acquire_timeout
+        while True:
+            if self._acquire(name, value, CONF.QUARK.ipam_lock_ttl_ms):
+                return Lease(name, value)
+            if time.time() >= deadline:
+                LOG.warn("Timed out waiting for IPAM lock %s, carrying on "
+                         "without it" % name)
+                return
+            time.sleep(ACQUIRE_INTERVAL)
+
+    @contextlib.contextmanager
+    def lock(self, name):
+        try:
+            lease = self._take(name)
+        except q_exc.RedisConnectionFailure:
+            LOG.exception("Couldn't take IPAM lock %s, carrying on without "
+                          "it" % name)
+            lease = None
+
+        try:
+            yield lease
+        finally:
+            if lease:
+                try:
+                    if not self._release(name, lease.value):
+                        LOG.warn("IPAM lock %s expired while held" % name)
+                except q_exc.RedisConnectionFailure:
+                    LOG.exception("Couldn't release IPAM lock %s" % name)
+
+
+class MemoryLockBackend(LeaseLockBackend):
+    """In process equivalent of RedisLockBackend, for tests."""
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._leases = {}
+
+    @classmethod
+    def get_name(self):
+        return "memory"
+
+    def _acquire(self, name, value, ttl_ms):
+        now = time.time()
+        with self._mutex:
+            held = self._leases.get(name)
+            if held and held[1] > now:
+                return False
+            self._leases[name] = (value, now + ttl_ms / 1000.0)
+            return True
+
+    def _release(self, name, value):
+        with self._mutex:
+            held = self._leases.get(name)
+            if not held or held[0] != value or held[1] <= time.time():
+                return False
+            del self._leases[name]
+            return True
+
+
+class RedisLockBackend(LeaseLockBackend):
+    def __init__(self):
+        self._client = None
+
+    @classmethod
+    def get_name(self):
+        return "redis"
+
+    def _get_client(self):
+        if not self._client:
+            # NOTE: imported here so the local backend doesn't need
+            #       twiceredis installed.
+            from quark.cache import lock_client
+            self._client = lock_client.LockClient()
+        return self._client
+
+    def _acquire(self, name, value, ttl_ms):
+        return self._get_client().acquire(name, value, ttl_ms)
+
+    def _release(self, name, value):
+        return self._get_client().release(name, value)
+
+
+class LockBackendRegistry(object):
+    def __init__(self):
+        self.backends = {
+            LocalLockBackend.get_name(): LocalLockBackend(),
+            MemoryLockBackend.get_name(): MemoryLockBackend(),
+            RedisLockBackend.get_name(): RedisLockBackend()}
+
+    def get_backend(self, backend_name=None):
+        backend_name = backend_name or CONF.QUARK.ipam_synchronization_backend
+        if backend_name in self.backends:
+            return self.backends[backend_name]
+        raise Exception("IPAM lock backend %s is not registered." %
+                        backend_name)
+
+
+REGISTRY = LockBackendRegistry()
+
+
+def synchronized(name, scope_arg=None):
+    """Decorator holding the named IPAM lock around each call.
+
+    With scope_arg, the value of that argument of the decorated function is
+    appended to the lock name. Keying by network this way keeps unrelated
+    networks from serializing against each other.
+    """
+    def wrap(f):
+        @functools.wraps(f)
+        def inner(*args, **kwargs):
+            lock_name = name
+            if scope_arg:
+                scope = inspect.getcallargs(f, *args, **kwargs)[scope_arg]
+                lock_name = "%s.%s" % (name, scope)
+            with REGISTRY.get_backend().lock(lock_name):
+                return f(*args, **kwargs)
+        return inner
+    return wrap
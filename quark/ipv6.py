@@ -0,0 +1,82 @@
+# Copyright 2015 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Integer only IPv6 address generation, see RFC2462 and RFC3041
+"""
+
+import binascii
+import random
+import socket
+import uuid
+
+# NOTE: the universal/local bit of an interface identifier, equivalent to
+#       netaddr.IPAddress("::0200:0:0:0").value
+MAGIC_INT = 1 << 57
+
+V6_MASK = (1 << 128) - 1
+
+
+def network(value, prefix_len):
+    """Masks a 128 bit address down to its first prefix_len bits."""
+    return value & (V6_MASK ^ (V6_MASK >> prefix_len))
+
+
+def cidr_network(cidr):
+    """Returns the integer network address of a v6 CIDR string."""
+    address, _, prefix_len = cidr.partition("/")
+    value = int(binascii.hexlify(socket.inet_pton(socket.AF_INET6,
+                                                  address)), 16)
+    return network(value, int(prefix_len or 128))
+
+
+def to_readable(value):
+    return socket.inet_ntop(socket.AF_INET6,
+                            binascii.unhexlify("%032x" % value))
+
+
+def eui64(mac):
+    """EUI-64 of a 48 bit MAC, with FFFE inserted between OUI and NIC."""
+    return ((mac >> 24) << 40) | (0xFFFE << 24) | (mac & 0xFFFFFF)
+
+
+def rfc2462_ip(mac, prefix):
+    return (prefix + eui64(mac)) ^ MAGIC_INT
+
+
+def rfc3041_ips(port_id, prefix):
+    """Yields addresses with random interface identifiers.
+
+    The identifiers come from a private PRNG seeded with port_id, so a port
+    gets the same sequence every time without touching the global random
+    module's state.
+    """
+    seed = uuid.UUID(port_id) if port_id else uuid.uuid4()
+    rand = random.Random(seed.int)
+    while True:
+        yield (prefix + rand.getrandbits(64)) ^ MAGIC_INT
+
+
+def generate(mac, port_id, prefix):
+    """Yields candidate addresses for a port within prefix.
+
+    The MAC derived address comes first when there is a MAC, followed by an
+    endless sequence of random ones.
+    """
+    if mac is not None:
+        yield rfc2462_ip(mac, prefix)
+
+    for value in rfc3041_ips(port_id, prefix):
+        yield value
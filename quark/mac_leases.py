@@ -0,0 +1,156 @@
+# Copyright 2015 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Worker local leases of new MAC addresses
+"""
+
+import atexit
+import threading
+import time
+
+from neutron import context as neutron_context
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from quark.db import api as db_api
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+
+quark_opts = [
+    cfg.IntOpt("mac_address_lease_block_size",
+               default=0,
+               help=_("Number of consecutive new MAC addresses each worker"
+                      " takes from a MAC range at a time and hands out from"
+                      " memory, e.g. 256. 0 takes them one at a time from"
+                      " the range.")),
+    cfg.IntOpt("mac_address_lease_ttl",
+               default=300,
+               help=_("Seconds a worker may hold on to a MAC address lease"
+                      " before handing the unused addresses back."))
+]
+
+CONF.register_opts(quark_opts, "QUARK")
+
+
+class MacLease(object):
+    """A block of never assigned MACs, [next_address, last_address]."""
+
+    def __init__(self, lease_id, mac_address_range_id, first_address,
+                 last_address, ttl):
+        self.id = lease_id
+        self.mac_address_range_id = mac_address_range_id
+        self.next_address = first_address
+        self.last_address = last_address
+        self.expires_at = time.time() + ttl
+
+    @property
+    def exhausted(self):
+        return self.next_address > self.last_address
+
+    @property
+    def expired(self):
+        return time.time() >= self.expires_at
+
+    def pop(self):
+        address = self.next_address
+        self.next_address += 1
+        return address
+
+
+class MacLeasePool(object):
+    """Per worker pool of MAC address leases.
+
+    Taking a block of MACs off a range costs one locked read and update of
+    the range row, after which each new MAC is only an INSERT. Leases are
+    kept separately for ports that may and may not use forbidden ranges.
+    Each is recorded in quark_mac_address_leases too, so that the block is
+    reclaimed if the worker dies holding it.
+    """
+
+    def __init__(self):
+        self._leases = {}
+        self._lock = threading.Lock()
+        self._registered = False
+
+    def pop(self, context, use_forbidden_mac_range=False):
+        """Returns (address, mac_address_range_id), or None if no range
+        has any addresses left to lease.
+        """
+        with self._lock:
+            lease = self._leases.get(use_forbidden_mac_range)
+            if lease and (lease.exhausted or lease.expired):
+                del self._leases[use_forbidden_mac_range]
+                self._return_lease(context, lease)
+                lease = None
+
+            if not lease:
+                lease = self._take_lease(context, use_forbidden_mac_range)
+                if not lease:
+                    return
+                self._leases[use_forbidden_mac_range] = lease
+            return lease.pop(), lease.mac_address_range_id
+
+    def release_all(self, context=None):
+        """Hands every unused leased address back."""
+        context = context or neutron_context.get_admin_context()
+        with self._lock:
+            leases = self._leases.values()
+            self._leases = {}
+            for lease in leases:
+                try:
+                    self._return_lease(context, lease)
+                except Exception:
+                    LOG.exception("Failed to return MAC address lease %s-%s",
+                                  lease.next_address, lease.last_address)
+
+    def _take_lease(self, context, use_forbidden_mac_range):
+        with context.session.begin():
+            leased = db_api.mac_address_range_lease_block(
+                context, CONF.QUARK.mac_address_lease_block_size,
+                CONF.QUARK.mac_address_lease_ttl,
+                use_forbidden_mac_range=use_forbidden_mac_range)
+        if not leased:
+            LOG.info("No MAC ranges with unassigned addresses to lease")
+            return
+
+        rng, lease = leased
+        LOG.info("Leased MAC addresses {0}-{1} from range {2}".format(
+            lease["first_address"], lease["last_address"], rng["cidr"]))
+        if not self._registered:
+            atexit.register(self.release_all)
+            self._registered = True
+        return MacLease(lease["id"], rng["id"], lease["first_address"],
+                        lease["last_address"],
+                        CONF.QUARK.mac_address_lease_ttl)
+
+    def _return_lease(self, context, lease):
+        with context.session.begin():
+            if not db_api.mac_address_lease_delete(context, lease.id):
+                LOG.info("MAC address lease {0}-{1} was already "
+                         "reclaimed".format(lease.next_address,
+                                            lease.last_address))
+                return
+            if lease.exhausted:
+                return
+            LOG.info("Returning unused MAC addresses {0}-{1}".format(
+                lease.next_address, lease.last_address))
+            db_api.mac_address_range_return_block(
+                context, lease.mac_address_range_id, lease.next_address,
+                lease.last_address)
+
+
+MAC_LEASES = MacLeasePool()
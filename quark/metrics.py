@@ -0,0 +1,335 @@
+# Copyright 2015 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Metrics sinks for IPAM timings and failures
+"""
+
+import BaseHTTPServer
+import bisect
+import errno
+import os
+import socket
+import threading
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+
+quark_opts = [
+    cfg.StrOpt("ipam_metrics_sink",
+               default="none",
+               help=_("Where IPAM attempt timings and failures are"
+                      " published. none, memory keeps them in process,"
+                      " statsd sends them over UDP and prometheus serves"
+                      " them in the Prometheus text format.")),
+    cfg.StrOpt("ipam_metrics_statsd_host",
+               default="127.0.0.1",
+               help=_("Host of the statsd daemon for the statsd sink.")),
+    cfg.IntOpt("ipam_metrics_statsd_port",
+               default=8125,
+               help=_("Port of the statsd daemon for the statsd sink.")),
+    cfg.StrOpt("ipam_metrics_prefix",
+               default="quark",
+               help=_("Prefix of every metric name.")),
+    cfg.IntOpt("ipam_metrics_prometheus_port",
+               default=9797,
+               help=_("First port the prometheus sink serves /metrics on."
+                      " Each worker process binds the first free port from"
+                      " here on, within ipam_metrics_prometheus_ports.")),
+    cfg.IntOpt("ipam_metrics_prometheus_ports",
+               default=32,
+               help=_("Number of consecutive ports the prometheus sink's"
+                      " workers may bind, which should be at least the"
+                      " number of API and RPC workers.")),
+]
+
+CONF.register_opts(quark_opts, "QUARK")
+
+# NOTE: histogram bucket upper bounds, in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+class MetricsRegistry(object):
+    """In process counters and histograms, keyed by name and labels."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def _key(self, name, labels):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def increment(self, name, labels=None, value=1):
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        key = self._key(name, labels)
+        with self._lock:
+            buckets, total, count = self.histograms.get(
+                key, ([0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0))
+            buckets[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+            self.histograms[key] = buckets, total + value, count + 1
+
+    def clear(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def render(self):
+        """Renders every metric in the Prometheus text format."""
+        def fmt(name, labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return name
+            return "%s{%s}" % (name, ",".join(
+                '%s="%s"' % (k, str(v).replace('"', '\\"'))
+                for k, v in labels))
+
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append("%s %s" % (fmt(name, labels), value))
+            for (name, labels), hist in sorted(self.histograms.items()):
+                buckets, total, count = hist
+                cumulative = 0
+                for bound, hits in zip(LATENCY_BUCKETS + ("+Inf",), buckets):
+                    cumulative += hits
+                    lines.append("%s %d" % (fmt(name + "_bucket", labels,
+                                                [("le", bound)]),
+                                            cumulative))
+                lines.append("%s %f" % (fmt(name + "_sum", labels), total))
+                lines.append("%s %d" % (fmt(name + "_count", labels), count))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsSink(object):
+    @classmethod
+    def get_name(self):
+        raise NotImplementedError()
+
+    def increment(self, name, labels=None, value=1):
+        raise NotImplementedError()
+
+    def observe(self, name, value, labels=None):
+        raise NotImplementedError()
+
+    def record_ipam_log(self, ipam_log):
+        """Publishes the attempts recorded by a QuarkIPAMLog.
+
+        Step latencies are labelled by strategy, step and outcome. Failures
+        are also counted by reason and network, which is what finds the
+        networks driving retries without a histogram per network.
+        """
+        prefix = CONF.QUARK.ipam_metrics_prefix
+        strategy = ipam_log.strategy or "unknown"
+        status = "success" if ipam_log.success else "failed"
+        total = 0
+        for step, entries in ipam_log.entries.items():
+            for entry in entries:
+                total += entry.get_time()
+                outcome = "success" if entry.success else "failed"
+                self.observe("%s_ipam_step_seconds" % prefix,
+                             entry.get_time(),
+                             dict(strategy=strategy, step=step,
+                                  outcome=outcome))
+                if not entry.success:
+                    self.increment("%s_ipam_step_failures_total" % prefix,
+                                   dict(strategy=strategy, step=step,
+                                        reason=entry.reason,
+                                        network_id=ipam_log.network_id))
+            retries = max(len(entries) - 1, 0)
+            if retries:
+                self.increment("%s_ipam_retries_total" % prefix,
+                               dict(strategy=strategy, step=step,
+                                    network_id=ipam_log.network_id),
+                               value=retries)
+        self.observe("%s_ipam_allocation_seconds" % prefix, total,
+                     dict(strategy=strategy, outcome=status))
+
+
+class NullSink(MetricsSink):
+    @classmethod
+    def get_name(self):
+        return "none"
+
+    def increment(self, name, labels=None, value=1):
+        pass
+
+    def observe(self, name, value, labels=None):
+        pass
+
+    def record_ipam_log(self, ipam_log):
+        pass
+
+
+class MemorySink(MetricsSink):
+    def __init__(self):
+        self.registry = MetricsRegistry()
+
+    @classmethod
+    def get_name(self):
+        return "memory"
+
+    def increment(self, name, labels=None, value=1):
+        self.registry.increment(name, labels, value)
+
+    def observe(self, name, value, labels=None):
+        self.registry.observe(name, value, labels)
+
+
+class StatsdSink(MetricsSink):
+    """Fire and forget UDP statsd emitter.
+
+    Labels are sent as DogStatsD style tags, which statsd_exporter and
+    telegraf both understand.
+    """
+
+    def __init__(self):
+        self._socket = None
+
+    @classmethod
+    def get_name(self):
+        return "statsd"
+
+    def _send(self, name, value, kind, labels):
+        if not self._socket:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        payload = "%s:%s|%s" % (name, value, kind)
+        if labels:
+            payload += "|#" + ",".join("%s:%s" % (k, v)
+                                       for k, v in sorted(labels.items()))
+        try:
+            self._socket.sendto(payload,
+                                (CONF.QUARK.ipam_metrics_statsd_host,
+                                 CONF.QUARK.ipam_metrics_statsd_port))
+        except socket.error:
+            LOG.debug("Couldn't send metric %s to statsd" % name)
+
+    def increment(self, name, labels=None, value=1):
+        self._send(name, value, "c", labels)
+
+    def observe(self, name, value, labels=None):
+        self._send(name, int(value * 1000), "ms", labels)
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class PrometheusSink(MemorySink):
+    """Keeps metrics in process and serves them at /metrics.
+
+    The HTTP server is started in a daemon thread on first use, in each
+    worker process, on the first free port from
+    ipam_metrics_prometheus_port. Scrape every port in the range.
+    """
+
+    def __init__(self):
+        super(PrometheusSink, self).__init__()
+        self._server = None
+        self._server_pid = None
+        self._server_lock = threading.Lock()
+
+    @classmethod
+    def get_name(self):
+        return "prometheus"
+
+    @property
+    def port(self):
+        if self._server is None:
+            return None
+        return self._server.server_address[1]
+
+    def _bind(self, handler):
+        first = CONF.QUARK.ipam_metrics_prometheus_port
+        last = first + max(CONF.QUARK.ipam_metrics_prometheus_ports, 1) - 1
+        for port in xrange(first, last + 1):
+            try:
+                return BaseHTTPServer.HTTPServer(("", port), handler)
+            except socket.error as e:
+                if e.errno != errno.EADDRINUSE or port == last:
+                    LOG.error("Couldn't serve IPAM metrics on any port from"
+                              " %s to %s: %s" % (first, last, e))
+                    raise
+
+    def _ensure_server(self):
+        # NOTE: a server started before the workers forked is only being
+        #       served by the parent, so each worker starts its own.
+        if self._server is not None and self._server_pid == os.getpid():
+            return
+        with self._server_lock:
+            if self._server is not None and self._server_pid == os.getpid():
+                return
+            # NOTE: BaseHTTPRequestHandler is a classic class.
+            handler = type("MetricsHandler", (_MetricsHandler, object),
+                           {"registry": self.registry})
+            if self._server is not None:
+                self._server.server_close()
+                self._server = None
+            server = self._bind(handler)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self._server, self._server_pid = server, os.getpid()
+            LOG.info("Serving IPAM metrics on port %s" % self.port)
+
+    def increment(self, name, labels=None, value=1):
+        self._ensure_server()
+        super(PrometheusSink, self).increment(name, labels, value)
+
+    def observe(self, name, value, labels=None):
+        self._ensure_server()
+        super(PrometheusSink, self).observe(name, value, labels)
+
+
+class MetricsSinkRegistry(object):
+    def __init__(self):
+        self.sinks = {
+            NullSink.get_name(): NullSink(),
+            MemorySink.get_name(): MemorySink(),
+            StatsdSink.get_name(): StatsdSink(),
+            PrometheusSink.get_name(): PrometheusSink()}
+
+    def get_sink(self, sink_name=None):
+        sink_name = sink_name or CONF.QUARK.ipam_metrics_sink
+        if sink_name in self.sinks:
+            return self.sinks[sink_name]
+        LOG.warn("Metrics sink %s not found, metrics are discarded" %
+                 sink_name)
+        return self.sinks[NullSink.get_name()]
+
+
+REGISTRY = MetricsSinkRegistry()
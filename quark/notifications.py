@@ -0,0 +1,154 @@
+# Copyright 2015 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Buffered emission of IPAM notifications
+"""
+
+import Queue
+import threading
+
+from neutron.common import rpc as n_rpc
+from oslo_config import cfg
+from oslo_log import log as logging
+from sqlalchemy import event
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+
+quark_opts = [
+    cfg.BoolOpt("ipam_async_notifications",
+                default=False,
+                help=_("Queue IPAM address notifications and send them from"
+                       " a background thread once the transaction commits,"
+                       " rather than inline in the request.")),
+    cfg.IntOpt("ipam_notification_batch_size",
+               default=100,
+               help=_("Most queued notifications sent per batch by the"
+                      " background thread.")),
+    cfg.IntOpt("ipam_notification_queue_size",
+               default=10000,
+               help=_("Most notifications kept queued. Once full they are"
+                      " sent inline again until the queue drains."))
+]
+
+CONF.register_opts(quark_opts, "QUARK")
+
+PENDING_KEY = "quark_pending_notifications"
+
+
+class NotificationQueue(object):
+    """Sends queued notifications in batches from a daemon thread."""
+
+    def __init__(self):
+        self._queue = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_worker(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._queue = Queue.Queue(
+                maxsize=CONF.QUARK.ipam_notification_queue_size)
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._thread = thread
+
+    def put(self, notifications):
+        self._ensure_worker()
+        for notification in notifications:
+            try:
+                self._queue.put_nowait(notification)
+            except Queue.Full:
+                LOG.warn("IPAM notification queue is full, sending inline")
+                _send([notification])
+
+    def _next_batch(self, block=True):
+        batch = [self._queue.get(block)]
+        while len(batch) < CONF.QUARK.ipam_notification_batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            _send(self._next_batch())
+
+    def flush(self):
+        """Sends everything queued from the calling thread."""
+        if self._queue is None:
+            return
+        while True:
+            try:
+                batch = self._next_batch(block=False)
+            except Queue.Empty:
+                return
+            _send(batch)
+
+
+QUEUE = NotificationQueue()
+
+
+def _send(notifications):
+    notifier = n_rpc.get_notifier("network")
+    for context, event_type, payload in notifications:
+        try:
+            notifier.info(context, event_type, payload)
+        except Exception:
+            LOG.exception("Couldn't send %s notification" % event_type)
+
+
+def _after_commit(session):
+    pending = session.info.pop(PENDING_KEY, None)
+    if pending:
+        QUEUE.put(pending)
+
+
+def _after_soft_rollback(session, previous_transaction):
+    # NOTE: only the outermost rollback discards, a rolled back
+    #       subtransaction dooms its parent which is rolled back in turn.
+    if previous_transaction.parent is None:
+        session.info.pop(PENDING_KEY, None)
+
+
+def notify(context, event_type, payload):
+    """Sends an IPAM notification.
+
+    With ipam_async_notifications set, notifications made inside a
+    transaction are held until it commits and then queued, and those made
+    outside of one are queued right away. Otherwise they're sent inline.
+    """
+    if not CONF.QUARK.ipam_async_notifications:
+        n_rpc.get_notifier("network").info(context, event_type, payload)
+        return
+
+    session = context.session
+    if session.transaction is None:
+        QUEUE.put([(context, event_type, payload)])
+        return
+
+    if PENDING_KEY not in session.info:
+        session.info[PENDING_KEY] = []
+        if not event.contains(session, "after_commit", _after_commit):
+            event.listen(session, "after_commit", _after_commit)
+            event.listen(session, "after_soft_rollback",
+                         _after_soft_rollback)
+    session.info[PENDING_KEY].append((context, event_type, payload))
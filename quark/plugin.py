@@ -26,6 +26,8 @@ from oslo_log import log as logging
 import webob.exc
 
 from quark.api import extensions
+from quark.db import replica
+from quark.db import sql_stats
 from quark import ip_availability
 from quark.plugin_modules import floating_ips
 from quark.plugin_modules import ip_addresses
@@ -109,9 +111,28 @@ CONF.register_opts(quark_quota_opts, "QUOTAS")
 qres_reg.ResourceRegistry.get_instance().register_resources(quark_resources)
 
 
+def read_only(func):
+    """Marks a plugin call that only reads, so sessioned may route it to the
+    read replica.
+    """
+    func.read_only = True
+    return func
+
+
 def sessioned(func):
+    # NOTE: plugin calls are named for what they do, anything but a get_
+    #       may write.
+    writes = not func.__name__.startswith("get_")
+
     def _wrapped(self, context, *args, **kwargs):
-        res = func(self, context, *args, **kwargs)
+        with sql_stats.collected(func.__name__):
+            if getattr(func, "read_only", False):
+                with replica.routed(context):
+                    res = func(self, context, *args, **kwargs)
+            else:
+                if writes:
+                    replica.mark_written(context)
+                res = func(self, context, *args, **kwargs)
         if not context.session.is_active:
             context.session.close()
             # NOTE(mdietz): Forces neutron to get a fresh session
@@ -192,6 +213,7 @@ class Plugin(neutron_plugin_base_v2.NeutronPluginBaseV2,
         return security_groups.get_security_group_rule(context, id, fields)
 
     @sessioned
+    @read_only
     def get_security_groups(self, context, filters=None, fields=None,
                             sorts=None, limit=None, marker=None,
                             page_reverse=False):
@@ -273,10 +295,11 @@ class Plugin(neutron_plugin_base_v2.NeutronPluginBaseV2,
                                                        port)
 
     @sessioned
+    @read_only
     def get_ports(self, context, limit=None, page_reverse=False, sorts=None,
-                  marker=None, filters=None, fields=None):
+                  marker=None, filters=None, fields=None, page_token=None):
         return ports.get_ports(context, limit, sorts, marker, page_reverse,
-                               filters, fields)
+                               filters, fields, page_token=page_token)
 
     @sessioned
     def get_ports_for_ip_address(self, context, ip, limit=None,
@@ -337,10 +360,11 @@ class Plugin(neutron_plugin_base_v2.NeutronPluginBaseV2,
         return subnets.get_subnet(context, id, fields)
 
     @sessioned
+    @read_only
     def get_subnets(self, context, limit=None, page_reverse=False, sorts=None,
-                    marker=None, filters=None, fields=None):
+                    marker=None, filters=None, fields=None, page_token=None):
         return subnets.get_subnets(context, limit, page_reverse, sorts, marker,
-                                   filters, fields)
+                                   filters, fields, page_token=page_token)
 
     @sessioned
     def get_subnets_count(self, context, filters=None):
@@ -368,10 +392,13 @@ class Plugin(neutron_plugin_base_v2.NeutronPluginBaseV2,
         return networks.get_network(context, id, fields)
 
     @sessioned
+    @read_only
     def get_networks(self, context, limit=None, sorts=None, marker=None,
-                     page_reverse=False, filters=None, fields=None):
+                     page_reverse=False, filters=None, fields=None,
+                     page_token=None):
         return networks.get_networks(context, limit, sorts, marker,
-                                     page_reverse, filters, fields)
+                                     page_reverse, filters, fields,
+                                     page_token=page_token)
 
     @sessioned
     def get_networks_count(self, context, filters=None):
@@ -432,6 +459,7 @@ class Plugin(neutron_plugin_base_v2.NeutronPluginBaseV2,
         return floating_ips.delete_floatingip(context, id)
 
     @sessioned
+    @read_only
     def get_floatingips(self, context, filters=None, fields=None,
                         sorts=None, limit=None, marker=None,
                         page_reverse=False):
@@ -91,9 +91,17 @@ def create_ip_policy(context, ip_policy):
             ipp["networks"] = nets
 
         ip_policy = db_api.ip_policy_create(context, **ipp)
+        _invalidate_free_ranges(context, subnets)
     return v._make_ip_policy_dict(ip_policy)
 
 
+def _invalidate_free_ranges(context, subnets):
+    # NOTE: the free address index excludes policy CIDRs, so it has to be
+    #       rebuilt whenever the policy covering a subnet changes.
+    for subnet in subnets:
+        db_api.subnet_update_set_free_ranges(context, subnet)
+
+
 def _check_for_pre_existing_policies_in(models):
     models_with_existing_policies = [model for model in models
                                      if model.get('ip_policy', None)]
@@ -180,6 +188,7 @@ def update_ip_policy(context, id, ip_policy):
 
         if ip_policy_cidrs:
             _validate_policy_with_routes(context, ip_policy_cidrs, all_subnets)
+        _invalidate_free_ranges(context, all_subnets + ipp_db["subnets"])
         ipp_db = db_api.ip_policy_update(context, ipp_db, **ipp)
     return v._make_ip_policy_dict(ipp_db)
 
@@ -192,6 +201,7 @@ def delete_ip_policy(context, id):
             raise quark_exceptions.IPPolicyNotFound(id=id)
         if ipp["networks"] or ipp["subnets"]:
             raise quark_exceptions.IPPolicyInUse(id=id)
+        _invalidate_free_ranges(context, ipp["subnets"])
         db_api.ip_policy_delete(context, ipp)
 
 
@@ -195,7 +195,8 @@ def get_network(context, id, fields=None):
 
 
 def get_networks(context, limit=None, sorts=None, marker=None,
-                 page_reverse=False, filters=None, fields=None):
+                 page_reverse=False, filters=None, fields=None,
+                 page_token=None):
     """Retrieve a list of networks.
 
     The contents of the list depends on the identity of the user
@@ -213,10 +214,22 @@ def get_networks(context, limit=None, sorts=None, marker=None,
         network dictionary as listed in the RESOURCE_ATTRIBUTE_MAP
         object in neutron/api/v2/attributes.py. Only these fields
         will be returned.
+    : param page_token: continuation token for keyset pagination by id,
+        db_api.FIRST_PAGE for the first page. A db_api.Page carrying the
+        next_page_token is returned when it's given. It can't be combined
+        with a marker, page_reverse or sorts other than ascending on id.
     """
     LOG.info("get_networks for tenant %s with filters %s, fields %s" %
              (context.tenant_id, filters, fields))
     filters = filters or {}
+    if page_token is not None:
+        db_api.page_token_check(sorts, marker, page_reverse)
+        nets = db_api.network_find(context, limit, join_subnets=True,
+                                   page_token=page_token, scope=db_api.ALL,
+                                   **filters) or []
+        return db_api.page_create(
+            [v._make_network_dict(net, fields=fields) for net in nets],
+            nets, limit)
     nets = db_api.network_find(context, limit, sorts, marker, page_reverse,
                                join_subnets=True, **filters) or []
     nets = [v._make_network_dict(net, fields=fields) for net in nets]
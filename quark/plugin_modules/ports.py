@@ -463,7 +463,7 @@ def get_port(context, id, fields=None):
 
 
 def get_ports(context, limit=None, sorts=None, marker=None, page_reverse=False,
-              filters=None, fields=None):
+              filters=None, fields=None, page_token=None):
     """Retrieve a list of ports.
 
     The contents of the list depends on the identity of the user
@@ -481,6 +481,10 @@ def get_ports(context, limit=None, sorts=None, marker=None, page_reverse=False,
         port dictionary as listed in the RESOURCE_ATTRIBUTE_MAP
         object in neutron/api/v2/attributes.py. Only these fields
         will be returned.
+    : param page_token: continuation token for keyset pagination by id,
+        db_api.FIRST_PAGE for the first page. A db_api.Page carrying the
+        next_page_token is returned when it's given. It can't be combined
+        with a marker, page_reverse or sorts other than ascending on id.
     """
     LOG.info("get_ports for tenant %s filters %s fields %s" %
              (context.tenant_id, filters, fields))
@@ -501,6 +505,17 @@ def get_ports(context, limit=None, sorts=None, marker=None, page_reverse=False,
         ports = []
         for ip in query:
             ports.extend(ip.ports)
+    elif page_token is not None:
+        db_api.page_token_check(sorts, marker, page_reverse)
+        ports = db_api.port_find(context, limit, fields=fields,
+                                 join_security_groups=True,
+                                 page_token=page_token, scope=db_api.ALL,
+                                 **filters) or []
+        return db_api.page_create(v._make_ports_list(ports, fields), ports,
+                                  limit)
+    elif db_api.use_stream(limit, sorts, marker, page_token):
+        ports = db_api.stream(db_api.port_find, context, fields=fields,
+                              join_security_groups=True, **filters)
     else:
         ports = db_api.port_find(context, limit, sorts, marker,
                                  fields=fields, join_security_groups=True,
@@ -181,7 +181,11 @@ def get_security_groups(context, filters=None, fields=None,
                         page_reverse=False):
     LOG.info("get_security_groups for tenant %s" %
              (context.tenant_id))
-    groups = db_api.security_group_find(context, **filters)
+    if db_api.use_stream(limit, sorts, marker):
+        groups = db_api.stream(db_api.security_group_find, context,
+                               **filters)
+    else:
+        groups = db_api.security_group_find(context, **filters)
     return [v._make_security_group_dict(group) for group in groups]
 
 
@@ -26,6 +26,7 @@ from oslo_utils import timeutils
 from quark import allocation_pool
 from quark.db import api as db_api
 from quark.db import models
+from quark.db import replica
 from quark import exceptions as q_exc
 from quark import network_strategy
 from quark.plugin_modules import ip_policies
@@ -319,6 +320,7 @@ def update_subnet(context, id, subnet):
                     context, subnet_db["ip_policy"], exclude=cidrs)
                 # invalidate the cache
                 db_api.subnet_update_set_alloc_pool_cache(context, subnet_db)
+                db_api.subnet_update_set_free_ranges(context, subnet_db)
         subnet = db_api.subnet_update(context, subnet_db, **s)
     return v._make_subnet_dict(subnet)
 
@@ -349,7 +351,7 @@ def get_subnet(context, id, fields=None):
 
 
 def get_subnets(context, limit=None, page_reverse=False, sorts=None,
-                marker=None, filters=None, fields=None):
+                marker=None, filters=None, fields=None, page_token=None):
     """Retrieve a list of subnets.
 
     The contents of the list depends on the identity of the user
@@ -367,20 +369,43 @@ def get_subnets(context, limit=None, page_reverse=False, sorts=None,
         subnet dictionary as listed in the RESOURCE_ATTRIBUTE_MAP
         object in neutron/api/v2/attributes.py. Only these fields
         will be returned.
+    : param page_token: continuation token for keyset pagination by id,
+        db_api.FIRST_PAGE for the first page. A db_api.Page carrying the
+        next_page_token is returned when it's given. It can't be combined
+        with a marker, page_reverse or sorts other than ascending on id.
     """
     LOG.info("get_subnets for tenant %s with filters %s fields %s" %
              (context.tenant_id, filters, fields))
     filters = filters or {}
-    subnets = db_api.subnet_find(context, limit=limit,
-                                 page_reverse=page_reverse, sorts=sorts,
-                                 marker_obj=marker,
-                                 join_dns=True, join_routes=True, **filters)
+    if page_token is not None:
+        db_api.page_token_check(sorts, marker, page_reverse)
+        subnets = db_api.subnet_find(context, limit=limit, join_dns=True,
+                                     join_routes=True, page_token=page_token,
+                                     scope=db_api.ALL, **filters) or []
+        return db_api.page_create(
+            v._make_subnets_list(_fill_alloc_pool_cache(context, subnets),
+                                 fields=fields), subnets, limit)
+    if db_api.use_stream(limit, sorts, marker, page_token):
+        subnets = db_api.stream(db_api.subnet_find, context, join_dns=True,
+                                join_routes=True, **filters)
+    else:
+        subnets = db_api.subnet_find(context, limit=limit,
+                                     page_reverse=page_reverse, sorts=sorts,
+                                     marker_obj=marker,
+                                     join_dns=True, join_routes=True,
+                                     **filters)
+    return v._make_subnets_list(_fill_alloc_pool_cache(context, subnets),
+                                fields=fields)
+
+
+def _fill_alloc_pool_cache(context, subnets):
     for subnet in subnets:
         cache = subnet.get("_allocation_pool_cache")
-        if not cache:
+        # NOTE: the cache is filled in by the next read from the primary.
+        if not cache and not replica.is_routed(context):
             db_api.subnet_update_set_alloc_pool_cache(
                 context, subnet, subnet.allocation_pools)
-    return v._make_subnets_list(subnets, fields=fields)
+        yield subnet
 
 
 def get_subnets_count(context, filters=None):
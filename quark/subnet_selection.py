@@ -0,0 +1,182 @@
+# Copyright 2015 Openstack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Policies for the order IPAM tries the subnets of a network in
+"""
+
+import hashlib
+import itertools
+import random
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+
+quark_opts = [
+    cfg.StrOpt("ipam_subnet_selection",
+               default="MOST_FULL",
+               help=_("Order new addresses are allocated from the subnets"
+                      " of a network in. MOST_FULL packs subnets one at a"
+                      " time, LEAST_CONTENDED avoids subnets this worker"
+                      " recently lost races on, RANDOM spreads allocations"
+                      " across subnets and TENANT_HASH keeps each tenant"
+                      " on the same subnet while it has room. Only"
+                      " MOST_FULL is worth using when every candidate"
+                      " subnet is locked up front.")),
+    cfg.DictOpt("ipam_subnet_selection_networks",
+                default={},
+                help=_("network_id:policy pairs overriding"
+                       " ipam_subnet_selection for particular networks.")),
+    cfg.IntOpt("ipam_subnet_contention_half_life",
+               default=60,
+               help=_("Seconds for a lost race on a subnet to count half as"
+                      " much towards LEAST_CONTENDED ordering."))
+]
+
+CONF.register_opts(quark_opts, "QUARK")
+
+
+def _by_version(candidates):
+    """Groups (subnet, count) candidates by IP version, keeping the order."""
+    return [list(group) for _, group in itertools.groupby(
+        candidates, key=lambda candidate: candidate[0]["ip_version"])]
+
+
+class SubnetContention(object):
+    """Per worker, exponentially decaying count of lost races by subnet."""
+
+    def __init__(self):
+        self._scores = {}
+
+    def record(self, subnet_id):
+        self._scores[subnet_id] = self.score(subnet_id) + 1, time.time()
+
+    def score(self, subnet_id):
+        score, recorded_at = self._scores.get(subnet_id, (0, 0))
+        if not score:
+            return 0
+        half_lives = ((time.time() - recorded_at) /
+                      max(CONF.QUARK.ipam_subnet_contention_half_life, 1))
+        return score * 0.5 ** half_lives
+
+    def clear(self):
+        self._scores = {}
+
+
+CONTENTION = SubnetContention()
+
+
+class SubnetSelectionPolicy(object):
+    """Orders candidate subnets, given as (subnet, ips_in_subnet) tuples
+    sorted by IP version and then most full first.
+
+    Policies may reorder subnets within an IP version, but not move them
+    between versions.
+    """
+
+    @classmethod
+    def get_name(self):
+        raise NotImplementedError()
+
+    def order(self, context, candidates):
+        raise NotImplementedError()
+
+
+class MostFull(SubnetSelectionPolicy):
+    @classmethod
+    def get_name(self):
+        return "MOST_FULL"
+
+    def order(self, context, candidates):
+        return candidates
+
+
+class LeastContended(SubnetSelectionPolicy):
+    @classmethod
+    def get_name(self):
+        return "LEAST_CONTENDED"
+
+    def order(self, context, candidates):
+        ordered = []
+        for group in _by_version(candidates):
+            # NOTE: sorted is stable, so subnets nobody has raced on yet
+            #       stay most full first.
+            ordered.extend(sorted(group, key=lambda candidate:
+                                  CONTENTION.score(candidate[0]["id"])))
+        return ordered
+
+
+class Randomized(SubnetSelectionPolicy):
+    @classmethod
+    def get_name(self):
+        return "RANDOM"
+
+    def order(self, context, candidates):
+        ordered = []
+        for group in _by_version(candidates):
+            random.shuffle(group)
+            ordered.extend(group)
+        return ordered
+
+
+class TenantHash(SubnetSelectionPolicy):
+    """Rendezvous hash of the tenant against each subnet, so adding or
+    filling up a subnet only moves the tenants that hashed to it.
+    """
+
+    @classmethod
+    def get_name(self):
+        return "TENANT_HASH"
+
+    def _weight(self, key, subnet):
+        return hashlib.md5("%s:%s" % (key, subnet["id"])).hexdigest()
+
+    def order(self, context, candidates):
+        if not context.tenant_id:
+            return candidates
+        ordered = []
+        for group in _by_version(candidates):
+            ordered.extend(sorted(group, reverse=True, key=lambda candidate:
+                                  self._weight(context.tenant_id,
+                                               candidate[0])))
+        return ordered
+
+
+class SubnetSelectionRegistry(object):
+    def __init__(self):
+        self.policies = {
+            MostFull.get_name(): MostFull(),
+            LeastContended.get_name(): LeastContended(),
+            Randomized.get_name(): Randomized(),
+            TenantHash.get_name(): TenantHash()}
+
+    def is_valid_policy(self, policy_name):
+        return policy_name in self.policies
+
+    def get_policy(self, net_id=None):
+        overrides = CONF.QUARK.ipam_subnet_selection_networks
+        policy_name = overrides.get(net_id, CONF.QUARK.ipam_subnet_selection)
+        if self.is_valid_policy(policy_name):
+            return self.policies[policy_name]
+        LOG.warn("Subnet selection policy %s not found, using %s" %
+                 (policy_name, MostFull.get_name()))
+        return self.policies[MostFull.get_name()]
+
+
+REGISTRY = SubnetSelectionRegistry()
@@ -1,9 +1,12 @@
+import contextlib
+
 from neutron import context
 from neutron.db import api as neutron_db_api
 from oslo_config import cfg
 from sqlalchemy.orm import configure_mappers
 
 from quark.db import models
+from quark.db import sql_stats
 from quark import quota_driver
 from quark.tests import test_base
 
@@ -21,6 +24,15 @@ class BaseFunctionalTest(test_base.TestBase):
         models.BASEV2.metadata.create_all(self.engine)
         quota_driver.Quota.metadata.create_all(self.engine)
 
+    @contextlib.contextmanager
+    def assertMaxStatements(self, limit):
+        """Fails if the block issues more than limit SQL statements."""
+        with sql_stats.collect(self.id(), capture_sql=True) as stats:
+            yield stats
+        if stats.statements > limit:
+            self.fail("%d statements issued, at most %d expected:\n%s" % (
+                stats.statements, limit, "\n".join(stats.sql)))
+
     def tearDown(self):
         self.context = None
         neutron_db_api._FACADE = None
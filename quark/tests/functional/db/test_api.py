@@ -184,9 +184,32 @@ class QuarkFindSubnetAllocationCount(QuarkIpamBaseFunctionalTest):
                     self.context, subnet)
                 self.context.session.refresh(subnet)
                 self.assertTrue(updated)
+                # NOTE: the cursor starts on the excluded network address,
+                #       so it skips it and hands out net4[1] next.
                 self.assertEqual(
                     netaddr.IPAddress(subnet["next_auto_assign_ip"]).ipv4(),
-                    net4[1])
+                    net4[2])
+
+    def test_subnet_update_next_auto_assign_ip_skips_policy_cidr(self):
+        cidr4 = "0.0.0.0/24"
+        net4 = netaddr.IPNetwork(cidr4)
+        models = self._create_models(cidr4, 4, net4[0])
+        models["ip_policy"]["exclude"] = ["0.0.0.0/26", "0.0.0.255/32"]
+        with self._fixtures([models]) as net:
+            subnet = db_api.subnet_find(self.context, network_id=net['id'],
+                                        scope=db_api.ALL)[0]
+            with self.context.session.begin():
+                db_api.subnet_update(
+                    self.context, subnet,
+                    next_auto_assign_ip=net4.ipv6().first + 10)
+            with self.context.session.begin():
+                updated = db_api.subnet_update_next_auto_assign_ip(
+                    self.context, subnet)
+                self.context.session.refresh(subnet)
+                self.assertTrue(updated)
+                self.assertEqual(
+                    netaddr.IPAddress(subnet["next_auto_assign_ip"]).ipv4(),
+                    net4[65])
 
 
 class QuarkFindMacAddressRangeAllocationCount(QuarkIpamBaseFunctionalTest):
@@ -17,6 +17,8 @@ import contextlib
 
 import mock
 import netaddr
+from neutron.common import exceptions
+from oslo_config import cfg
 
 from quark.db import api as db_api
 import quark.ipam
@@ -42,6 +44,43 @@ class QuarkNetworksPaginationFunctionalTest(BaseFunctionalTest):
         res = network_api.get_networks(self.context)
         self.assertNotEqual(len(res), networks_per_page)
 
+    def test_networks_keyset_pagination(self):
+        for name in ("fake_A", "fake_B", "fake_C"):
+            db_api.network_create(self.context, name=name, tenant_id="fake",
+                                  network_plugin="BASE")
+        seen = []
+        pages = 0
+        page_token = db_api.FIRST_PAGE
+        while page_token is not None:
+            res = network_api.get_networks(self.context, 2,
+                                           page_token=page_token)
+            seen.extend(net["id"] for net in res)
+            page_token = res.next_page_token
+            pages += 1
+        self.assertEqual(pages, 2)
+        self.assertEqual(len(seen), 3)
+        self.assertEqual(seen, sorted(seen))
+
+    def test_networks_page_token_honours_id_sort(self):
+        db_api.network_create(self.context, name="fake_A", tenant_id="fake",
+                              network_plugin="BASE")
+        res = network_api.get_networks(self.context, 2, [("id", True)],
+                                       page_token=db_api.FIRST_PAGE)
+        self.assertEqual(len(res), 1)
+        self.assertIsNone(res.next_page_token)
+
+    def test_networks_page_token_conflicts(self):
+        self.assertRaises(exceptions.InvalidInput, network_api.get_networks,
+                          self.context, 1, [("name", True)],
+                          page_token=db_api.FIRST_PAGE)
+        self.assertRaises(exceptions.InvalidInput, network_api.get_networks,
+                          self.context, 1, page_reverse=True,
+                          page_token=db_api.FIRST_PAGE)
+
+    def test_networks_invalid_page_token(self):
+        self.assertRaises(exceptions.InvalidInput, network_api.get_networks,
+                          self.context, 1, page_token="not a token")
+
 
 class QuarkSubnetsPaginationFunctionalTest(BaseFunctionalTest):
     @contextlib.contextmanager
@@ -72,6 +111,34 @@ class QuarkSubnetsPaginationFunctionalTest(BaseFunctionalTest):
             self.assertEqual(len(subnets_paged), subnets_per_page)
             self.assertNotEqual(len(subnets_unpaged), subnets_per_page)
 
+    def test_subnets_keyset_pagination(self):
+        network = dict(name="public", tenant_id="fake")
+        subnets = [dict(id=i, cidr="%d.0.0.0/24" % i, ip_policy=None,
+                        tenant_id="fake") for i in xrange(1, 4)]
+        with self._stubs(network, subnets):
+            res = subnet_api.get_subnets(self.context, 2, filters={},
+                                         page_token=db_api.FIRST_PAGE)
+            self.assertEqual([subnet["id"] for subnet in res], ["1", "2"])
+            res = subnet_api.get_subnets(self.context, 2, filters={},
+                                         page_token=res.next_page_token)
+            self.assertEqual([subnet["id"] for subnet in res], ["3"])
+            self.assertIsNone(res.next_page_token)
+
+    def test_subnets_streamed_in_chunks(self):
+        cfg.CONF.set_override("list_stream_chunk_size", 2, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override, "list_stream_chunk_size",
+                        "QUARK")
+        network = dict(name="public", tenant_id="fake")
+        subnets = [dict(id=i, cidr="%d.0.0.0/24" % i, ip_policy=None,
+                        tenant_id="fake") for i in xrange(1, 4)]
+        with self._stubs(network, subnets):
+            with mock.patch("quark.db.api.subnet_find",
+                            wraps=db_api.subnet_find) as subnet_find:
+                res = subnet_api.get_subnets(self.context, filters={})
+            self.assertEqual(sorted(subnet["id"] for subnet in res),
+                             ["1", "2", "3"])
+            self.assertEqual(subnet_find.call_count, 2)
+
 
 class QuarkPortsPaginationFunctionalTest(BaseFunctionalTest):
     @contextlib.contextmanager
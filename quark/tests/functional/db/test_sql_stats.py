@@ -0,0 +1,71 @@
+import mock
+from oslo_config import cfg
+
+from quark.db import api as db_api
+from quark.db import sql_stats
+from quark import metrics
+from quark import plugin
+from quark.tests.functional.base import BaseFunctionalTest
+
+
+class QuarkSQLStatsFunctionalTest(BaseFunctionalTest):
+    def _create_network(self):
+        with self.context.session.begin():
+            db_api.network_create(self.context, name="net", tenant_id="fake",
+                                  network_plugin="BASE")
+
+    def test_collect(self):
+        with sql_stats.collect("outer") as outer:
+            self._create_network()
+            with sql_stats.collect("inner", capture_sql=True) as inner:
+                db_api.network_find(self.context)
+        self.assertEqual(inner.statements, 1)
+        self.assertEqual(outer.statements, 2)
+        self.assertEqual(len(inner.sql), 1)
+        self.assertTrue(inner.sql[0].startswith("SELECT"))
+        self.assertEqual(outer.sql, [])
+
+        db_api.network_find(self.context)
+        self.assertEqual(outer.statements, 2)
+
+    def test_assert_max_statements(self):
+        with self.assertMaxStatements(1):
+            self._create_network()
+        with self.assertRaises(AssertionError):
+            with self.assertMaxStatements(1):
+                self._create_network()
+                db_api.network_find(self.context)
+
+    def test_publish(self):
+        sink = metrics.MemorySink()
+        with sql_stats.collect("create_network") as stats:
+            self._create_network()
+        with mock.patch("quark.metrics.REGISTRY.get_sink",
+                        return_value=sink):
+            sql_stats.publish(stats)
+        counters = sink.registry.counters
+        labels = (("method", "create_network"),)
+        self.assertEqual(
+            counters[("quark_ipam_sql_statements_total", labels)], 1)
+        self.assertEqual(counters[("quark_ipam_sql_rows_total", labels)], 1)
+        self.assertEqual(
+            sink.registry.histograms[("quark_ipam_sql_seconds", labels)][2],
+            1)
+
+    def test_sessioned_publishes_when_enabled(self):
+        class Plugin(object):
+            @plugin.sessioned
+            def get_networks(self, context):
+                return db_api.network_find(context)
+
+        with mock.patch("quark.db.sql_stats.publish") as publish:
+            Plugin().get_networks(self.context)
+            self.assertFalse(publish.called)
+
+            cfg.CONF.set_override("sql_statement_stats", True, "QUARK")
+            self.addCleanup(cfg.CONF.clear_override, "sql_statement_stats",
+                            "QUARK")
+            Plugin().get_networks(self.context)
+        stats = publish.call_args[0][0]
+        self.assertEqual(stats.name, "get_networks")
+        self.assertEqual(stats.statements, 1)
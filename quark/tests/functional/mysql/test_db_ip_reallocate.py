@@ -219,7 +219,7 @@ class QuarkIPReallocateFindTest(MySqlBaseFunctionalTest, IPReallocateMixin):
             self.context,
             {"transaction_id": self.transaction.id},
             **ip_kwargs)
-        self.assertTrue(reallocated)
+        self.assertFalse(reallocated)
 
         updated_address = db_api.ip_address_reallocate_find(
             self.context, self.transaction.id)
@@ -243,7 +243,7 @@ class QuarkIPReallocateFindTest(MySqlBaseFunctionalTest, IPReallocateMixin):
             self.context,
             {"transaction_id": self.transaction.id},
             **ip_kwargs)
-        self.assertTrue(reallocated)
+        self.assertFalse(reallocated)
 
         updated_address = db_api.ip_address_reallocate_find(
             self.context, self.transaction.id)
@@ -264,21 +264,21 @@ class QuarkIPReallocateFindTest(MySqlBaseFunctionalTest, IPReallocateMixin):
             "deallocated": True,
             "version": 4,
         }
+        self.insert_default_ip_policy(self.subnet_v4_db)
         reallocated = db_api.ip_address_reallocate(
             self.context,
             {"transaction_id": self.transaction.id},
             **ip_kwargs)
-        self.assertTrue(reallocated)
+        self.assertFalse(reallocated)
 
-        self.insert_default_ip_policy(self.subnet_v4_db)
         updated_address = db_api.ip_address_reallocate_find(
             self.context, self.transaction.id)
         self.assertIsNone(updated_address)
 
         self.context.session.flush()
-        self.assertIsNone(db_api.ip_address_find(self.context,
-                                                 id=ip_address_db.id,
-                                                 scope=db_api.ONE))
+        self.assertIsNotNone(db_api.ip_address_find(self.context,
+                                                    id=ip_address_db.id,
+                                                    scope=db_api.ONE))
 
     def test_address_not_in_cidr(self):
         self.network_db = self.insert_network()
@@ -299,13 +299,39 @@ class QuarkIPReallocateFindTest(MySqlBaseFunctionalTest, IPReallocateMixin):
             self.context,
             {"transaction_id": self.transaction.id},
             **ip_kwargs)
-        self.assertTrue(reallocated)
+        self.assertFalse(reallocated)
 
         updated_address = db_api.ip_address_reallocate_find(
             self.context, self.transaction.id)
         self.assertIsNone(updated_address)
 
         self.context.session.flush()
-        self.assertIsNone(db_api.ip_address_find(self.context,
-                                                 id=ip_address_db.id,
-                                                 scope=db_api.ONE))
+        self.assertIsNotNone(db_api.ip_address_find(self.context,
+                                                    id=ip_address_db.id,
+                                                    scope=db_api.ONE))
+
+    def test_policy_violation_ip_address_specified(self):
+        self.network_db = self.insert_network()
+        self.subnet_v4_db = self.insert_subnet(
+            self.network_db, "192.168.0.0/24")
+        self.ip_address_v4 = netaddr.IPAddress("192.168.0.0")
+        self.insert_ip_address(self.ip_address_v4, self.network_db,
+                               self.subnet_v4_db)
+        self.transaction = self.insert_transaction()
+        self.insert_default_ip_policy(self.subnet_v4_db)
+        ip_kwargs = {
+            "network_id": self.network_db["id"],
+            "reuse_after": self.REUSE_AFTER,
+            "ip_address": self.ip_address_v4,
+            "version": 4,
+        }
+        reallocated = db_api.ip_address_reallocate(
+            self.context,
+            {"transaction_id": self.transaction.id},
+            **ip_kwargs)
+        self.assertTrue(reallocated)
+
+        updated_address = db_api.ip_address_reallocate_find(
+            self.context, self.transaction.id)
+        self.assertEqual(updated_address["address"],
+                         int(self.ip_address_v4.ipv6()))
@@ -0,0 +1,198 @@
+import contextlib
+
+import mock
+import netaddr
+
+from quark.db import api as db_api
+from quark.db import models
+from quark.tests.functional.base import BaseFunctionalTest
+from quark.tools import allocation_counts
+
+
+class QuarkSubnetAllocationCounts(BaseFunctionalTest):
+    @contextlib.contextmanager
+    def _fixtures(self):
+        with self.context.session.begin():
+            net_mod = db_api.network_create(self.context, name="public",
+                                            tenant_id="fake")
+            sub_mod = db_api.subnet_create(self.context, network=net_mod,
+                                           cidr="192.168.0.0/24",
+                                           tenant_id="fake")
+        yield net_mod, sub_mod
+
+    def _create_ip(self, net, subnet, address):
+        with self.context.session.begin():
+            return db_api.ip_address_create(
+                self.context, address=netaddr.IPAddress(address),
+                subnet_id=subnet["id"], network_id=net["id"], version=4)
+
+    def _counts(self, subnet):
+        self.context.session.refresh(subnet)
+        return subnet["allocated_count"], subnet["reserved_count"]
+
+    def test_counts_follow_address_lifecycle(self):
+        with self._fixtures() as (net, subnet):
+            ip = self._create_ip(net, subnet, "192.168.0.2")
+            self._create_ip(net, subnet, "192.168.0.3")
+            self.assertEqual(self._counts(subnet), (2, 0))
+
+            with self.context.session.begin():
+                db_api.ip_address_deallocate(self.context, ip)
+            self.assertEqual(self._counts(subnet), (1, 1))
+
+            with self.context.session.begin():
+                db_api.ip_address_update(self.context, ip, deallocated=False)
+            self.assertEqual(self._counts(subnet), (2, 0))
+
+            with self.context.session.begin():
+                db_api.ip_address_delete(self.context, ip)
+            self.assertEqual(self._counts(subnet), (1, 0))
+
+    def _reallocate(self, net, **filters):
+        m = models.IPAddress
+        with self.context.session.begin():
+            return db_api.ip_address_reallocate(
+                self.context,
+                {m.transaction_id: db_api.claim_token_create(),
+                 m.deallocated: False},
+                network_id=net["id"], **filters)
+
+    def test_counts_follow_reallocation(self):
+        with self._fixtures() as (net, subnet):
+            ip = self._create_ip(net, subnet, "192.168.0.2")
+            with self.context.session.begin():
+                db_api.ip_address_deallocate(self.context, ip)
+            self.assertTrue(self._reallocate(net, deallocated=True))
+            self.assertEqual(self._counts(subnet), (1, 0))
+            self.assertFalse(self._reallocate(net, deallocated=True))
+            self.assertEqual(self._counts(subnet), (1, 0))
+
+    def test_counts_follow_explicit_reallocation(self):
+        with self._fixtures() as (net, subnet):
+            ip = self._create_ip(net, subnet, "192.168.0.2")
+            with self.context.session.begin():
+                db_api.ip_address_deallocate(self.context, ip)
+            address = netaddr.IPAddress("192.168.0.2")
+            self.assertTrue(self._reallocate(net, ip_address=address))
+            self.assertEqual(self._counts(subnet), (1, 0))
+
+            # NOTE: an explicitly requested address that's still allocated
+            #       is claimed without touching the counts.
+            self.assertTrue(self._reallocate(net, ip_address=address))
+            self.assertEqual(self._counts(subnet), (1, 0))
+
+    def test_failed_counter_update_rolls_back_claim(self):
+        with self._fixtures() as (net, subnet):
+            ip = self._create_ip(net, subnet, "192.168.0.2")
+            with self.context.session.begin():
+                db_api.ip_address_deallocate(self.context, ip)
+
+            execute = self.context.session.execute
+            statements = []
+
+            def _execute(*args, **kwargs):
+                statements.append(args[0])
+                if len(statements) == 2:
+                    raise Exception("lost connection")
+                return execute(*args, **kwargs)
+
+            m = models.IPAddress
+            with mock.patch.object(self.context.session, "execute",
+                                   side_effect=_execute):
+                self.assertRaises(
+                    Exception, db_api.ip_address_reallocate, self.context,
+                    {m.transaction_id: db_api.claim_token_create(),
+                     m.deallocated: False},
+                    network_id=net["id"], deallocated=True)
+            self.assertEqual(len(statements), 2)
+            self.assertEqual(self._counts(subnet), (0, 1))
+            self.context.session.refresh(ip)
+            self.assertTrue(ip["_deallocated"])
+
+    def test_bulk_create_counts(self):
+        with self._fixtures() as (net, subnet):
+            with self.context.session.begin():
+                db_api.ip_address_create_bulk(self.context, [
+                    dict(address=netaddr.IPAddress("192.168.0.%d" % i),
+                         subnet_id=subnet["id"], network_id=net["id"],
+                         version=4, address_type="fixed")
+                    for i in range(2, 5)])
+            self.assertEqual(self._counts(subnet), (3, 0))
+
+    def test_reconcile_fixes_drift(self):
+        with self._fixtures() as (net, subnet):
+            self._create_ip(net, subnet, "192.168.0.2")
+            with self.context.session.begin():
+                db_api.subnet_update(self.context, subnet,
+                                     allocated_count=10, reserved_count=3)
+
+            with self.context.session.begin():
+                drifted = allocation_counts.reconcile_subnet_counts(
+                    self.context, dry_run=True)
+            self.assertEqual(drifted, [(subnet["id"], (10, 3), (1, 0))])
+            self.assertEqual(self._counts(subnet), (10, 3))
+
+            with self.context.session.begin():
+                allocation_counts.reconcile_subnet_counts(self.context)
+            self.assertEqual(self._counts(subnet), (1, 0))
+
+
+class QuarkMacRangeAllocationCounts(BaseFunctionalTest):
+    @contextlib.contextmanager
+    def _fixtures(self):
+        with self.context.session.begin():
+            rng = db_api.mac_address_range_create(
+                self.context, cidr="AA:BB:CC/24", do_not_use=False,
+                first_address=0, last_address=255, next_auto_assign_mac=0)
+        yield rng
+
+    def _count(self, mac_range):
+        self.context.session.refresh(mac_range)
+        return mac_range["allocated_count"]
+
+    def test_count_follows_mac_lifecycle(self):
+        with self._fixtures() as rng:
+            with self.context.session.begin():
+                mac = db_api.mac_address_create(
+                    self.context, address=0, mac_address_range_id=rng["id"])
+                db_api.mac_address_create(
+                    self.context, address=1, mac_address_range_id=rng["id"])
+            self.assertEqual(self._count(rng), 2)
+
+            with self.context.session.begin():
+                db_api.mac_address_update(self.context, mac,
+                                          deallocated=True)
+            self.assertEqual(self._count(rng), 2)
+
+            with self.context.session.begin():
+                db_api.mac_address_delete(self.context, mac)
+            self.assertEqual(self._count(rng), 1)
+
+    def test_range_selection_uses_count(self):
+        with self._fixtures() as rng:
+            with self.context.session.begin():
+                db_api.mac_address_range_update(self.context, rng,
+                                                allocated_count=7)
+            with self.context.session.begin():
+                found = db_api.mac_address_range_find_allocation_counts(
+                    self.context)
+            self.assertEqual(found, (rng, 7))
+
+    def test_reconcile_fixes_drift(self):
+        with self._fixtures() as rng:
+            with self.context.session.begin():
+                db_api.mac_address_create(
+                    self.context, address=0, mac_address_range_id=rng["id"])
+            with self.context.session.begin():
+                db_api.mac_address_range_update(self.context, rng,
+                                                allocated_count=5)
+
+            with self.context.session.begin():
+                drifted = allocation_counts.reconcile_mac_range_counts(
+                    self.context, dry_run=True)
+            self.assertEqual(drifted, [(rng["id"], 5, 1)])
+            self.assertEqual(self._count(rng), 5)
+
+            with self.context.session.begin():
+                allocation_counts.reconcile_mac_range_counts(self.context)
+            self.assertEqual(self._count(rng), 1)
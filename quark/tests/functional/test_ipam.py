@@ -17,9 +17,13 @@ import contextlib
 
 import mock
 import netaddr
+from neutron.common import exceptions
 from neutron.common import rpc
+from oslo_config import cfg
 
 from quark.db import api as db_api
+from quark.db import models
+from quark import interval_set
 import quark.ipam
 from quark.tests.functional.base import BaseFunctionalTest
 
@@ -68,6 +72,383 @@ class QuarkIPAddressAllocate(QuarkIpamBaseFunctionalTest):
             self.assertEqual(ipaddress[0]['used_by_tenant_id'], "fake")
 
 
+class QuarkIPAddressAllocateBulk(QuarkIpamBaseFunctionalTest):
+    @contextlib.contextmanager
+    def _stubs(self, network, subnet):
+        self.ipam = quark.ipam.QuarkIpamANY()
+        with self.context.session.begin():
+            next_ip = subnet.pop("next_auto_assign_ip", 0)
+            net_mod = db_api.network_create(self.context, **network)
+            subnet["network"] = net_mod
+            sub_mod = db_api.subnet_create(self.context, **subnet)
+            db_api.subnet_update(self.context,
+                                 sub_mod,
+                                 next_auto_assign_ip=next_ip)
+        yield net_mod, sub_mod
+
+    def test_allocate_bulk_creates_sequential_ips(self):
+        network = dict(name="public", tenant_id="fake")
+        ipnet = netaddr.IPNetwork("0.0.0.0/24")
+        next_ip = ipnet.ipv6().first + 2
+        subnet = dict(id=1, cidr="0.0.0.0/24", next_auto_assign_ip=next_ip,
+                      ip_policy=None, tenant_id="fake")
+        with self._stubs(network, subnet) as (net, sub):
+            reqs = [dict(network_id=net["id"], port_id=str(i), version=4)
+                    for i in xrange(3)]
+            res = self.ipam.allocate_ip_addresses_bulk(self.context, reqs, 0)
+            addresses = [res[str(i)][0]["address"] for i in xrange(3)]
+            self.assertEqual(addresses, [next_ip, next_ip + 1, next_ip + 2])
+            self.assertEqual(res["0"][0]["used_by_tenant_id"], "fake")
+            self.context.session.refresh(sub)
+            self.assertEqual(sub["next_auto_assign_ip"], next_ip + 3)
+
+
+class QuarkIPAddressAllocateOptimistic(QuarkIpamBaseFunctionalTest):
+    @contextlib.contextmanager
+    def _stubs(self, network, subnet):
+        self.ipam = quark.ipam.QuarkIpamANYOptimistic()
+        with self.context.session.begin():
+            next_ip = subnet.pop("next_auto_assign_ip", 0)
+            net_mod = db_api.network_create(self.context, **network)
+            subnet["network"] = net_mod
+            sub_mod = db_api.subnet_create(self.context, **subnet)
+            db_api.subnet_update(self.context,
+                                 sub_mod,
+                                 next_auto_assign_ip=next_ip)
+        yield net_mod, sub_mod
+
+    def _allocate(self, net):
+        ipaddress = []
+        self.ipam.allocate_ip_address(self.context, ipaddress,
+                                      net["id"], 0, 0)
+        return ipaddress[0]["address"]
+
+    def test_allocate_advances_cursor(self):
+        network = dict(name="public", tenant_id="fake")
+        ipnet = netaddr.IPNetwork("0.0.0.0/24")
+        next_ip = ipnet.ipv6().first + 2
+        subnet = dict(id=1, cidr="0.0.0.0/24", next_auto_assign_ip=next_ip,
+                      ip_policy=None, tenant_id="fake")
+        with self._stubs(network, subnet) as (net, sub):
+            self.assertEqual(self._allocate(net), next_ip)
+            self.assertEqual(self._allocate(net), next_ip + 1)
+            self.context.session.refresh(sub)
+            self.assertEqual(sub["next_auto_assign_ip"], next_ip + 2)
+
+    def test_allocate_retries_after_losing_race(self):
+        network = dict(name="public", tenant_id="fake")
+        ipnet = netaddr.IPNetwork("0.0.0.0/24")
+        next_ip = ipnet.ipv6().first + 2
+        subnet = dict(id=1, cidr="0.0.0.0/24", next_auto_assign_ip=next_ip,
+                      ip_policy=None, tenant_id="fake")
+        update_cursor = db_api.subnet_update_next_auto_assign_ip
+        calls = []
+
+        def _racing_update(context, subnet, **kwargs):
+            if not calls:
+                # Another worker claims the address first
+                update_cursor(context, subnet)
+            calls.append(kwargs["expected"])
+            return update_cursor(context, subnet, **kwargs)
+
+        with self._stubs(network, subnet) as (net, sub):
+            with mock.patch("quark.db.api."
+                            "subnet_update_next_auto_assign_ip",
+                            side_effect=_racing_update):
+                self.assertEqual(self._allocate(net), next_ip + 1)
+            self.assertEqual(calls, [next_ip, next_ip + 1])
+            self.context.session.refresh(sub)
+            self.assertEqual(sub["next_auto_assign_ip"], next_ip + 2)
+
+
+class QuarkIPAddressAllocateStriped(QuarkIpamBaseFunctionalTest):
+    def setUp(self):
+        super(QuarkIPAddressAllocateStriped, self).setUp()
+        cfg.CONF.set_override("ipam_subnet_cursor_stripes", 2, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override,
+                        "ipam_subnet_cursor_stripes", "QUARK")
+
+    @contextlib.contextmanager
+    def _stubs(self, network, subnet):
+        self.ipam = quark.ipam.QuarkIpamANY()
+        with self.context.session.begin():
+            next_ip = subnet.pop("next_auto_assign_ip", 0)
+            net_mod = db_api.network_create(self.context, **network)
+            subnet["network"] = net_mod
+            sub_mod = db_api.subnet_create(self.context, **subnet)
+            db_api.subnet_update(self.context,
+                                 sub_mod,
+                                 next_auto_assign_ip=next_ip)
+        with mock.patch("quark.ipam.random.randrange", return_value=1):
+            yield net_mod, sub_mod
+
+    def _allocate(self, net):
+        ipaddress = []
+        self.ipam.allocate_ip_address(self.context, ipaddress,
+                                      net["id"], 0, 0)
+        return ipaddress[0]["address"]
+
+    def test_allocate_starts_at_chosen_stripe(self):
+        network = dict(name="public", tenant_id="fake")
+        ipnet = netaddr.IPNetwork("0.0.0.0/29")
+        first = ipnet.ipv6().first
+        subnet = dict(id=1, cidr="0.0.0.0/29", next_auto_assign_ip=first + 2,
+                      ip_policy=None, tenant_id="fake")
+        with self._stubs(network, subnet) as (net, sub):
+            addresses = [self._allocate(net) for _ in xrange(4)]
+            self.assertEqual(addresses,
+                             [first + 5, first + 6, first + 7, first + 2])
+            cursors = db_api.subnet_cursors_find(self.context, sub)
+            self.assertEqual([(c["first_ip"], c["last_ip"]) for c in cursors],
+                             [(first + 2, first + 4), (first + 5, first + 7)])
+            self.context.session.refresh(sub)
+            self.assertEqual(sub["next_auto_assign_ip"], first + 2)
+
+    def test_bulk_allocation_takes_from_stripes(self):
+        network = dict(name="public", tenant_id="fake")
+        ipnet = netaddr.IPNetwork("0.0.0.0/29")
+        first = ipnet.ipv6().first
+        subnet = dict(id=1, cidr="0.0.0.0/29", next_auto_assign_ip=first + 2,
+                      ip_policy=None, tenant_id="fake")
+        with self._stubs(network, subnet) as (net, sub):
+            self.assertEqual(self._allocate(net), first + 5)
+            reqs = [dict(network_id=net["id"], port_id=str(i), version=4)
+                    for i in xrange(3)]
+            res = self.ipam.allocate_ip_addresses_bulk(self.context, reqs, 0)
+            self.assertEqual([res[str(i)][0]["address"] for i in xrange(3)],
+                             [first + 6, first + 7, first + 2])
+            self.assertEqual(self._allocate(net), first + 3)
+            self.assertEqual(self._allocate(net), first + 4)
+            self.context.session.refresh(sub)
+            self.assertEqual(sub["next_auto_assign_ip"], first + 2)
+
+    def test_counts_kept_on_stripes(self):
+        network = dict(name="public", tenant_id="fake")
+        ipnet = netaddr.IPNetwork("0.0.0.0/29")
+        first = ipnet.ipv6().first
+        subnet = dict(id=1, cidr="0.0.0.0/29", next_auto_assign_ip=first + 2,
+                      ip_policy=None, tenant_id="fake")
+        with self._stubs(network, subnet) as (net, sub):
+            for _ in xrange(4):
+                self._allocate(net)
+            self.context.session.refresh(sub)
+            self.assertEqual(sub["allocated_count"], 0)
+            cursors = db_api.subnet_cursors_find(self.context, sub)
+            for cursor in cursors:
+                self.context.session.refresh(cursor)
+            self.assertEqual([c["allocated_count"] for c in cursors], [1, 3])
+
+    def test_subnet_full_when_all_stripes_exhausted(self):
+        network = dict(name="public", tenant_id="fake")
+        ipnet = netaddr.IPNetwork("0.0.0.0/29")
+        first = ipnet.ipv6().first
+        subnet = dict(id=1, cidr="0.0.0.0/29", next_auto_assign_ip=first + 2,
+                      ip_policy=None, tenant_id="fake")
+        with self._stubs(network, subnet) as (net, sub):
+            for _ in xrange(6):
+                self._allocate(net)
+            with self.assertRaises(exceptions.IpAddressGenerationFailure):
+                self._allocate(net)
+            self.context.session.refresh(sub)
+            self.assertEqual(sub["next_auto_assign_ip"], -1)
+
+
+class QuarkSubnetFreeRanges(QuarkIpamBaseFunctionalTest):
+    @contextlib.contextmanager
+    def _stubs(self):
+        with self.context.session.begin():
+            net = db_api.network_create(self.context, name="public",
+                                        tenant_id="fake")
+            subnet = db_api.subnet_create(self.context, network=net,
+                                          cidr="192.168.0.0/29",
+                                          tenant_id="fake")
+            subnet["ip_policy"] = db_api.ip_policy_create(
+                self.context, exclude=["192.168.0.0/32", "192.168.0.7/32"])
+        yield net, subnet
+
+    def _create_ip(self, net, subnet, address):
+        with self.context.session.begin():
+            return db_api.ip_address_create(
+                self.context, address=netaddr.IPAddress(address),
+                subnet_id=subnet["id"], network_id=net["id"], version=4)
+
+    def _free(self, subnet):
+        self.context.session.refresh(subnet)
+        free_ranges = db_api.subnet_free_ranges_find(self.context, subnet)
+        return [str(netaddr.IPAddress(value).ipv4())
+                for first, last in free_ranges.intervals()
+                for value in xrange(first, last + 1)]
+
+    def _save(self, subnet, free_ranges=None):
+        if free_ranges is None:
+            free_ranges = db_api.subnet_free_ranges_find(self.context, subnet)
+        with self.context.session.begin():
+            db_api.subnet_update_set_free_ranges(self.context, subnet,
+                                                 free_ranges)
+
+    def test_build_excludes_compiled_policy_and_rows(self):
+        with self._stubs() as (net, subnet):
+            self._create_ip(net, subnet, "192.168.0.1")
+            self.assertEqual(self._free(subnet),
+                             ["192.168.0.%d" % i for i in xrange(2, 7)])
+
+    def test_saved_index_is_reused(self):
+        with self._stubs() as (net, subnet):
+            first = netaddr.IPNetwork("192.168.0.0/29").ipv6().first
+            self.context.session.refresh(subnet)
+            self._save(subnet, interval_set.IntervalSet.from_range(
+                first + 3, first + 3))
+            self.assertEqual(self._free(subnet), ["192.168.0.3"])
+
+    def test_rebuilt_after_row_deleted(self):
+        with self._stubs() as (net, subnet):
+            ip = self._create_ip(net, subnet, "192.168.0.1")
+            self.context.session.refresh(subnet)
+            self._save(subnet)
+            with self.context.session.begin():
+                db_api.ip_address_delete(self.context, ip)
+            self.assertIn("192.168.0.1", self._free(subnet))
+
+    def test_rebuilt_after_row_created_outside_index(self):
+        with self._stubs() as (net, subnet):
+            self.context.session.refresh(subnet)
+            self._save(subnet)
+            self._create_ip(net, subnet, "192.168.0.1")
+            self.assertNotIn("192.168.0.1", self._free(subnet))
+
+    def test_rebuilt_after_policy_change(self):
+        with self._stubs() as (net, subnet):
+            self.context.session.refresh(subnet)
+            self._save(subnet)
+            with self.context.session.begin():
+                db_api.ip_policy_update(
+                    self.context, subnet["ip_policy"],
+                    exclude=["192.168.0.0/31", "192.168.0.7/32"])
+            self.assertNotIn("192.168.0.1", self._free(subnet))
+
+    def _reserve(self, subnet):
+        self.context.session.refresh(subnet)
+        with self.context.session.begin():
+            free_ranges = db_api.subnet_free_ranges_find(self.context, subnet)
+            address = free_ranges.pop_first()
+            db_api.subnet_update_set_free_ranges(self.context, subnet,
+                                                 free_ranges,
+                                                 reserved=[address])
+
+    def test_reservation_in_flight_keeps_index(self):
+        with self._stubs() as (net, subnet):
+            self._reserve(subnet)
+            with mock.patch("quark.db.api.subnet_free_ranges_build") as build:
+                self.assertNotIn("192.168.0.1", self._free(subnet))
+                self._create_ip(net, subnet, "192.168.0.1")
+                self.assertEqual(self._free(subnet),
+                                 ["192.168.0.%d" % i for i in xrange(2, 7)])
+            self.assertFalse(build.called)
+
+    def test_reservation_in_flight_kept_out_of_rebuild(self):
+        with self._stubs() as (net, subnet):
+            self._reserve(subnet)
+            self._create_ip(net, subnet, "192.168.0.6")
+            self.assertNotIn("192.168.0.1", self._free(subnet))
+
+    def test_abandoned_reservation_is_freed(self):
+        cfg.CONF.set_override("ipam_free_ranges_reservation_timeout", 0,
+                              "QUARK")
+        self.addCleanup(cfg.CONF.clear_override,
+                        "ipam_free_ranges_reservation_timeout", "QUARK")
+        with self._stubs() as (net, subnet):
+            self._reserve(subnet)
+            self.assertIn("192.168.0.1", self._free(subnet))
+
+    def test_deallocated_rows_stay_out_of_index(self):
+        with self._stubs() as (net, subnet):
+            ip = self._create_ip(net, subnet, "192.168.0.1")
+            self.context.session.refresh(subnet)
+            self._save(subnet)
+            with self.context.session.begin():
+                db_api.ip_address_deallocate(self.context, ip)
+            self.assertNotIn("192.168.0.1", self._free(subnet))
+
+    def test_allocations_made_with_index_disabled_are_skipped(self):
+        cfg.CONF.set_override("ipam_use_free_ranges", True, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override, "ipam_use_free_ranges",
+                        "QUARK")
+        ipam = quark.ipam.QuarkIpamANY()
+
+        def _allocate(net):
+            ipaddress = []
+            ipam.allocate_ip_address(self.context, ipaddress, net["id"], 0,
+                                     0)
+            return ipaddress[0]["address_readable"]
+
+        with self._stubs() as (net, subnet):
+            self.assertEqual(_allocate(net), "192.168.0.1")
+            cfg.CONF.set_override("ipam_use_free_ranges", False, "QUARK")
+            next_ip = subnet["first_ip"] + 3
+            with self.context.session.begin():
+                db_api.subnet_update(self.context, subnet,
+                                     next_auto_assign_ip=next_ip)
+            self.assertEqual(_allocate(net), "192.168.0.3")
+            cfg.CONF.set_override("ipam_use_free_ranges", True, "QUARK")
+            self.assertEqual([_allocate(net) for _ in xrange(4)],
+                             ["192.168.0.2", "192.168.0.4", "192.168.0.5",
+                              "192.168.0.6"])
+
+
+class QuarkIPAddressAllocateLazyLocking(QuarkIpamBaseFunctionalTest):
+    def setUp(self):
+        super(QuarkIPAddressAllocateLazyLocking, self).setUp()
+        cfg.CONF.set_override("ipam_lazy_subnet_locking", True, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override,
+                        "ipam_lazy_subnet_locking", "QUARK")
+
+    @contextlib.contextmanager
+    def _stubs(self, network, subnets):
+        self.ipam = quark.ipam.QuarkIpamANY()
+        with self.context.session.begin():
+            net_mod = db_api.network_create(self.context, **network)
+            sub_mods = []
+            for subnet in subnets:
+                subnet["network"] = net_mod
+                sub_mods.append(db_api.subnet_create(self.context, **subnet))
+        yield net_mod, sub_mods
+
+    def _allocate(self, net):
+        ipaddress = []
+        self.ipam.allocate_ip_address(self.context, ipaddress,
+                                      net["id"], 0, 0)
+        return ipaddress[0]
+
+    def test_allocate_moves_past_full_subnet(self):
+        network = dict(name="public", tenant_id="fake")
+        subnets = [dict(cidr="0.0.0.0/31", ip_policy=None, tenant_id="fake"),
+                   dict(cidr="1.0.0.0/24", ip_policy=None, tenant_id="fake")]
+        with self._stubs(network, subnets) as (net, subs):
+            allocated = [self._allocate(net)["subnet_id"]
+                         for _ in xrange(3)]
+            self.assertEqual(allocated,
+                             [subs[0]["id"], subs[0]["id"], subs[1]["id"]])
+            self.context.session.refresh(subs[0])
+            self.assertEqual(subs[0]["next_auto_assign_ip"], -1)
+
+    def test_allocate_skips_subnet_disabled_after_selection(self):
+        network = dict(name="public", tenant_id="fake")
+        subnets = [dict(cidr="0.0.0.0/24", ip_policy=None, tenant_id="fake"),
+                   dict(cidr="1.0.0.0/24", ip_policy=None, tenant_id="fake")]
+        with self._stubs(network, subnets) as (net, subs):
+            select = self.ipam._select_subnet
+
+            def _select_then_disable(*args, **kwargs):
+                candidates = list(select(*args, **kwargs))
+                db_api.subnet_update(self.context, subs[0], do_not_use=True)
+                return candidates
+
+            with mock.patch.object(self.ipam, "_select_subnet",
+                                   side_effect=_select_then_disable):
+                address = self._allocate(net)
+            self.assertEqual(address["subnet_id"], subs[1]["id"])
+
+
 class QuarkIPAddressFindReallocatable(QuarkIpamBaseFunctionalTest):
     @contextlib.contextmanager
     def _stubs(self, network, subnet):
@@ -182,3 +563,66 @@ class QuarkIPAddressAllocateWithFullSubnetsNotMarkedAsFull(
                 self.assertEqual(available_subnets[0].cidr, "2.2.2.0/30")
                 self.assertEqual(available_subnets[0].next_auto_assign_ip,
                                  netaddr.IPAddress("2.2.2.2").ipv6().value)
+
+
+class QuarkIPAddressDeallocateBulk(QuarkIpamBaseFunctionalTest):
+    def setUp(self):
+        super(QuarkIPAddressDeallocateBulk, self).setUp()
+        cfg.CONF.set_override("ipam_bulk_deallocation", True, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override,
+                        "ipam_bulk_deallocation", "QUARK")
+        self.ipam = quark.ipam.QuarkIpamANY()
+
+    @contextlib.contextmanager
+    def _stubs(self):
+        with self.context.session.begin():
+            net = db_api.network_create(self.context, name="public",
+                                        tenant_id="fake")
+            v4 = db_api.subnet_create(self.context, network=net,
+                                      cidr="192.168.0.0/24",
+                                      tenant_id="fake")
+            v6 = db_api.subnet_create(self.context, network=net,
+                                      cidr="fd00::/64", tenant_id="fake")
+            addresses = []
+            for subnet, address, version in ((v4, "192.168.0.2", 4),
+                                             (v4, "192.168.0.3", 4),
+                                             (v6, "fd00::2", 6)):
+                addresses.append(db_api.ip_address_create(
+                    self.context, address=netaddr.IPAddress(address),
+                    subnet_id=subnet["id"], network_id=net["id"],
+                    version=version, address_type="fixed"))
+            port = db_api.port_create(self.context, network_id=net["id"],
+                                      backend_key="", device_id="dev",
+                                      addresses=addresses)
+            other = db_api.port_create(self.context, network_id=net["id"],
+                                       backend_key="", device_id="dev2",
+                                       addresses=[addresses[1]])
+        yield port, other, addresses, (v4, v6)
+
+    def test_deallocate_ips_by_port(self):
+        with self._stubs() as (port, other, addresses, subnets):
+            v4, v6 = subnets
+            with self.context.session.begin():
+                self.ipam.deallocate_ips_by_port(self.context, port)
+
+            self.assertEqual(port["ip_addresses"], [])
+            self.assertTrue(addresses[0]["_deallocated"])
+            self.assertIsNone(addresses[0]["address_type"])
+
+            found = db_api.ip_address_find(self.context, scope=db_api.ALL)
+            found = dict((ip["address_readable"], ip) for ip in found)
+            self.assertNotIn("fd00::2", found)
+            self.assertTrue(found["192.168.0.2"]["_deallocated"])
+            self.assertFalse(found["192.168.0.3"]["_deallocated"])
+
+            queue = models.IPAddressReuseQueue
+            queued = self.context.session.query(queue.ip_address_id).all()
+            self.assertEqual([row[0] for row in queued],
+                             [addresses[0]["id"]])
+
+            for subnet in subnets:
+                self.context.session.refresh(subnet)
+            self.assertEqual((v4["allocated_count"], v4["reserved_count"]),
+                             (1, 1))
+            self.assertEqual((v6["allocated_count"], v6["reserved_count"]),
+                             (0, 0))
@@ -0,0 +1,34 @@
+from oslo_config import cfg
+
+from quark.tests.functional.base import BaseFunctionalTest
+from quark.tools import ipam_benchmark
+
+
+class QuarkIpamBenchmark(BaseFunctionalTest):
+    def setUp(self):
+        super(QuarkIpamBenchmark, self).setUp()
+        cfg.CONF.set_override("ipam_metrics_sink", "memory", "QUARK")
+        self.addCleanup(cfg.CONF.clear_override, "ipam_metrics_sink",
+                        "QUARK")
+
+    def test_seed_and_run_worker(self):
+        network_ids = ipam_benchmark.seed(self.context, 1, 2, 28, "BOTH")
+        self.assertEqual(len(network_ids), 1)
+        result = ipam_benchmark.run_worker(self.context, network_ids[0],
+                                           "BOTH", "port", 5)
+        self.assertEqual(result["failures"], {})
+        self.assertEqual(len(result["latencies"]), 5)
+
+    def test_summarize(self):
+        results = [dict(latencies=[0.3, 0.1], failures={"DBDeadlock": 1}),
+                   dict(latencies=[0.2], failures={"DBDeadlock": 1,
+                                                   "Exception": 2})]
+        summary = ipam_benchmark.summarize(results, 2.0, 4)
+        self.assertEqual(summary["allocations"], 3)
+        self.assertEqual(summary["throughput"], 1.5)
+        self.assertEqual(summary["latency"]["p50"], 0.2)
+        self.assertEqual(summary["latency"]["max"], 0.3)
+        self.assertEqual(summary["deadlocks"], 2)
+        self.assertEqual(summary["failures"],
+                         {"DBDeadlock": 2, "Exception": 2})
+        self.assertEqual(summary["retries"], 4)
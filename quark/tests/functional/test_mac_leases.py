@@ -0,0 +1,91 @@
+import contextlib
+
+from oslo_config import cfg
+
+from quark.db import api as db_api
+from quark.db import models
+from quark import mac_leases
+from quark.tests.functional.base import BaseFunctionalTest
+
+
+class QuarkMacLeasePool(BaseFunctionalTest):
+    def setUp(self):
+        super(QuarkMacLeasePool, self).setUp()
+        cfg.CONF.set_override("mac_address_lease_block_size", 4, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override,
+                        "mac_address_lease_block_size", "QUARK")
+        self.pool = mac_leases.MacLeasePool()
+
+    @contextlib.contextmanager
+    def _fixtures(self, first_address=0, last_address=255):
+        with self.context.session.begin():
+            rng = db_api.mac_address_range_create(
+                self.context, cidr="AA:BB:CC/24", do_not_use=False,
+                first_address=first_address, last_address=last_address,
+                next_auto_assign_mac=first_address)
+        yield rng
+
+    def _next_auto_assign_mac(self, rng):
+        self.context.session.refresh(rng)
+        return rng["next_auto_assign_mac"]
+
+    def _deallocated_macs(self):
+        return sorted(mac["address"] for mac in db_api.mac_address_find(
+            self.context, deallocated=True, scope=db_api.ALL))
+
+    def test_pop_hands_out_block_from_memory(self):
+        with self._fixtures() as rng:
+            popped = [self.pool.pop(self.context) for _ in xrange(5)]
+            self.assertEqual(popped, [(i, rng["id"]) for i in xrange(5)])
+            self.assertEqual(self._next_auto_assign_mac(rng), 8)
+
+    def test_pop_last_block_closes_range(self):
+        with self._fixtures(last_address=5) as rng:
+            popped = [self.pool.pop(self.context) for _ in xrange(7)]
+            self.assertEqual([p and p[0] for p in popped],
+                             [0, 1, 2, 3, 4, 5, None])
+            self.assertEqual(self._next_auto_assign_mac(rng), -1)
+
+    def test_release_rewinds_range(self):
+        with self._fixtures() as rng:
+            self.pool.pop(self.context)
+            self.pool.release_all(self.context)
+            self.assertEqual(self._next_auto_assign_mac(rng), 1)
+            self.assertEqual(self._deallocated_macs(), [])
+
+    def test_release_after_other_lease_deallocates(self):
+        with self._fixtures() as rng:
+            other = mac_leases.MacLeasePool()
+            self.pool.pop(self.context)
+            other.pop(self.context)
+            self.pool.release_all(self.context)
+            self.assertEqual(self._next_auto_assign_mac(rng), 8)
+            self.assertEqual(self._deallocated_macs(), [1, 2, 3])
+
+    def test_expired_lease_is_returned(self):
+        cfg.CONF.set_override("mac_address_lease_ttl", 0, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override, "mac_address_lease_ttl",
+                        "QUARK")
+        with self._fixtures() as rng:
+            self.assertEqual(self.pool.pop(self.context), (0, rng["id"]))
+            self.assertEqual(self.pool.pop(self.context), (1, rng["id"]))
+            self.assertEqual(self._next_auto_assign_mac(rng), 5)
+
+    def test_abandoned_lease_is_reclaimed(self):
+        cfg.CONF.set_override("mac_address_lease_ttl", 0, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override, "mac_address_lease_ttl",
+                        "QUARK")
+        with self._fixtures() as rng:
+            address, rng_id = self.pool.pop(self.context)
+            with self.context.session.begin():
+                db_api.mac_address_create(self.context, address=address,
+                                          mac_address_range_id=rng_id)
+            # NOTE: the worker holding the lease dies without returning it.
+            self.pool = mac_leases.MacLeasePool()
+
+            self.assertEqual(self.pool.pop(self.context), (1, rng["id"]))
+            self.assertEqual(self._next_auto_assign_mac(rng), 5)
+            self.assertEqual(self._deallocated_macs(), [])
+            leases = self.context.session.query(models.MacAddressLease).all()
+            self.assertEqual([(lease["first_address"], lease["last_address"])
+                              for lease in leases], [(1, 4)])
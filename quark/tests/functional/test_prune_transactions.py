@@ -0,0 +1,41 @@
+from quark.db import api as db_api
+from quark.db import models
+from quark.tests.functional.base import BaseFunctionalTest
+from quark.tools import prune_transactions
+
+
+class QuarkPruneTransactions(BaseFunctionalTest):
+    def setUp(self):
+        super(QuarkPruneTransactions, self).setUp()
+        with self.context.session.begin():
+            for _ in xrange(5):
+                db_api.transaction_create(self.context)
+
+    def _remaining(self):
+        return self.context.session.query(models.Transaction).count()
+
+    def test_prune_in_batches(self):
+        pruned = prune_transactions.prune_transactions(self.context, 2)
+        self.assertEqual(pruned, 5)
+        self.assertEqual(self._remaining(), 0)
+
+    def test_prune_dry_run(self):
+        pruned = prune_transactions.prune_transactions(self.context, 2,
+                                                       dry_run=True)
+        self.assertEqual(pruned, 5)
+        self.assertEqual(self._remaining(), 5)
+
+
+class QuarkClaimTokens(BaseFunctionalTest):
+    def test_claim_tokens_fit_transaction_id(self):
+        token = db_api.claim_token_create()
+        self.assertTrue(0 <= token < 2 ** 63)
+        with self.context.session.begin():
+            mac_range = db_api.mac_address_range_create(
+                self.context, cidr="AA:BB:CC/24", first_address=0,
+                last_address=255, next_auto_assign_mac=0)
+            db_api.mac_address_create(
+                self.context, address=1,
+                mac_address_range_id=mac_range["id"], transaction_id=token)
+        mac = db_api.mac_address_reallocate_find(self.context, token)
+        self.assertEqual(mac["address"], 1)
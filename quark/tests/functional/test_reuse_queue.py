@@ -0,0 +1,119 @@
+import contextlib
+import datetime
+
+import netaddr
+from oslo_utils import timeutils
+
+from quark.db import api as db_api
+from quark.db import models
+from quark.tests.functional.base import BaseFunctionalTest
+
+
+class QuarkIPAddressReuseQueue(BaseFunctionalTest):
+    @contextlib.contextmanager
+    def _fixtures(self):
+        with self.context.session.begin():
+            net_mod = db_api.network_create(self.context, name="public",
+                                            tenant_id="fake")
+            sub_mod = db_api.subnet_create(self.context, network=net_mod,
+                                           cidr="192.168.0.0/24",
+                                           tenant_id="fake")
+        yield net_mod, sub_mod
+
+    def _create_ip(self, net, subnet, address):
+        with self.context.session.begin():
+            return db_api.ip_address_create(
+                self.context, address=netaddr.IPAddress(address),
+                subnet_id=subnet["id"], network_id=net["id"], version=4)
+
+    def _deallocate(self, ip, ago):
+        with self.context.session.begin():
+            db_api.ip_address_deallocate(self.context, ip)
+            ip["deallocated_at"] = (timeutils.utcnow() -
+                                    datetime.timedelta(seconds=ago))
+
+    def _queued(self):
+        queue = models.IPAddressReuseQueue
+        query = self.context.session.query(queue.ip_address_id)
+        return [row.ip_address_id
+                for row in query.order_by(queue.deallocated_at)]
+
+    def _reallocate(self, net, reuse_after=60):
+        context = self.context.elevated()
+        with context.session.begin():
+            return db_api.ip_address_reallocate_from_queue(
+                context, {models.IPAddress.deallocated: False,
+                          models.IPAddress.transaction_id:
+                          db_api.claim_token_create()},
+                network_id=net["id"], deallocated=True, version=4,
+                lock_id=None, reuse_after=reuse_after)
+
+    def test_queue_follows_deallocation(self):
+        with self._fixtures() as (net, subnet):
+            ip = self._create_ip(net, subnet, "192.168.0.2")
+            self.assertEqual(self._queued(), [])
+            self._deallocate(ip, 0)
+            self.assertEqual(self._queued(), [ip["id"]])
+
+            with self.context.session.begin():
+                db_api.ip_address_update(self.context, ip, deallocated=False)
+            self.assertEqual(self._queued(), [])
+
+    def test_reallocate_pops_oldest_eligible(self):
+        with self._fixtures() as (net, subnet):
+            newer = self._create_ip(net, subnet, "192.168.0.2")
+            older = self._create_ip(net, subnet, "192.168.0.3")
+            recent = self._create_ip(net, subnet, "192.168.0.4")
+            self._deallocate(newer, 100)
+            self._deallocate(older, 200)
+            self._deallocate(recent, 0)
+
+            self.assertTrue(self._reallocate(net))
+            self.context.session.refresh(older)
+            self.assertFalse(older["_deallocated"])
+            self.assertEqual(self._queued(), [recent["id"], newer["id"]])
+
+            self.assertTrue(self._reallocate(net))
+            self.assertFalse(self._reallocate(net))
+            self.assertEqual(self._queued(), [recent["id"]])
+
+    def test_reallocate_skips_ineligible_entries(self):
+        with self._fixtures() as (net, subnet):
+            ip = self._create_ip(net, subnet, "192.168.0.2")
+            self._deallocate(ip, 100)
+            with self.context.session.begin():
+                db_api.subnet_update(self.context, subnet, do_not_use=True)
+
+            self.assertFalse(self._reallocate(net))
+            self.assertEqual(self._queued(), [ip["id"]])
+
+            with self.context.session.begin():
+                db_api.subnet_update(self.context, subnet, do_not_use=False)
+            self.assertTrue(self._reallocate(net))
+            self.assertEqual(self._queued(), [])
+
+
+class QuarkMacAddressReuseQueue(BaseFunctionalTest):
+    def test_reallocate_pops_deallocated_mac(self):
+        with self.context.session.begin():
+            rng = db_api.mac_address_range_create(
+                self.context, cidr="AA:BB:CC/24", do_not_use=False,
+                first_address=0, last_address=255, next_auto_assign_mac=2)
+            mac = db_api.mac_address_create(
+                self.context, address=1, mac_address_range_id=rng["id"])
+        with self.context.session.begin():
+            db_api.mac_address_update(
+                self.context, mac, deallocated=True,
+                deallocated_at=datetime.datetime(1970, 1, 1))
+
+        context = self.context.elevated()
+        with context.session.begin():
+            result = db_api.mac_address_reallocate_from_queue(
+                context, {"deallocated": False}, deallocated=True,
+                reuse_after=60)
+        self.assertTrue(result)
+        self.context.session.refresh(mac)
+        self.assertFalse(mac["deallocated"])
+        self.assertEqual(
+            self.context.session.query(models.MacAddressReuseQueue).all(),
+            [])
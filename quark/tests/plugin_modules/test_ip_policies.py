@@ -84,8 +84,10 @@ class TestQuarkCreateIpPolicies(test_quark_plugin.TestQuarkPlugin):
             mock.patch("%s.subnet_find" % db_mod),
             mock.patch("%s.network_find" % db_mod),
             mock.patch("%s.ip_policy_create" % db_mod),
-            mock.patch("%s.route_find" % db_mod)
-        ) as (subnet_find, net_find, ip_policy_create, route_find):
+            mock.patch("%s.route_find" % db_mod),
+            mock.patch("%s.subnet_update_set_free_ranges" % db_mod)
+        ) as (subnet_find, net_find, ip_policy_create, route_find,
+              set_free_ranges):
             subnet_find.return_value = subnets if subnets else None
             net_find.return_value = nets if nets else None
             ip_policy_create.return_value = ip_policy
@@ -301,7 +303,9 @@ class TestQuarkUpdateIpPolicies(test_quark_plugin.TestQuarkPlugin):
             mock.patch("%s.subnet_find" % db_mod),
             mock.patch("%s.network_find" % db_mod),
             mock.patch("%s.ip_policy_update" % db_mod),
-        ) as (ip_policy_find, subnet_find, network_find, ip_policy_update):
+            mock.patch("%s.subnet_update_set_free_ranges" % db_mod),
+        ) as (ip_policy_find, subnet_find, network_find, ip_policy_update,
+              set_free_ranges):
             ip_policy_find.return_value = ip_policy
             subnet_find.return_value = subnets
             network_find.return_value = networks
@@ -891,6 +891,20 @@ class TestQuarkAllocationPoolCache(test_quark_plugin.TestQuarkPlugin):
             set_cache.assert_called_with(self.context, subnet_found)
         cfg.CONF.set_override('allow_allocation_pool_update', og, 'QUARK')
 
+    @mock.patch("quark.db.api.subnet_update_set_free_ranges")
+    @mock.patch("quark.db.api.subnet_update_set_alloc_pool_cache")
+    def test_update_subnet_allocation_pools_invalidate_free_ranges(
+            self, set_cache, set_free_ranges):
+        og = cfg.CONF.QUARK.allow_allocation_pool_update
+        cfg.CONF.set_override('allow_allocation_pool_update', True, 'QUARK')
+        with self._stubs() as subnet_found:
+            pools = [dict(start="172.16.0.1", end="172.16.0.12")]
+            s = dict(subnet=dict(allocation_pools=pools))
+            self.plugin.update_subnet(self.context, 1, s)
+            set_free_ranges.assert_called_once_with(self.context,
+                                                    subnet_found)
+        cfg.CONF.set_override('allow_allocation_pool_update', og, 'QUARK')
+
     @mock.patch("quark.db.api.subnet_update_set_alloc_pool_cache")
     def test_get_subnet_set_alloc_cache_if_cache_is_none(self, set_cache):
         with self._stubs() as subnet_found:
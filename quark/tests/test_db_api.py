@@ -198,6 +198,23 @@ class TestDBAPI(BaseFunctionalTest):
         result = db_api._model_query(self.context, test_model, bad_filter)
         self.assertEqual(len(result), 1)
 
+    def test_model_query_plans_once_per_model(self):
+        db_api._FILTER_PLANS.pop(models.Subnet, None)
+        with mock.patch("quark.db.api.class_mapper",
+                        wraps=db_api.class_mapper) as class_mapper:
+            first = db_api._model_query(self.context, models.Subnet,
+                                        {"network_id": [42]})
+            second = db_api._model_query(self.context, models.Subnet,
+                                         {"network_id": [43]})
+        self.assertEqual(class_mapper.call_count, 1)
+        self.assertEqual(len(first), 2)
+
+        def literal(clauses):
+            return sorted(str(clause.compile(
+                compile_kwargs={"literal_binds": True}))
+                for clause in clauses)
+        self.assertNotEqual(literal(first), literal(second))
+
     def test_port_associate_ip(self):
         self.context.session.add = mock.Mock()
         mock_ports = [models.Port(id=str(x), network_id="2", ip_addresses=[])
@@ -13,9 +13,11 @@
 # License for the specific language governing permissions and limitations
 #  under the License.
 
+from netaddr import IPNetwork
 from netaddr import IPSet
 
 from quark.db import models
+from quark import interval_set
 from quark.tests import test_base
 
 
@@ -38,3 +40,51 @@ class TestDBModels(test_base.TestBase):
                       network=dict(ip_policy=None), ip_policy=None)
         ip_policy_rules = models.IPPolicy.get_ip_policy_cidrs(subnet)
         self.assertEqual(ip_policy_rules, IPSet())
+
+    def test_get_compiled_policy(self):
+        ip_policy = models.IPPolicy(id="1", exclude=[
+            models.IPPolicyCIDR(cidr="0.0.0.0/32"),
+            models.IPPolicyCIDR(cidr="0.0.0.255/32"),
+            models.IPPolicyCIDR(cidr="0.0.0.1/32")])
+        subnet = dict(id=1, cidr="0.0.0.0/24", ip_policy=ip_policy)
+        net = IPNetwork("0.0.0.0/24").ipv6()
+        compiled = models.IPPolicy.get_compiled_policy(subnet)
+        self.assertEqual(compiled.intervals(),
+                         [[net.first, net.first + 1], [net.last, net.last]])
+        self.assertIs(models.IPPolicy.get_compiled_policy(subnet), compiled)
+
+    def test_get_compiled_policy_recompiles_changed_policy(self):
+        ip_policy = models.IPPolicy(id="2", exclude=[
+            models.IPPolicyCIDR(cidr="0.0.0.0/32")])
+        subnet = dict(id=1, cidr="0.0.0.0/24", ip_policy=ip_policy)
+        compiled = models.IPPolicy.get_compiled_policy(subnet)
+        ip_policy["exclude"] = [models.IPPolicyCIDR(cidr="0.0.0.0/31")]
+        ip_policy["revision"] = "changed"
+        recompiled = models.IPPolicy.get_compiled_policy(subnet)
+        self.assertNotEqual(compiled, recompiled)
+        self.assertEqual(recompiled.size, 2)
+
+    def test_get_compiled_policy_hit_skips_cidrs(self):
+        ip_policy = dict(id="3", revision="r1", exclude=[
+            models.IPPolicyCIDR(cidr="0.0.0.0/32")])
+        subnet = dict(id=1, cidr="0.0.0.0/24", ip_policy=ip_policy)
+        compiled = models.IPPolicy.get_compiled_policy(subnet)
+        del ip_policy["exclude"]
+        self.assertIs(models.IPPolicy.get_compiled_policy(subnet), compiled)
+        self.assertEqual(compiled.size, 1)
+
+    def test_get_compiled_policy_no_policy(self):
+        subnet = dict(id=1, cidr="0.0.0.0/24", ip_policy=None)
+        compiled = models.IPPolicy.get_compiled_policy(subnet)
+        self.assertEqual(compiled, interval_set.FrozenIntervalSet())
+
+    def test_allocation_pools_excludes_policy(self):
+        ip_policy = models.IPPolicy(exclude=[
+            models.IPPolicyCIDR(cidr="192.168.0.0/32"),
+            models.IPPolicyCIDR(cidr="192.168.0.64/26"),
+            models.IPPolicyCIDR(cidr="192.168.0.255/32")])
+        subnet = models.Subnet(cidr="192.168.0.0/24")
+        subnet["ip_policy"] = ip_policy
+        self.assertEqual(subnet.allocation_pools,
+                         [dict(start="192.168.0.1", end="192.168.0.63"),
+                          dict(start="192.168.0.128", end="192.168.0.254")])
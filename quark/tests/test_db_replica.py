@@ -0,0 +1,79 @@
+import mock
+from oslo_config import cfg
+
+from quark.db import replica
+from quark import plugin
+from quark.tests import test_base
+
+
+class TestReplicaRouting(test_base.TestBase):
+    def setUp(self):
+        super(TestReplicaRouting, self).setUp()
+        cfg.CONF.set_override("read_replica_routing", True, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override, "read_replica_routing",
+                        "QUARK")
+        cfg.CONF.set_override("slave_connection", "mysql://replica/neutron",
+                              "database")
+        self.addCleanup(cfg.CONF.clear_override, "slave_connection",
+                        "database")
+        patcher = mock.patch("quark.db.replica.LAG.get", return_value=0)
+        self.lag = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.context._session = None
+
+    def test_use_replica(self):
+        self.assertTrue(replica.use_replica(self.context))
+
+    def test_disabled_by_default(self):
+        cfg.CONF.clear_override("read_replica_routing", "QUARK")
+        self.assertFalse(replica.use_replica(self.context))
+
+    def test_primary_after_write(self):
+        replica.mark_written(self.context)
+        self.assertFalse(replica.use_replica(self.context))
+
+    def test_primary_when_lagging(self):
+        self.lag.return_value = 60
+        self.assertFalse(replica.use_replica(self.context))
+        self.lag.return_value = None
+        self.assertFalse(replica.use_replica(self.context))
+
+    def test_primary_in_transaction(self):
+        self.context._session = mock.Mock()
+        self.assertFalse(replica.use_replica(self.context))
+
+    @mock.patch("neutron.db.api.get_session")
+    def test_routed_swaps_session(self, get_session):
+        with replica.routed(self.context):
+            self.assertEqual(self.context._session, get_session.return_value)
+            self.assertTrue(replica.is_routed(self.context))
+        get_session.assert_called_once_with(use_slave=True)
+        get_session.return_value.close.assert_called_once_with()
+        self.assertIsNone(self.context._session)
+        self.assertFalse(replica.is_routed(self.context))
+
+
+class TestSessioned(test_base.TestBase):
+    def test_only_writes_are_marked(self):
+        class Plugin(object):
+            @plugin.sessioned
+            def get_thing(self, context):
+                pass
+
+            @plugin.sessioned
+            @plugin.read_only
+            def get_things(self, context):
+                pass
+
+            @plugin.sessioned
+            def create_thing(self, context):
+                pass
+
+        with mock.patch("quark.db.replica.routed") as routed:
+            Plugin().get_thing(self.context)
+            self.assertFalse(routed.called)
+            Plugin().get_things(self.context)
+            routed.assert_called_once_with(self.context)
+        self.assertFalse(getattr(self.context, replica.WROTE_KEY, False))
+        Plugin().create_thing(self.context)
+        self.assertTrue(getattr(self.context, replica.WROTE_KEY))
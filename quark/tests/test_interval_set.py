@@ -0,0 +1,65 @@
+from quark import interval_set
+from quark.tests import test_base
+
+
+class TestIntervalSet(test_base.TestBase):
+    def test_merges_adjacent_and_overlapping(self):
+        s = interval_set.IntervalSet([(5, 7), (1, 2), (3, 4), (6, 9)])
+        self.assertEqual(s.intervals(), [[1, 9]])
+        self.assertEqual(s.size, 9)
+
+    def test_keeps_disjoint_intervals(self):
+        s = interval_set.IntervalSet([(10, 12), (1, 2)])
+        self.assertEqual(s.intervals(), [[1, 2], [10, 12]])
+        self.assertEqual(len(s), 2)
+
+    def test_contains(self):
+        s = interval_set.IntervalSet([(1, 2), (10, 12)])
+        self.assertIn(1, s)
+        self.assertIn(11, s)
+        self.assertNotIn(0, s)
+        self.assertNotIn(5, s)
+        self.assertNotIn(13, s)
+
+    def test_next_gap(self):
+        s = interval_set.IntervalSet([(1, 2), (3, 5), (10, 12)])
+        self.assertEqual(s.next_gap(0), 0)
+        self.assertEqual(s.next_gap(1), 6)
+        self.assertEqual(s.next_gap(7), 7)
+        self.assertEqual(s.next_gap(12), 13)
+
+    def test_remove_splits_interval(self):
+        s = interval_set.IntervalSet.from_range(0, 255)
+        s.remove(0)
+        s.remove(255)
+        s.remove_range(10, 19)
+        self.assertEqual(s.intervals(), [[1, 9], [20, 254]])
+
+    def test_remove_range_spanning_intervals(self):
+        s = interval_set.IntervalSet([(1, 3), (5, 7), (9, 11)])
+        s.remove_range(2, 10)
+        self.assertEqual(s.intervals(), [[1, 1], [11, 11]])
+
+    def test_remove_missing_is_noop(self):
+        s = interval_set.IntervalSet([(1, 3)])
+        s.remove(7)
+        self.assertEqual(s.intervals(), [[1, 3]])
+
+    def test_pop_first(self):
+        s = interval_set.IntervalSet([(1, 2), (5, 5)])
+        self.assertEqual(s.pop_first(), 1)
+        self.assertEqual(s.pop_first(), 2)
+        self.assertEqual(s.pop_first(), 5)
+        self.assertIsNone(s.pop_first())
+        self.assertFalse(s)
+
+    def test_add_refills_hole(self):
+        s = interval_set.IntervalSet([(1, 3), (5, 7)])
+        s.add(4)
+        self.assertEqual(s.intervals(), [[1, 7]])
+
+    def test_json_round_trip(self):
+        first = 281470681743360
+        s = interval_set.IntervalSet([(first, first + 9),
+                                      (first + 20, first + 255)])
+        self.assertEqual(interval_set.IntervalSet.from_json(s.to_json()), s)
@@ -26,6 +26,7 @@ from oslo_db import exception as db_exc
 
 from quark.db import models
 from quark import exceptions as q_exc
+from quark import interval_set
 import quark.ipam
 from quark import network_strategy
 from quark.tests import test_base
@@ -254,6 +255,55 @@ class QuarkNewMacAddressAllocation(QuarkIpamBaseTest):
             self.assertEqual(mr[0]["next_auto_assign_mac"], -1)
 
 
+class QuarkNewMacAddressLeasedAllocation(QuarkIpamBaseTest):
+    def setUp(self):
+        super(QuarkNewMacAddressLeasedAllocation, self).setUp()
+        cfg.CONF.set_override("mac_address_lease_block_size", 256, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override,
+                        "mac_address_lease_block_size", "QUARK")
+
+    @contextlib.contextmanager
+    def _stubs(self, leased=None):
+        with contextlib.nested(
+            mock.patch("quark.db.api.mac_address_reallocate"),
+            mock.patch("quark.db.api."
+                       "mac_address_range_find_allocation_counts"),
+            mock.patch("quark.mac_leases.MAC_LEASES.pop"),
+            mock.patch("quark.db.api.mac_address_create")
+        ) as (mac_realloc, mac_range_count, lease_pop, mac_create):
+            mac_realloc.return_value = False
+            lease_pop.side_effect = leased
+            mac_create.side_effect = lambda context, **kw: mac_helper(kw)
+            yield mac_range_count, mac_create
+
+    def test_allocate_mac_from_lease(self):
+        with self._stubs(leased=[(5, 1)]) as (mac_range_count, mac_create):
+            address = self.ipam.allocate_mac_address(self.context, 0, 0, 0)
+            self.assertEqual(address["address"], 5)
+            self.assertEqual(address["mac_address_range_id"], 1)
+            self.assertFalse(mac_range_count.called)
+
+    def test_allocate_mac_from_lease_retries_conflict(self):
+        with self._stubs(leased=[(5, 1), (6, 1)]) as (_, mac_create):
+            mac_create.side_effect = [Exception,
+                                      mac_helper(dict(address=6))]
+            address = self.ipam.allocate_mac_address(self.context, 0, 0, 0)
+            self.assertEqual(address["address"], 6)
+
+    def test_allocate_mac_no_lease_fails(self):
+        with self._stubs(leased=[None]):
+            with self.assertRaises(exceptions.MacAddressGenerationFailure):
+                self.ipam.allocate_mac_address(self.context, 0, 0, 0)
+
+    def test_allocate_specific_mac_skips_lease(self):
+        with self._stubs() as (mac_range_count, _):
+            mac_range_count.return_value = None
+            with self.assertRaises(exceptions.MacAddressGenerationFailure):
+                self.ipam.allocate_mac_address(self.context, 0, 0, 0,
+                                               mac_address=254)
+            self.assertTrue(mac_range_count.called)
+
+
 class QuarkNewMacAddressAllocationCreateConflict(QuarkIpamBaseTest):
     @contextlib.contextmanager
     def _stubs(self, addresses=None, ranges=None):
@@ -1112,7 +1162,7 @@ class QuarkIpamAllocateFromV6Subnet(QuarkIpamBaseTest):
             ip_mod["deallocated"] = deallocated
 
         with contextlib.nested(
-            mock.patch("quark.db.models.IPPolicy.get_ip_policy_cidrs"),
+            mock.patch("quark.db.models.IPPolicy.get_compiled_policy"),
             mock.patch("quark.db.api.ip_address_find"),
             mock.patch("quark.db.api.ip_address_create"),
             mock.patch("quark.db.api.ip_address_update")
@@ -1137,7 +1187,8 @@ class QuarkIpamAllocateFromV6Subnet(QuarkIpamBaseTest):
         old_override = cfg.CONF.QUARK.v6_allocation_attempts
         cfg.CONF.set_override('v6_allocation_attempts', 1, 'QUARK')
 
-        policy = netaddr.IPSet(["feed::/64"])
+        net = netaddr.IPNetwork("feed::/64")
+        policy = interval_set.FrozenIntervalSet([(net.first, net.last)])
         with self._stubs(policies=policy):
             with self.assertRaises(exceptions.IpAddressGenerationFailure):
                 self.ipam._allocate_from_v6_subnet(self.context, 0, subnet6,
@@ -2015,6 +2066,158 @@ class QuarkIpamTestSelectSubnet(QuarkIpamBaseTest):
             self.assertTrue(refresh.called)
             self.assertEqual(subnets[0][0]["next_auto_assign_ip"], -1)
 
+    def test_select_subnet_skips_adjacent_policy_cidrs(self):
+        net = netaddr.IPNetwork("0.0.0.0/24").ipv6()
+        subnet = dict(id=1, first_ip=net.first, last_ip=net.last,
+                      cidr="0.0.0.0/24", ip_version=4, network_id=1,
+                      next_auto_assign_ip=net.first,
+                      ip_policy=dict(size=2, exclude=[
+                          models.IPPolicyCIDR(cidr="0.0.0.0/32"),
+                          models.IPPolicyCIDR(cidr="0.0.0.1/32")]))
+        with self._stubs(subnet, 0) as (subnets, refresh):
+            s = self.ipam.select_subnet(self.context, subnet["network_id"],
+                                        None, None)
+            self.assertEqual(subnets[0][0], s)
+            self.assertEqual(s["next_auto_assign_ip"], net.first + 3)
+
+    def test_select_subnet_skip_past_last_ip_marks_full(self):
+        net = netaddr.IPNetwork("0.0.0.0/24").ipv6()
+        subnet = dict(id=1, first_ip=net.first, last_ip=net.last,
+                      cidr="0.0.0.0/24", ip_version=4, network_id=1,
+                      next_auto_assign_ip=net.last,
+                      ip_policy=dict(size=1, exclude=[
+                          models.IPPolicyCIDR(cidr="0.0.0.255/32")]))
+        with self._stubs(subnet, 0) as (subnets, refresh):
+            s = self.ipam.select_subnet(self.context, subnet["network_id"],
+                                        None, None)
+            self.assertIsNone(s)
+            self.assertEqual(subnets[0][0]["next_auto_assign_ip"], -1)
+
+
+class QuarkIpamTestSelectSubnetFreeRanges(QuarkIpamBaseTest):
+    def setUp(self):
+        super(QuarkIpamTestSelectSubnetFreeRanges, self).setUp()
+        cfg.CONF.set_override("ipam_use_free_ranges", True, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override, "ipam_use_free_ranges",
+                        "QUARK")
+
+    @contextlib.contextmanager
+    def _stubs(self, subnet, free_ranges):
+        with contextlib.nested(
+            mock.patch("quark.db.api.subnet_find_ordered_by_most_full"),
+            mock.patch("quark.db.api.subnet_update_next_auto_assign_ip"),
+            mock.patch("quark.db.api.subnet_update_set_full"),
+            mock.patch("quark.db.api.subnet_free_ranges_find"),
+            mock.patch("quark.db.api.subnet_update_set_free_ranges"),
+            mock.patch("sqlalchemy.orm.session.Session.refresh"),
+        ) as (subnet_find, subnet_incr, subnet_set_full, ranges_find,
+              set_ranges, refresh):
+            subnet_find.return_value = [(subnet_helper(subnet), 0)]
+            ranges_find.return_value = free_ranges
+            yield subnet_incr, subnet_set_full, set_ranges
+
+    def test_select_subnet_reserves_first_free_address(self):
+        net = netaddr.IPNetwork("0.0.0.0/24").ipv6()
+        subnet = dict(id=1, first_ip=net.first, last_ip=net.last,
+                      cidr="0.0.0.0/24", ip_version=4,
+                      next_auto_assign_ip=net.first,
+                      ip_policy=None, network_id=1)
+        free_ranges = interval_set.IntervalSet([(net.first + 5,
+                                                 net.first + 7)])
+        with self._stubs(subnet, free_ranges) as (subnet_incr, set_full,
+                                                  set_ranges):
+            s = self.ipam.select_subnet(self.context, subnet["network_id"],
+                                        None, None)
+            self.assertEqual(s["reserved_ip"], net.first + 5)
+            self.assertFalse(subnet_incr.called)
+            set_ranges.assert_called_once_with(self.context, s, free_ranges,
+                                               reserved=[net.first + 5])
+            self.assertEqual(free_ranges.intervals(),
+                             [[net.first + 6, net.first + 7]])
+
+    def test_select_subnet_free_ranges_exhausted_marks_full(self):
+        net = netaddr.IPNetwork("0.0.0.0/24").ipv6()
+        subnet = dict(id=1, first_ip=net.first, last_ip=net.last,
+                      cidr="0.0.0.0/24", ip_version=4,
+                      next_auto_assign_ip=net.first,
+                      ip_policy=None, network_id=1)
+        with self._stubs(subnet, interval_set.IntervalSet()) as (
+                subnet_incr, set_full, set_ranges):
+            s = self.ipam.select_subnet(self.context, subnet["network_id"],
+                                        None, None)
+            self.assertIsNone(s)
+            self.assertEqual(set_full.call_count, 1)
+
+
+class QuarkIpamTestBulkAllocation(QuarkIpamBaseTest):
+    @contextlib.contextmanager
+    def _stubs(self, subnet, bulk_raises=False):
+        with contextlib.nested(
+            mock.patch("quark.db.api.subnet_find_ordered_by_most_full"),
+            mock.patch("quark.db.api.subnet_update_next_auto_assign_ip"),
+            mock.patch("quark.db.api.ip_address_create_bulk"),
+            mock.patch("quark.ipam.QuarkIpam.allocate_ip_address"),
+            mock.patch("quark.ipam.QuarkIpam._notify_new_addresses"),
+        ) as (subnet_find, subnet_incr, create_bulk, allocate, notify):
+            subnet_find.return_value = [(subnet_helper(subnet), 0)]
+
+            def _create_bulk(context, rows):
+                if bulk_raises:
+                    raise db_exc.DBDuplicateEntry()
+                return [dict(address_readable=str(row["address"]))
+                        for row in rows]
+
+            create_bulk.side_effect = _create_bulk
+            yield subnet_incr, create_bulk, allocate
+
+    def test_allocate_bulk_reserves_contiguous_range(self):
+        net = netaddr.IPNetwork("0.0.0.0/29").ipv6()
+        subnet = dict(id=1, first_ip=net.first, last_ip=net.last,
+                      cidr="0.0.0.0/29", ip_version=4,
+                      next_auto_assign_ip=net.first + 1,
+                      ip_policy=dict(size=1, exclude=[
+                          models.IPPolicyCIDR(cidr="0.0.0.2/32")]),
+                      network_id=1)
+        reqs = [dict(network_id=1, port_id=port_id, version=4)
+                for port_id in ("a", "b", "c")]
+        with self._stubs(subnet) as (subnet_incr, create_bulk, allocate):
+            res = self.ipam.allocate_ip_addresses_bulk(self.context, reqs, 0)
+            self.assertEqual(create_bulk.call_count, 1)
+            self.assertEqual(
+                [a["address_readable"] for port_id in ("a", "b", "c")
+                 for a in res[port_id]],
+                ["0.0.0.1", "0.0.0.3", "0.0.0.4"])
+            self.assertEqual(subnet_incr.call_args[1]["increment"], 4)
+            self.assertFalse(allocate.called)
+
+    def test_allocate_bulk_falls_back_when_short(self):
+        net = netaddr.IPNetwork("0.0.0.0/30").ipv6()
+        subnet = dict(id=1, first_ip=net.first, last_ip=net.last,
+                      cidr="0.0.0.0/30", ip_version=4,
+                      next_auto_assign_ip=net.last,
+                      ip_policy=None, network_id=1)
+        reqs = [dict(network_id=1, port_id=port_id, version=4)
+                for port_id in ("a", "b")]
+        with self._stubs(subnet) as (subnet_incr, create_bulk, allocate):
+            res = self.ipam.allocate_ip_addresses_bulk(self.context, reqs, 0)
+            self.assertEqual(len(res["a"]), 1)
+            self.assertEqual(allocate.call_count, 1)
+            self.assertEqual(allocate.call_args[0][3], "b")
+
+    def test_allocate_bulk_conflict_falls_back(self):
+        net = netaddr.IPNetwork("0.0.0.0/29").ipv6()
+        subnet = dict(id=1, first_ip=net.first, last_ip=net.last,
+                      cidr="0.0.0.0/29", ip_version=4,
+                      next_auto_assign_ip=net.first,
+                      ip_policy=None, network_id=1)
+        reqs = [dict(network_id=1, port_id="a", version=4),
+                dict(network_id=1, port_id="b", version=6)]
+        with self._stubs(subnet, bulk_raises=True) as (subnet_incr,
+                                                       create_bulk,
+                                                       allocate):
+            self.ipam.allocate_ip_addresses_bulk(self.context, reqs, 0)
+            self.assertEqual(allocate.call_count, 2)
+
 
 class QuarkIpamTestSelectSubnetLocking(QuarkIpamBaseTest):
     @contextlib.contextmanager
@@ -0,0 +1,84 @@
+import mock
+from oslo_config import cfg
+
+from quark import exceptions as q_exc
+from quark import ipam_locks
+from quark.tests import test_base
+
+
+class TestMemoryLockBackend(test_base.TestBase):
+    def setUp(self):
+        super(TestMemoryLockBackend, self).setUp()
+        self.backend = ipam_locks.MemoryLockBackend()
+        cfg.CONF.set_override("ipam_lock_acquire_timeout", 0, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override,
+                        "ipam_lock_acquire_timeout", "QUARK")
+
+    def test_released_lock_can_be_taken(self):
+        with self.backend.lock("net1") as held:
+            self.assertIsNotNone(held)
+        with self.backend.lock("net1") as lease:
+            self.assertIsNotNone(lease)
+            self.assertNotEqual(lease.value, held.value)
+
+    def test_held_lock_times_out_to_no_lease(self):
+        with self.backend.lock("net1") as held:
+            self.assertIsNotNone(held)
+            with self.backend.lock("net1") as lease:
+                self.assertIsNone(lease)
+            with self.backend.lock("net2") as lease:
+                self.assertIsNotNone(lease)
+
+    def test_expired_lease_can_be_taken(self):
+        cfg.CONF.set_override("ipam_lock_ttl_ms", 0, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override, "ipam_lock_ttl_ms",
+                        "QUARK")
+        with self.backend.lock("net1") as held:
+            with self.backend.lock("net1") as lease:
+                self.assertIsNotNone(lease)
+                self.assertNotEqual(lease.value, held.value)
+
+
+class TestRedisLockBackend(test_base.TestBase):
+    def setUp(self):
+        super(TestRedisLockBackend, self).setUp()
+        self.backend = ipam_locks.RedisLockBackend()
+        self.client = mock.MagicMock()
+        self.backend._client = self.client
+
+    def test_lock_acquires_and_releases(self):
+        self.client.acquire.return_value = True
+        with self.backend.lock("net1") as lease:
+            self.assertEqual(lease.name, "net1")
+        self.client.release.assert_called_once_with("net1", lease.value)
+
+    def test_lock_carries_on_without_redis(self):
+        self.client.acquire.side_effect = q_exc.RedisConnectionFailure()
+        with self.backend.lock("net1") as lease:
+            self.assertIsNone(lease)
+        self.assertFalse(self.client.release.called)
+
+
+class TestSynchronized(test_base.TestBase):
+    def setUp(self):
+        super(TestSynchronized, self).setUp()
+        cfg.CONF.set_override("ipam_synchronization_backend", "memory",
+                              "QUARK")
+        self.addCleanup(cfg.CONF.clear_override,
+                        "ipam_synchronization_backend", "QUARK")
+
+    def test_lock_name_scoped_by_argument(self):
+        @ipam_locks.synchronized("reallocate_ip", scope_arg="net_id")
+        def allocate(context, net_id, port_id=None):
+            return net_id
+
+        backend = ipam_locks.REGISTRY.get_backend()
+        with mock.patch.object(backend, "lock") as lock:
+            self.assertEqual(allocate(None, "net1"), "net1")
+            allocate(None, net_id="net2")
+        self.assertEqual([c[0][0] for c in lock.call_args_list],
+                         ["reallocate_ip.net1", "reallocate_ip.net2"])
+
+    def test_unknown_backend_raises(self):
+        with self.assertRaises(Exception):
+            ipam_locks.REGISTRY.get_backend("nope")
@@ -0,0 +1,43 @@
+import random
+
+import netaddr
+
+from quark import ipv6
+from quark.tests import test_base
+
+
+class TestIPv6Generation(test_base.TestBase):
+    def test_magic_int(self):
+        self.assertEqual(ipv6.MAGIC_INT,
+                         netaddr.IPAddress("::0200:0:0:0").value)
+
+    def test_cidr_network_masks_host_bits(self):
+        self.assertEqual(ipv6.cidr_network("fe80::1234/112"),
+                         netaddr.IPAddress("fe80::").value)
+        self.assertEqual(ipv6.cidr_network("feed::1/64"),
+                         netaddr.IPNetwork("feed::1/64").first)
+
+    def test_to_readable(self):
+        value = netaddr.IPAddress("fe80::a8bb:ccff:fedd:eeff").value
+        self.assertEqual(ipv6.to_readable(value), "fe80::a8bb:ccff:fedd:eeff")
+
+    def test_eui64_matches_netaddr(self):
+        mac = netaddr.EUI("AA:BB:CC:DD:EE:FF")
+        self.assertEqual(ipv6.eui64(mac.value), mac.eui64().value)
+
+    def test_rfc3041_ips_leave_global_random_alone(self):
+        port_id = "945af340-ed34-4fec-8c87-853a2df492b4"
+        random.seed(42)
+        expected = random.getrandbits(64)
+        random.seed(42)
+        ips = ipv6.rfc3041_ips(port_id, 0)
+        first = ips.next()
+        self.assertEqual(random.getrandbits(64), expected)
+        self.assertEqual(first,
+                         ipv6.rfc3041_ips(port_id, 0).next())
+
+    def test_generate_without_mac(self):
+        port_id = "945af340-ed34-4fec-8c87-853a2df492b4"
+        prefix = ipv6.cidr_network("fe80::/120")
+        self.assertEqual(ipv6.generate(None, port_id, prefix).next(),
+                         netaddr.IPAddress("fe80::40c9:a95:d83a:2ffa").value)
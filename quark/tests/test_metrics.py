@@ -0,0 +1,125 @@
+import contextlib
+import errno
+import socket
+
+import mock
+from oslo_config import cfg
+
+from quark import ipam
+from quark import metrics
+from quark.tests import test_base
+
+
+class TestMetricsRegistry(test_base.TestBase):
+    def test_render(self):
+        registry = metrics.MetricsRegistry()
+        registry.increment("retries_total", dict(network_id="net1"))
+        registry.increment("retries_total", dict(network_id="net1"), 2)
+        registry.observe("step_seconds", 0.02, dict(step="alloc"))
+        lines = registry.render().splitlines()
+        self.assertIn('retries_total{network_id="net1"} 3', lines)
+        self.assertIn('step_seconds_bucket{step="alloc",le="0.01"} 0',
+                      lines)
+        self.assertIn('step_seconds_bucket{step="alloc",le="0.025"} 1',
+                      lines)
+        self.assertIn('step_seconds_bucket{step="alloc",le="+Inf"} 1', lines)
+        self.assertIn('step_seconds_count{step="alloc"} 1', lines)
+
+
+class TestIPAMLogMetrics(test_base.TestBase):
+    def setUp(self):
+        super(TestIPAMLogMetrics, self).setUp()
+        self.sink = metrics.MemorySink()
+
+    def _log(self):
+        log = ipam.QuarkIPAMLog()
+        log.strategy = "ANY"
+        log.network_id = "net1"
+        first = log.make_entry("_try_allocate_ip_address")
+        first.failed("policy")
+        first.end()
+        log.make_entry("_try_allocate_ip_address").end()
+        return log
+
+    def test_record_ipam_log(self):
+        self.sink.record_ipam_log(self._log())
+        counters = self.sink.registry.counters
+        self.assertEqual(counters[(
+            "quark_ipam_step_failures_total",
+            (("network_id", "net1"), ("reason", "policy"),
+             ("step", "_try_allocate_ip_address"), ("strategy", "ANY")))],
+            1)
+        self.assertEqual(counters[(
+            "quark_ipam_retries_total",
+            (("network_id", "net1"), ("step", "_try_allocate_ip_address"),
+             ("strategy", "ANY")))], 1)
+        histograms = self.sink.registry.histograms
+        self.assertEqual(histograms[(
+            "quark_ipam_allocation_seconds",
+            (("outcome", "success"), ("strategy", "ANY")))][2], 1)
+
+    def test_log_end_publishes_to_sink(self):
+        log = self._log()
+        with mock.patch("quark.metrics.REGISTRY.get_sink") as get_sink:
+            log.end()
+        get_sink.return_value.record_ipam_log.assert_called_once_with(log)
+
+    def test_statsd_payload(self):
+        sink = metrics.StatsdSink()
+        sink._socket = mock.MagicMock()
+        sink.observe("quark_ipam_step_seconds", 0.25, dict(step="alloc"))
+        payload = sink._socket.sendto.call_args[0][0]
+        self.assertEqual(payload, "quark_ipam_step_seconds:250|ms|#step:alloc")
+
+
+class TestPrometheusSink(test_base.TestBase):
+    def setUp(self):
+        super(TestPrometheusSink, self).setUp()
+        self.sink = metrics.PrometheusSink()
+        cfg.CONF.set_override("ipam_metrics_prometheus_port", 9000, "QUARK")
+        cfg.CONF.set_override("ipam_metrics_prometheus_ports", 3, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override,
+                        "ipam_metrics_prometheus_port", "QUARK")
+        self.addCleanup(cfg.CONF.clear_override,
+                        "ipam_metrics_prometheus_ports", "QUARK")
+
+    @contextlib.contextmanager
+    def _stubs(self, in_use):
+        def _server(address, handler):
+            if address[1] in in_use:
+                raise socket.error(errno.EADDRINUSE, "in use")
+            server = mock.MagicMock()
+            server.server_address = address
+            return server
+
+        with contextlib.nested(
+            mock.patch("quark.metrics.BaseHTTPServer.HTTPServer"),
+            mock.patch("quark.metrics.threading.Thread")
+        ) as (http_server, thread):
+            http_server.side_effect = _server
+            yield http_server, thread
+
+    def test_binds_first_free_port(self):
+        with self._stubs(in_use=[9000, 9001]) as (http_server, thread):
+            self.sink.increment("retries_total")
+            self.assertEqual(self.sink.port, 9002)
+            self.sink.increment("retries_total")
+            self.assertEqual(http_server.call_count, 3)
+            self.assertEqual(thread.return_value.start.call_count, 1)
+
+    def test_no_free_port_raises(self):
+        with self._stubs(in_use=[9000, 9001, 9002]) as (http_server, thread):
+            self.assertRaises(socket.error, self.sink.increment,
+                              "retries_total")
+            self.assertIsNone(self.sink.port)
+            self.assertFalse(thread.called)
+
+    def test_forked_worker_serves_its_own(self):
+        with self._stubs(in_use=[]) as (http_server, thread):
+            with mock.patch("quark.metrics.os.getpid", return_value=1):
+                self.sink.increment("retries_total")
+            parent = self.sink._server
+            with mock.patch("quark.metrics.os.getpid", return_value=2):
+                self.sink.increment("retries_total")
+            parent.server_close.assert_called_once_with()
+            self.assertEqual(thread.return_value.start.call_count, 2)
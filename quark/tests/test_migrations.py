@@ -842,3 +842,285 @@ class Test4fc07b41d45c(BaseMigrationTest):
                 self.ip_addresses_table.c.id)).fetchall()
         expected_results = []
         self.assertEqual(results, expected_results)
+
+
+class Test3f1b7a9c2d5e(BaseMigrationTest):
+    def setUp(self):
+        super(Test3f1b7a9c2d5e, self).setUp()
+        alembic_command.upgrade(self.config, '2a8e3ba5f58e')
+        self.subnets = table(
+            'quark_subnets',
+            column('id', sa.String(length=36)),
+            column('_cidr', sa.String(length=64)))
+        self.ip_addresses = table(
+            'quark_ip_addresses',
+            column('id', sa.String(length=36)),
+            column('address', INET()),
+            column('address_readable', sa.String(length=128)),
+            column('subnet_id', sa.String(length=36)),
+            column('_deallocated', sa.Boolean()))
+
+    def _counts(self):
+        subnets = table(
+            'quark_subnets',
+            column('id', sa.String(length=36)),
+            column('allocated_count', sa.Integer()),
+            column('reserved_count', sa.Integer()))
+        return self.connection.execute(select([subnets]).order_by(
+            subnets.c.id)).fetchall()
+
+    def test_upgrade_empty(self):
+        alembic_command.upgrade(self.config, '3f1b7a9c2d5e')
+        self.assertEqual(self._counts(), [])
+
+    def test_upgrade(self):
+        self.connection.execute(
+            self.subnets.insert(),
+            dict(id="1", _cidr="192.168.10.0/24"),
+            dict(id="2", _cidr="192.168.20.0/24"))
+        self.connection.execute(
+            self.ip_addresses.insert(),
+            dict(id="1", address=1, address_readable="1", subnet_id="1",
+                 _deallocated=False),
+            dict(id="2", address=2, address_readable="2", subnet_id="1",
+                 _deallocated=None),
+            dict(id="3", address=3, address_readable="3", subnet_id="1",
+                 _deallocated=True))
+        alembic_command.upgrade(self.config, '3f1b7a9c2d5e')
+        self.assertEqual(self._counts(), [(u"1", 2, 1), (u"2", 0, 0)])
+
+
+class Test5e1f9d3a7b20(BaseMigrationTest):
+    def setUp(self):
+        super(Test5e1f9d3a7b20, self).setUp()
+        alembic_command.upgrade(self.config, '4c8e2f0b6a71')
+        self.mac_ranges = table(
+            'quark_mac_address_ranges',
+            column('id', sa.String(length=36)),
+            column('cidr', sa.String(length=255)),
+            column('first_address', sa.BigInteger()),
+            column('last_address', sa.BigInteger()),
+            column('next_auto_assign_mac', sa.BigInteger()))
+        self.mac_addresses = table(
+            'quark_mac_addresses',
+            column('address', sa.BigInteger()),
+            column('mac_address_range_id', sa.String(length=36)),
+            column('deallocated', sa.Boolean()))
+
+    def _counts(self):
+        mac_ranges = table(
+            'quark_mac_address_ranges',
+            column('id', sa.String(length=36)),
+            column('allocated_count', sa.Integer()))
+        return self.connection.execute(select([mac_ranges]).order_by(
+            mac_ranges.c.id)).fetchall()
+
+    def test_upgrade_empty(self):
+        alembic_command.upgrade(self.config, '5e1f9d3a7b20')
+        self.assertEqual(self._counts(), [])
+
+    def test_upgrade(self):
+        self.connection.execute(
+            self.mac_ranges.insert(),
+            dict(id="1", cidr="AA:BB:CC/24", first_address=0,
+                 last_address=255, next_auto_assign_mac=2),
+            dict(id="2", cidr="AA:BB:CD/24", first_address=256,
+                 last_address=511, next_auto_assign_mac=256))
+        self.connection.execute(
+            self.mac_addresses.insert(),
+            dict(address=0, mac_address_range_id="1", deallocated=False),
+            dict(address=1, mac_address_range_id="1", deallocated=True))
+        alembic_command.upgrade(self.config, '5e1f9d3a7b20')
+        self.assertEqual(self._counts(), [(u"1", 2), (u"2", 0)])
+
+
+class Test1d7c4b8e9f36(BaseMigrationTest):
+    def setUp(self):
+        super(Test1d7c4b8e9f36, self).setUp()
+        alembic_command.upgrade(self.config, '5e1f9d3a7b20')
+        self.ip_addresses = table(
+            'quark_ip_addresses',
+            column('id', sa.String(length=36)),
+            column('address', INET()),
+            column('address_readable', sa.String(length=128)),
+            column('network_id', sa.String(length=36)),
+            column('version', sa.Integer()),
+            column('_deallocated', sa.Boolean()),
+            column('deallocated_at', sa.DateTime()))
+        self.mac_addresses = table(
+            'quark_mac_addresses',
+            column('address', sa.BigInteger()),
+            column('mac_address_range_id', sa.String(length=36)),
+            column('deallocated', sa.Boolean()),
+            column('deallocated_at', sa.DateTime()))
+        self.ip_queue = table(
+            'quark_ip_address_reuse_queue',
+            column('ip_address_id', sa.String(length=36)),
+            column('network_id', sa.String(length=36)),
+            column('version', sa.Integer()),
+            column('deallocated_at', sa.DateTime()))
+        self.mac_queue = table(
+            'quark_mac_address_reuse_queue',
+            column('address', sa.BigInteger()),
+            column('deallocated_at', sa.DateTime()))
+
+    def test_upgrade_empty(self):
+        alembic_command.upgrade(self.config, '1d7c4b8e9f36')
+        self.assertEqual(self.connection.execute(
+            select([self.ip_queue])).fetchall(), [])
+        self.assertEqual(self.connection.execute(
+            select([self.mac_queue])).fetchall(), [])
+
+    def test_upgrade(self):
+        dt = datetime.datetime(1970, 1, 1)
+        self.connection.execute(
+            self.ip_addresses.insert(),
+            dict(id="1", address=1, address_readable="1", network_id="n",
+                 version=4, _deallocated=True, deallocated_at=dt),
+            dict(id="2", address=2, address_readable="2", network_id="n",
+                 version=4, _deallocated=False, deallocated_at=None))
+        self.connection.execute(
+            self.mac_addresses.insert(),
+            dict(address=1, mac_address_range_id="1", deallocated=False,
+                 deallocated_at=None),
+            dict(address=2, mac_address_range_id="1", deallocated=True,
+                 deallocated_at=dt))
+        alembic_command.upgrade(self.config, '1d7c4b8e9f36')
+        self.assertEqual(self.connection.execute(
+            select([self.ip_queue])).fetchall(), [(u"1", u"n", 4, dt)])
+        self.assertEqual(self.connection.execute(
+            select([self.mac_queue])).fetchall(), [(2, dt)])
+
+
+class Test2b9e4d1c7a58(BaseMigrationTest):
+    def setUp(self):
+        super(Test2b9e4d1c7a58, self).setUp()
+        alembic_command.upgrade(self.config, '1d7c4b8e9f36')
+        self.ip_addresses = table(
+            'quark_ip_addresses',
+            column('id', sa.String(length=36)),
+            column('address', INET()),
+            column('address_readable', sa.String(length=128)),
+            column('version', sa.Integer()),
+            column('transaction_id', sa.BigInteger()))
+        self.mac_addresses = table(
+            'quark_mac_addresses',
+            column('address', sa.BigInteger()),
+            column('mac_address_range_id', sa.String(length=36)),
+            column('transaction_id', sa.BigInteger()))
+
+    def _assert_claim_column(self, table_name):
+        inspector = sa.inspect(self.engine)
+        transaction_id = [c for c in inspector.get_columns(table_name)
+                          if c["name"] == "transaction_id"][0]
+        self.assertIsInstance(transaction_id["type"], sa.BigInteger)
+        self.assertEqual(
+            [fk for fk in inspector.get_foreign_keys(table_name)
+             if fk["referred_table"] == "quark_transactions"], [])
+        self.assertIn("ix_%s_transaction_id" % table_name,
+                      [i["name"] for i in inspector.get_indexes(table_name)])
+
+    def test_upgrade_empty(self):
+        alembic_command.upgrade(self.config, '2b9e4d1c7a58')
+        self._assert_claim_column("quark_ip_addresses")
+        self._assert_claim_column("quark_mac_addresses")
+
+    def test_upgrade(self):
+        self.connection.execute(
+            self.ip_addresses.insert(),
+            dict(id="1", address=1, address_readable="1", version=4,
+                 transaction_id=None))
+        self.connection.execute(
+            self.mac_addresses.insert(),
+            dict(address=1, mac_address_range_id="1", transaction_id=None))
+        alembic_command.upgrade(self.config, '2b9e4d1c7a58')
+        self._assert_claim_column("quark_ip_addresses")
+        self._assert_claim_column("quark_mac_addresses")
+
+        token = 2 ** 40
+        self.connection.execute(
+            self.ip_addresses.update().values(transaction_id=token))
+        self.connection.execute(
+            self.mac_addresses.update().values(transaction_id=token))
+        self.assertEqual(self.connection.execute(
+            select([self.ip_addresses.c.id,
+                    self.ip_addresses.c.transaction_id])).fetchall(),
+            [(u"1", token)])
+        self.assertEqual(self.connection.execute(
+            select([self.mac_addresses.c.address,
+                    self.mac_addresses.c.transaction_id])).fetchall(),
+            [(1, token)])
+
+
+class Test3c9a5e2f7d14(BaseMigrationTest):
+    def setUp(self):
+        super(Test3c9a5e2f7d14, self).setUp()
+        alembic_command.upgrade(self.config, '6a2d8f4c1e93')
+
+    def test_upgrade(self):
+        alembic_command.upgrade(self.config, '3c9a5e2f7d14')
+        inspector = sa.inspect(self.engine)
+        self.assertEqual(
+            sorted(c["name"] for c in
+                   inspector.get_columns("quark_mac_address_leases")),
+            ["created_at", "expires_at", "first_address", "id",
+             "last_address", "mac_address_range_id"])
+
+    def test_downgrade(self):
+        alembic_command.upgrade(self.config, '3c9a5e2f7d14')
+        alembic_command.downgrade(self.config, '6a2d8f4c1e93')
+        self.assertNotIn("quark_mac_address_leases",
+                         sa.inspect(self.engine).get_table_names())
+
+
+class Test7e2b4c9a1f58(BaseMigrationTest):
+    def setUp(self):
+        super(Test7e2b4c9a1f58, self).setUp()
+        alembic_command.upgrade(self.config, '3c9a5e2f7d14')
+        self.subnets = table(
+            'quark_subnets',
+            column('id', sa.String(length=36)),
+            column('_cidr', sa.String(length=64)),
+            column('allocated_count', sa.Integer()),
+            column('reserved_count', sa.Integer()))
+        self.cursors = table(
+            'quark_subnet_cursors',
+            column('subnet_id', sa.String(length=36)),
+            column('stripe', sa.Integer()),
+            column('first_ip', INET()),
+            column('last_ip', INET()),
+            column('next_auto_assign_ip', INET()),
+            column('allocated_count', sa.Integer()),
+            column('reserved_count', sa.Integer()))
+
+    def test_upgrade(self):
+        alembic_command.upgrade(self.config, '7e2b4c9a1f58')
+        inspector = sa.inspect(self.engine)
+        self.assertTrue(set(["allocated_count", "reserved_count"]).issubset(
+            c["name"] for c in inspector.get_columns("quark_subnet_cursors")))
+
+    def test_downgrade_folds_stripe_counts(self):
+        alembic_command.upgrade(self.config, '7e2b4c9a1f58')
+        self.connection.execute(
+            self.subnets.insert(),
+            dict(id="000", _cidr="192.168.10.0/24", allocated_count=1,
+                 reserved_count=0),
+            dict(id="111", _cidr="192.168.11.0/24", allocated_count=2,
+                 reserved_count=1))
+        self.connection.execute(
+            self.cursors.insert(),
+            dict(subnet_id="000", stripe=0, first_ip=1, last_ip=127,
+                 next_auto_assign_ip=1, allocated_count=3, reserved_count=1),
+            dict(subnet_id="000", stripe=1, first_ip=128, last_ip=255,
+                 next_auto_assign_ip=128, allocated_count=4,
+                 reserved_count=-1))
+        alembic_command.downgrade(self.config, '3c9a5e2f7d14')
+        results = self.connection.execute(
+            select([self.subnets.c.id, self.subnets.c.allocated_count,
+                    self.subnets.c.reserved_count]).order_by(
+                self.subnets.c.id)).fetchall()
+        self.assertEqual(results, [(u"000", 8, 0), (u"111", 2, 1)])
+        self.assertNotIn(
+            "allocated_count",
+            [c["name"] for c in
+             sa.inspect(self.engine).get_columns("quark_subnet_cursors")])
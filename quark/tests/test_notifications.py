@@ -0,0 +1,93 @@
+import Queue
+
+import mock
+from oslo_config import cfg
+import sqlalchemy as sa
+from sqlalchemy import orm
+
+from quark import notifications
+from quark.tests import test_base
+
+
+class TestNotify(test_base.TestBase):
+    def setUp(self):
+        super(TestNotify, self).setUp()
+        engine = sa.create_engine("sqlite://")
+        self.context = mock.Mock()
+        self.context.session = orm.sessionmaker(bind=engine,
+                                                autocommit=True)()
+        self.payload = dict(ip_address="0.0.0.0")
+        patcher = mock.patch("quark.notifications.QUEUE.put")
+        self.put = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch("neutron.common.rpc.get_notifier")
+        self.get_notifier = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _notify(self):
+        notifications.notify(self.context, "ip_block.address.create",
+                             self.payload)
+
+    def test_sent_inline_by_default(self):
+        with self.context.session.begin():
+            self._notify()
+        self.get_notifier.return_value.info.assert_called_once_with(
+            self.context, "ip_block.address.create", self.payload)
+        self.assertFalse(self.put.called)
+
+    def test_queued_after_commit(self):
+        cfg.CONF.set_override("ipam_async_notifications", True, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override, "ipam_async_notifications",
+                        "QUARK")
+        with self.context.session.begin():
+            with self.context.session.begin(subtransactions=True):
+                self._notify()
+            self._notify()
+            self.assertFalse(self.put.called)
+        self.put.assert_called_once_with(
+            [(self.context, "ip_block.address.create", self.payload)] * 2)
+        self.assertFalse(self.get_notifier.called)
+
+    def test_discarded_on_rollback(self):
+        cfg.CONF.set_override("ipam_async_notifications", True, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override, "ipam_async_notifications",
+                        "QUARK")
+        with self.assertRaises(ValueError):
+            with self.context.session.begin():
+                self._notify()
+                raise ValueError()
+        with self.context.session.begin():
+            pass
+        self.assertFalse(self.put.called)
+
+    def test_queued_outside_transaction(self):
+        cfg.CONF.set_override("ipam_async_notifications", True, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override, "ipam_async_notifications",
+                        "QUARK")
+        self._notify()
+        self.put.assert_called_once_with(
+            [(self.context, "ip_block.address.create", self.payload)])
+
+
+class TestNotificationQueue(test_base.TestBase):
+    def test_flush_sends_in_batches(self):
+        cfg.CONF.set_override("ipam_notification_batch_size", 2, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override,
+                        "ipam_notification_batch_size", "QUARK")
+        queue = notifications.NotificationQueue()
+        queue._queue = Queue.Queue()
+        for i in xrange(3):
+            queue._queue.put(("context", "event", i))
+        with mock.patch("quark.notifications._send") as send:
+            queue.flush()
+        self.assertEqual(send.call_args_list,
+                         [mock.call([("context", "event", 0),
+                                     ("context", "event", 1)]),
+                          mock.call([("context", "event", 2)])])
+
+    def test_send_logs_failures(self):
+        with mock.patch("neutron.common.rpc.get_notifier") as get_notifier:
+            get_notifier.return_value.info.side_effect = [Exception(), None]
+            notifications._send([("context", "event", 0),
+                                 ("context", "event", 1)])
+        self.assertEqual(get_notifier.return_value.info.call_count, 2)
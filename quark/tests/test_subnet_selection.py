@@ -0,0 +1,64 @@
+from neutron import context
+from oslo_config import cfg
+
+from quark import subnet_selection
+from quark.tests import test_base
+
+
+class TestSubnetSelection(test_base.TestBase):
+    def setUp(self):
+        super(TestSubnetSelection, self).setUp()
+        self.candidates = [(dict(id="v4-1", ip_version=4), 200),
+                           (dict(id="v4-2", ip_version=4), 100),
+                           (dict(id="v4-3", ip_version=4), 0),
+                           (dict(id="v6-1", ip_version=6), 5)]
+        subnet_selection.CONTENTION.clear()
+        self.addCleanup(subnet_selection.CONTENTION.clear)
+
+    def _order(self, policy_name, ctx=None):
+        policy = subnet_selection.REGISTRY.policies[policy_name]
+        ordered = policy.order(ctx or self.context, list(self.candidates))
+        return [subnet["id"] for subnet, _ in ordered]
+
+    def test_most_full_keeps_order(self):
+        self.assertEqual(self._order("MOST_FULL"),
+                         ["v4-1", "v4-2", "v4-3", "v6-1"])
+
+    def test_least_contended(self):
+        subnet_selection.CONTENTION.record("v4-1")
+        subnet_selection.CONTENTION.record("v4-1")
+        subnet_selection.CONTENTION.record("v4-2")
+        self.assertEqual(self._order("LEAST_CONTENDED"),
+                         ["v4-3", "v4-2", "v4-1", "v6-1"])
+
+    def test_random_keeps_versions_apart(self):
+        ordered = self._order("RANDOM")
+        self.assertEqual(sorted(ordered[:3]), ["v4-1", "v4-2", "v4-3"])
+        self.assertEqual(ordered[3], "v6-1")
+
+    def test_tenant_hash_is_stable_per_tenant(self):
+        ordered = self._order("TENANT_HASH")
+        self.assertEqual(ordered, self._order("TENANT_HASH"))
+        self.assertEqual(ordered[3], "v6-1")
+
+    def test_tenant_hash_without_tenant_keeps_order(self):
+        ctx = context.Context('fake', None, is_admin=True)
+        self.assertEqual(self._order("TENANT_HASH", ctx),
+                         ["v4-1", "v4-2", "v4-3", "v6-1"])
+
+    def test_policy_per_network(self):
+        cfg.CONF.set_override("ipam_subnet_selection_networks",
+                              {"busy": "RANDOM"}, "QUARK")
+        self.addCleanup(cfg.CONF.clear_override,
+                        "ipam_subnet_selection_networks", "QUARK")
+        registry = subnet_selection.REGISTRY
+        self.assertEqual(registry.get_policy("busy").get_name(), "RANDOM")
+        self.assertEqual(registry.get_policy("quiet").get_name(),
+                         "MOST_FULL")
+
+    def test_unknown_policy_falls_back_to_most_full(self):
+        cfg.CONF.set_override("ipam_subnet_selection", "NOPE", "QUARK")
+        self.addCleanup(cfg.CONF.clear_override, "ipam_subnet_selection",
+                        "QUARK")
+        self.assertEqual(subnet_selection.REGISTRY.get_policy().get_name(),
+                         "MOST_FULL")
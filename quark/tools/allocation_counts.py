@@ -0,0 +1,120 @@
+import sys
+
+from neutron.common import config
+from neutron import context as neutron_context
+from oslo_config import cfg
+from oslo_log import log as logging
+from sqlalchemy import func as sql_func
+from sqlalchemy import or_
+
+from quark.db import models
+
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+allocation_counts_cli_opts = [
+    cfg.BoolOpt("dry-run", default=False,
+                help=_("Report drift in the denormalized allocation counts "
+                       "without fixing it"))
+]
+
+
+def main():
+    CONF.register_cli_opts(allocation_counts_cli_opts)
+    config.init(sys.argv[1:])
+    if not cfg.CONF.config_file:
+        sys.exit(_("ERROR: Unable to find configuration file via the default"
+                   " search paths (~/.neutron/, ~/, /etc/neutron/, /etc/) and"
+                   " the '--config-file' option!"))
+    config.setup_logging()
+
+    context = neutron_context.get_admin_context()
+    with context.session.begin():
+        drifted = reconcile_subnet_counts(context, dry_run=CONF.dry_run)
+    LOG.info("Found %s subnets with drifted allocation counts", len(drifted))
+    with context.session.begin():
+        drifted = reconcile_mac_range_counts(context, dry_run=CONF.dry_run)
+    LOG.info("Found %s MAC ranges with drifted allocation counts",
+             len(drifted))
+
+
+def _count_subnet_addresses(context, reserved):
+    query = context.session.query(models.IPAddress.subnet_id,
+                                  sql_func.count(models.IPAddress.id))
+    if reserved:
+        query = query.filter(models.IPAddress._deallocated == 1)
+    else:
+        query = query.filter(or_(models.IPAddress._deallocated.is_(None),
+                                 models.IPAddress._deallocated != 1))
+    query = query.group_by(models.IPAddress.subnet_id)
+    return dict(query.all())
+
+
+def _count_stripe_addresses(context):
+    cursor = models.SubnetCursor
+    query = context.session.query(cursor.subnet_id,
+                                  sql_func.sum(cursor.allocated_count),
+                                  sql_func.sum(cursor.reserved_count))
+    query = query.group_by(cursor.subnet_id)
+    return dict((subnet_id, (allocated or 0, reserved or 0))
+                for subnet_id, allocated, reserved in query)
+
+
+def reconcile_subnet_counts(context, dry_run=False):
+    """Recomputes Subnet.allocated_count and reserved_count.
+
+    The stored counts of a striped subnet include those kept on its cursor
+    stripes, which are left alone, the subnet row absorbs the difference.
+    Returns a list of (subnet_id, (allocated, reserved) stored,
+    (allocated, reserved) actual) for every subnet that had drifted.
+    """
+    allocated = _count_subnet_addresses(context, reserved=False)
+    reserved = _count_subnet_addresses(context, reserved=True)
+    striped = _count_stripe_addresses(context)
+
+    drifted = []
+    query = context.session.query(models.Subnet).with_lockmode("update")
+    for subnet in query:
+        on_stripes = striped.get(subnet["id"], (0, 0))
+        stored = (subnet["allocated_count"] + on_stripes[0],
+                  subnet["reserved_count"] + on_stripes[1])
+        actual = (allocated.get(subnet["id"], 0),
+                  reserved.get(subnet["id"], 0))
+        if stored == actual:
+            continue
+
+        LOG.info("Subnet %s counts drifted: stored %s, actual %s",
+                 subnet["id"], stored, actual)
+        drifted.append((subnet["id"], stored, actual))
+        if not dry_run:
+            subnet["allocated_count"] = actual[0] - on_stripes[0]
+            subnet["reserved_count"] = actual[1] - on_stripes[1]
+    return drifted
+
+
+def reconcile_mac_range_counts(context, dry_run=False):
+    """Recomputes MacAddressRange.allocated_count.
+
+    Returns a list of (mac_address_range_id, stored, actual) for every
+    range that had drifted.
+    """
+    query = context.session.query(models.MacAddress.mac_address_range_id,
+                                  sql_func.count(models.MacAddress.address))
+    query = query.group_by(models.MacAddress.mac_address_range_id)
+    allocated = dict(query.all())
+
+    drifted = []
+    query = context.session.query(models.MacAddressRange)
+    for mac_range in query.with_lockmode("update"):
+        stored = mac_range["allocated_count"]
+        actual = allocated.get(mac_range["id"], 0)
+        if stored == actual:
+            continue
+
+        LOG.info("MAC range %s count drifted: stored %s, actual %s",
+                 mac_range["id"], stored, actual)
+        drifted.append((mac_range["id"], stored, actual))
+        if not dry_run:
+            mac_range["allocated_count"] = actual
+    return drifted
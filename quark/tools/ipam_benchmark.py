@@ -0,0 +1,236 @@
+import json
+import multiprocessing
+import sys
+import threading
+import time
+import uuid
+
+import netaddr
+from neutron.common import config
+from neutron import context as neutron_context
+from neutron.db import api as neutron_db_api
+from oslo_config import cfg
+from oslo_db import exception as db_exception
+from oslo_log import log as logging
+
+from quark.db import api as db_api
+from quark.db import models
+from quark import ipam
+from quark import metrics
+from quark.plugin_modules import ip_policies
+
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+ipam_benchmark_cli_opts = [
+    cfg.StrOpt("strategy", default="ANY",
+               help=_("IPAM strategy of the seeded networks")),
+    cfg.StrOpt("operation", default="ip",
+               help=_("What each worker allocates: ip, mac or port, which "
+                      "is a MAC followed by IPs using it")),
+    cfg.IntOpt("workers", default=4,
+               help=_("Number of concurrent workers")),
+    cfg.BoolOpt("processes", default=False,
+                help=_("Run workers as processes rather than threads. "
+                       "Needs a database the processes can share, i.e. "
+                       "not in memory SQLite")),
+    cfg.IntOpt("allocations", default=100,
+               help=_("Number of allocations per worker")),
+    cfg.IntOpt("networks", default=1,
+               help=_("Number of networks to seed and spread workers "
+                      "across")),
+    cfg.IntOpt("subnets-per-network", default=4,
+               help=_("Number of v4 subnets seeded per network, each "
+                      "network also gets one v6 subnet")),
+    cfg.IntOpt("subnet-prefix", default=22,
+               help=_("Prefix length of the seeded v4 subnets")),
+    cfg.BoolOpt("create-schema", default=False,
+                help=_("Create the quark tables before seeding, for an "
+                       "empty database")),
+    cfg.StrOpt("label", default="",
+               help=_("Free form label saved with the results, e.g. the "
+                      "commit under test")),
+    cfg.StrOpt("output",
+               help=_("File to save the JSON results to, they're printed "
+                      "otherwise"))
+]
+
+
+def main():
+    CONF.register_cli_opts(ipam_benchmark_cli_opts)
+    config.init(sys.argv[1:])
+    if not cfg.CONF.config_file:
+        sys.exit(_("ERROR: Unable to find configuration file via the default"
+                   " search paths (~/.neutron/, ~/, /etc/neutron/, /etc/) and"
+                   " the '--config-file' option!"))
+    config.setup_logging()
+    CONF.set_override("ipam_metrics_sink", metrics.MemorySink.get_name(),
+                      "QUARK")
+
+    if CONF.create_schema:
+        models.BASEV2.metadata.create_all(neutron_db_api.get_engine())
+
+    context = neutron_context.get_admin_context()
+    network_ids = seed(context, CONF.networks, CONF.subnets_per_network,
+                       CONF.subnet_prefix, CONF.strategy)
+    results = run(network_ids, CONF.strategy, CONF.operation, CONF.workers,
+                  CONF.allocations, processes=CONF.processes)
+    results["options"] = dict(
+        strategy=CONF.strategy, operation=CONF.operation,
+        workers=CONF.workers, processes=CONF.processes,
+        allocations=CONF.allocations, networks=CONF.networks,
+        subnets_per_network=CONF.subnets_per_network,
+        subnet_prefix=CONF.subnet_prefix,
+        database=neutron_db_api.get_engine().dialect.name)
+    results["label"] = CONF.label
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if CONF.output:
+        with open(CONF.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+def seed(context, networks, subnets_per_network, subnet_prefix, strategy):
+    """Creates networks with v4 and v6 subnets, default IP policies and a
+    MAC range to allocate from. Returns the new network ids.
+    """
+    v4_subnets = netaddr.IPNetwork("10.0.0.0/8").subnet(subnet_prefix)
+    network_ids = []
+    with context.session.begin():
+        first_mac = netaddr.EUI("AA:BB:CC:00:00:00").value
+        db_api.mac_address_range_create(
+            context, cidr="AA:BB:CC/24", first_address=first_mac,
+            last_address=first_mac + 2 ** 24 - 1,
+            next_auto_assign_mac=first_mac, do_not_use=False)
+
+        for index in xrange(networks):
+            network = db_api.network_create(
+                context, id=str(uuid.uuid4()), name="benchmark-%d" % index,
+                tenant_id=context.tenant_id, ipam_strategy=strategy)
+            cidrs = [str(v4_subnets.next())
+                     for _ in xrange(subnets_per_network)]
+            cidrs.append("fd00:%x::/64" % index)
+            for cidr in cidrs:
+                subnet = db_api.subnet_create(
+                    context, network=network, cidr=cidr,
+                    ip_version=netaddr.IPNetwork(cidr).version)
+                exclude = []
+                ip_policies.ensure_default_policy(exclude, [subnet])
+                subnet["ip_policy"] = db_api.ip_policy_create(
+                    context, exclude=exclude)
+            network_ids.append(network["id"])
+    return network_ids
+
+
+def percentile(values, pct):
+    """Nearest rank percentile of an already sorted list."""
+    if not values:
+        return None
+    rank = max(int(round(pct / 100.0 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def _retries():
+    sink = metrics.REGISTRY.get_sink(metrics.MemorySink.get_name())
+    return sum(value for (name, _), value in sink.registry.counters.items()
+               if name.endswith("_ipam_retries_total"))
+
+
+def run_worker(context, network_id, strategy, operation, allocations):
+    """Performs allocations on a network, timing each one.
+
+    Returns a dict of the latencies of successful allocations, in seconds,
+    and the number of failed ones by exception name.
+    """
+    strategy = ipam.IPAM_REGISTRY.get_strategy(strategy)
+    latencies = []
+    failures = {}
+    for _ in xrange(allocations):
+        port_id = str(uuid.uuid4())
+        start = time.time()
+        try:
+            mac = None
+            if operation in ("mac", "port"):
+                mac = strategy.allocate_mac_address(
+                    context, network_id, port_id, CONF.QUARK.ipam_reuse_after)
+            if operation in ("ip", "port"):
+                addresses = []
+                strategy.allocate_ip_address(
+                    context, addresses, network_id, port_id,
+                    CONF.QUARK.ipam_reuse_after, mac_address=mac)
+            latencies.append(time.time() - start)
+        except Exception as e:
+            name = e.__class__.__name__
+            failures[name] = failures.get(name, 0) + 1
+    return dict(latencies=latencies, failures=failures)
+
+
+def _thread_worker(network_id, strategy, operation, allocations, results):
+    context = neutron_context.get_admin_context()
+    results.append(run_worker(context, network_id, strategy, operation,
+                              allocations))
+
+
+def _process_worker(network_id, strategy, operation, allocations, queue):
+    # NOTE: don't share the parent's pooled connections.
+    neutron_db_api.get_engine().dispose()
+    context = neutron_context.get_admin_context()
+    result = run_worker(context, network_id, strategy, operation,
+                        allocations)
+    result["retries"] = _retries()
+    queue.put(result)
+
+
+def run(network_ids, strategy, operation, workers, allocations,
+        processes=False):
+    """Runs workers spread across the networks and summarizes them."""
+    results = []
+    start = time.time()
+    if processes:
+        queue = multiprocessing.Queue()
+        procs = [multiprocessing.Process(
+            target=_process_worker,
+            args=(network_ids[i % len(network_ids)], strategy, operation,
+                  allocations, queue)) for i in xrange(workers)]
+        for proc in procs:
+            proc.start()
+        results = [queue.get() for _ in procs]
+        for proc in procs:
+            proc.join()
+        retries = sum(result["retries"] for result in results)
+    else:
+        retries_before = _retries()
+        threads = [threading.Thread(
+            target=_thread_worker,
+            args=(network_ids[i % len(network_ids)], strategy, operation,
+                  allocations, results)) for i in xrange(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        retries = _retries() - retries_before
+    return summarize(results, time.time() - start, retries)
+
+
+def summarize(results, elapsed, retries):
+    latencies = sorted(latency for result in results
+                       for latency in result["latencies"])
+    failures = {}
+    for result in results:
+        for name, count in result["failures"].items():
+            failures[name] = failures.get(name, 0) + count
+    deadlocks = failures.get(db_exception.DBDeadlock.__name__, 0)
+    return dict(
+        elapsed=elapsed,
+        allocations=len(latencies),
+        throughput=len(latencies) / elapsed if elapsed else 0,
+        latency=dict(p50=percentile(latencies, 50),
+                     p90=percentile(latencies, 90),
+                     p99=percentile(latencies, 99),
+                     max=latencies[-1] if latencies else None),
+        retries=retries,
+        deadlocks=deadlocks,
+        failures=failures)
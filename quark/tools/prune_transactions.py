@@ -0,0 +1,62 @@
+import sys
+
+from neutron.common import config
+from neutron import context as neutron_context
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from quark.db import models
+
+
+CONF = cfg.CONF
+LOG = logging.getLogger(__name__)
+
+prune_transactions_cli_opts = [
+    cfg.IntOpt("batch-size", default=10000,
+               help=_("Number of quark_transactions rows to delete per "
+                      "database transaction")),
+    cfg.BoolOpt("dry-run", default=False,
+                help=_("Report how many rows would be deleted without "
+                       "deleting them"))
+]
+
+
+def main():
+    CONF.register_cli_opts(prune_transactions_cli_opts)
+    config.init(sys.argv[1:])
+    if not cfg.CONF.config_file:
+        sys.exit(_("ERROR: Unable to find configuration file via the default"
+                   " search paths (~/.neutron/, ~/, /etc/neutron/, /etc/) and"
+                   " the '--config-file' option!"))
+    config.setup_logging()
+
+    context = neutron_context.get_admin_context()
+    pruned = prune_transactions(context, CONF.batch_size,
+                                dry_run=CONF.dry_run)
+    LOG.info("Pruned %s rows from quark_transactions", pruned)
+
+
+def prune_transactions(context, batch_size, dry_run=False):
+    """Empties the legacy quark_transactions table.
+
+    Reallocation claims rows with a token now, so nothing references the
+    table any more. Rows are deleted batch_size at a time, each batch in
+    its own transaction, to keep lock times short on large tables.
+    Returns the number of rows deleted, or that would be with dry_run.
+    """
+    query = context.session.query(models.Transaction)
+    if dry_run:
+        return query.count()
+
+    pruned = 0
+    while True:
+        with context.session.begin():
+            batch = query.with_entities(models.Transaction.id)
+            batch = batch.order_by(models.Transaction.id).limit(batch_size)
+            ids = [transaction_id for transaction_id, in batch]
+            if not ids:
+                return pruned
+            query.filter(models.Transaction.id.in_(ids)).delete(
+                synchronize_session=False)
+        pruned += len(ids)
+        LOG.debug("Deleted quark_transactions rows %s-%s", ids[0], ids[-1])